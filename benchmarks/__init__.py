@@ -0,0 +1 @@
+"""Benchmarks of KinesisProducer, see benchmarks.run."""
@@ -0,0 +1,287 @@
+"""Benchmark KinesisProducer against the StubKinesis stand-in.
+
+Each case of the grid of record sizes, buffer_size_limit,
+buffer_time_limit and kinesis_concurrency runs in its own process, so
+that its peak RSS and CPU time are its own, against a fresh stub running
+in this process. Results are appended to a JSON lines file, to compare
+them with the previous runs::
+
+    python -m benchmarks.run --record-sizes 100,1000 --concurrency 1,4
+    python -m benchmarks.run --compare  # Flag regressions
+
+"""
+from __future__ import print_function
+
+import argparse
+import base64
+import datetime
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+
+from kinesis_producer.clock import monotonic
+
+from .stub import StubKinesis
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_OUTPUT = os.path.join(ROOT, 'benchmarks', 'results.jsonl')
+
+# Results compared with the previous runs: name, True if higher is better
+COMPARED = (
+    ('records_per_second', True),
+    ('bytes_per_second', True),
+    ('latency_p50', False),
+    ('latency_p99', False),
+    ('peak_rss', False),
+    ('cpu_per_record', False),
+)
+
+
+def percentile(values, q):
+    """Return the q percentile (0 to 100) of sorted values."""
+    if not values:
+        return None
+    index = int(round(q / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def make_config(case, endpoint_url):
+    return dict(
+        aws_region='us-east-1',
+        buffer_size_limit=case['buffer_size_limit'],
+        buffer_time_limit=case['buffer_time_limit'],
+        kinesis_batch_size=case['kinesis_batch_size'],
+        kinesis_concurrency=case['kinesis_concurrency'],
+        kinesis_endpoint_url=endpoint_url,
+        kinesis_max_retries=10,
+        record_delimiter=b'\n',
+        stream_name='benchmark',
+    )
+
+
+def run_case(case, endpoint_url):
+    """Send the records of a case with a KinesisProducer, return results.
+
+    Latency is measured from send to the resolution of the record future,
+    CPU time and peak RSS are the ones of the current process.
+    """
+    import resource
+
+    from kinesis_producer import KinesisProducer
+
+    record_size = case['record_size']
+    record = base64.b64encode(os.urandom(record_size))[:record_size]
+    latencies = []
+    failures = []
+
+    def on_done(future, sent_at):
+        if future.exception() is not None:
+            failures.append(future)
+        latencies.append(monotonic() - sent_at)
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_started_at = usage.ru_utime + usage.ru_stime
+    started_at = monotonic()
+
+    producer = KinesisProducer(config=make_config(case, endpoint_url))
+    for _ in range(case['records']):
+        future = producer.send(record)
+        future.add_done_callback(
+            lambda future, sent_at=monotonic(): on_done(future, sent_at))
+    producer.close()
+    producer.join()
+
+    elapsed = monotonic() - started_at
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = usage.ru_utime + usage.ru_stime - cpu_started_at
+    # ru_maxrss is in bytes on macOS, in kilobytes elsewhere
+    peak_rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+    latencies.sort()
+    sent = case['records'] - len(failures)
+    return {
+        'elapsed': elapsed,
+        'records_failed': len(failures),
+        'records_per_second': sent / elapsed,
+        'bytes_per_second': sent * record_size / elapsed,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p99': percentile(latencies, 99),
+        'peak_rss': peak_rss,
+        'cpu_per_record': cpu / case['records'],
+        'put_retries': producer.stats()['counters'].get('put_retries', 0),
+    }
+
+
+def run_worker(case, endpoint_url):
+    """Run a case in a new process, return its results."""
+    env = dict(os.environ)
+    # botocore signs the requests, the stub ignores the signature
+    env.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    env.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    output = subprocess.check_output(
+        [sys.executable, '-m', 'benchmarks.run', '--worker', endpoint_url,
+         json.dumps(case)], cwd=ROOT, env=env)
+    return json.loads(output.decode('utf-8'))
+
+
+def iter_cases(args):
+    grid = itertools.product(args.record_sizes, args.buffer_size_limits,
+                             args.buffer_time_limits, args.concurrency)
+    for record_size, size_limit, time_limit, concurrency in grid:
+        yield {
+            'records': args.records,
+            'record_size': record_size,
+            'buffer_size_limit': size_limit,
+            'buffer_time_limit': time_limit,
+            'kinesis_batch_size': args.batch_size,
+            'kinesis_concurrency': concurrency,
+        }
+
+
+def get_revision():
+    try:
+        output = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode('ascii').strip()
+
+
+def load_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def find_previous(entry, previous_entries):
+    """Return the last previous entry of the same case and stub, if any."""
+    for previous in reversed(previous_entries):
+        if (previous['case'] == entry['case'] and
+                previous['stub'] == entry['stub']):
+            return previous
+    return None
+
+
+def compare(results, previous_results, threshold):
+    """Return the changes of the results worse than threshold (a ratio).
+
+    Changes are tuples like (name, previous value, value).
+    """
+    regressions = []
+    for name, higher_is_better in COMPARED:
+        value, previous = results.get(name), previous_results.get(name)
+        if not value or not previous:
+            continue
+        change = (value - previous) / float(previous)
+        if higher_is_better:
+            change = -change
+        if change > threshold:
+            regressions.append((name, previous, value))
+    return regressions
+
+
+def format_row(case, results):
+    return ('%(record_size)8i %(buffer_size_limit)9i %(buffer_time_limit)6g'
+            ' %(kinesis_concurrency)4i' % case +
+            ' %10.0f %8.2f %8.1f %8.1f %7.1f %7.2f' % (
+                results['records_per_second'],
+                results['bytes_per_second'] / 1e6,
+                (results['latency_p50'] or 0) * 1e3,
+                (results['latency_p99'] or 0) * 1e3,
+                results['peak_rss'] / 1e6,
+                results['cpu_per_record'] * 1e6))
+
+
+HEADER = ('    size    buffer   time conc  records/s     MB/s  p50(ms)'
+          '  p99(ms)  RSS(MB) CPU(us)')
+
+
+def parse_list(type_):
+    return lambda value: [type_(item) for item in value.split(',')]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--records', type=int, default=20000,
+                        help='records sent per case')
+    parser.add_argument('--record-sizes', type=parse_list(int),
+                        default=[100, 1000, 10000])
+    parser.add_argument('--buffer-size-limits', type=parse_list(int),
+                        default=[100000])
+    parser.add_argument('--buffer-time-limits', type=parse_list(float),
+                        default=[0.2])
+    parser.add_argument('--concurrency', type=parse_list(int),
+                        default=[1, 4], help='kinesis_concurrency values')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='kinesis_batch_size')
+    parser.add_argument('--shards', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='stub latency of each call (in seconds)')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='stub random extra latency (in seconds)')
+    parser.add_argument('--throttle-rate', type=float, default=0,
+                        help='ratio of records throttled by the stub')
+    parser.add_argument('--enforce-limits', action='store_true',
+                        help='throttle records over the shard limits')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT,
+                        help='JSON lines file of the results')
+    parser.add_argument('--no-save', action='store_true',
+                        help='do not append the results to the output')
+    parser.add_argument('--compare', action='store_true',
+                        help='compare with the previous results of the'
+                             ' output, exit with 1 on regressions')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='regression threshold (ratio)')
+    parser.add_argument('--worker', nargs=2, metavar=('ENDPOINT', 'CASE'),
+                        help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.worker:
+        endpoint_url, case = args.worker
+        print(json.dumps(run_case(json.loads(case), endpoint_url)))
+        return 0
+
+    stub_options = dict(shard_count=args.shards, latency=args.latency,
+                        jitter=args.jitter, throttle_rate=args.throttle_rate,
+                        enforce_limits=args.enforce_limits)
+    previous_entries = load_results(args.output) if args.compare else []
+    common = {
+        'date': datetime.datetime.utcnow().isoformat(),
+        'revision': get_revision(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+    }
+
+    regressed = False
+    print(HEADER)
+    for case in iter_cases(args):
+        with StubKinesis(**stub_options) as stub:
+            results = run_worker(case, stub.endpoint_url)
+            results['stub_throttled'] = stub.throttled
+        print(format_row(case, results))
+
+        entry = dict(common, case=case, stub=stub_options, results=results)
+        previous = find_previous(entry, previous_entries)
+        if previous is not None:
+            for name, before, after in compare(
+                    results, previous['results'], args.threshold):
+                regressed = True
+                print('    regression of %s: %g -> %g (%s)' % (
+                    name, before, after, previous['revision']))
+
+        if not args.no_save:
+            with open(args.output, 'a') as f:
+                f.write(json.dumps(entry, sort_keys=True) + '\n')
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
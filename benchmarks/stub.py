@@ -0,0 +1,208 @@
+"""Local stand-in of the Kinesis API, for benchmarks.
+
+StubKinesis is an HTTP server on the loopback interface answering the
+PutRecord, PutRecords and ListShards calls of botocore (JSON 1.1
+protocol), for any stream name. Records are discarded: only their count
+and size are kept.
+"""
+import base64
+import hashlib
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+
+from six.moves import BaseHTTPServer, socketserver
+
+from kinesis_producer.clock import monotonic
+from kinesis_producer.constants import (KINESIS_SHARD_MAX_BYTES_PER_SECOND,
+                                        KINESIS_SHARD_MAX_RECORDS_PER_SECOND)
+
+log = logging.getLogger(__name__)
+
+TARGET_PREFIX = 'Kinesis_20131202.'
+THROUGHPUT_EXCEEDED = 'ProvisionedThroughputExceededException'
+MAX_HASH_KEY = 2 ** 128 - 1
+
+
+def shard_id(index):
+    return 'shardId-%012i' % index
+
+
+class Shard(object):
+    """Hash key range of a stub shard, with its throughput of the second."""
+
+    def __init__(self, index, start, end):
+        self.shard_id = shard_id(index)
+        self.start = start
+        self.end = end
+        self._second = None
+        self._bytes = 0
+        self._records = 0
+
+    def consume(self, size, now):
+        """Count a record, return False if over the shard limits."""
+        second = int(now)
+        if second != self._second:
+            self._second = second
+            self._bytes = 0
+            self._records = 0
+        if (self._bytes + size > KINESIS_SHARD_MAX_BYTES_PER_SECOND or
+                self._records >= KINESIS_SHARD_MAX_RECORDS_PER_SECOND):
+            return False
+        self._bytes += size
+        self._records += 1
+        return True
+
+
+class StubKinesis(object):
+    """Kinesis stand-in listening on 127.0.0.1.
+
+    Each call waits latency seconds (plus up to jitter seconds) before
+    answering. Each record is rejected with a throttling error with the
+    probability throttle_rate and, with enforce_limits, when its shard is
+    over the Kinesis limits of the current second (1 MB and 1000 records).
+    Use as a context manager, or call start and close.
+    """
+
+    def __init__(self, shard_count=1, latency=0, jitter=0, throttle_rate=0,
+                 enforce_limits=False, port=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.enforce_limits = enforce_limits
+        self.shards = []
+        step = (MAX_HASH_KEY + 1) // shard_count
+        for index in range(shard_count):
+            end = MAX_HASH_KEY if index == shard_count - 1 \
+                else (index + 1) * step - 1
+            self.shards.append(Shard(index, index * step, end))
+
+        self.records = 0
+        self.bytes = 0
+        self.throttled = 0
+        self._sequence = itertools.count(1)
+        self._lock = threading.Lock()
+        self._random = random.Random()
+
+        self.server = _Server(('127.0.0.1', port), _Handler)
+        self.server.stub = self
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+
+    @property
+    def endpoint_url(self):
+        return 'http://%s:%i' % self.server.server_address[:2]
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _get_shard(self, entry):
+        hash_key = entry.get('ExplicitHashKey')
+        if hash_key is None:
+            digest = hashlib.md5(entry['PartitionKey'].encode('utf-8'))
+            hash_key = int(digest.hexdigest(), 16)
+        hash_key = int(hash_key)
+        for shard in self.shards:
+            if shard.start <= hash_key <= shard.end:
+                return shard
+        return self.shards[-1]
+
+    def put(self, entry):
+        """Return the result of a record, like a PutRecords result."""
+        size = len(base64.b64decode(entry['Data']))
+        size += len(entry['PartitionKey'].encode('utf-8'))
+        shard = self._get_shard(entry)
+        with self._lock:
+            throttled = (self._random.random() < self.throttle_rate or
+                         (self.enforce_limits and
+                          not shard.consume(size, monotonic())))
+            if throttled:
+                self.throttled += 1
+                return {'ErrorCode': THROUGHPUT_EXCEEDED,
+                        'ErrorMessage': 'Rate exceeded for shard %s' %
+                                        shard.shard_id}
+            self.records += 1
+            self.bytes += size
+            sequence_number = next(self._sequence)
+        return {'ShardId': shard.shard_id,
+                'SequenceNumber': '%056i' % sequence_number}
+
+    def wait(self):
+        delay = self.latency
+        if self.jitter:
+            delay += self._random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def put_record(self, request):
+        result = self.put(request)
+        if 'ErrorCode' in result:
+            return 400, {'__type': result['ErrorCode'],
+                         'message': result['ErrorMessage']}
+        return 200, result
+
+    def put_records(self, request):
+        results = [self.put(entry) for entry in request['Records']]
+        failed = sum(1 for result in results if 'ErrorCode' in result)
+        return 200, {'FailedRecordCount': failed, 'Records': results}
+
+    def list_shards(self, request):
+        shards = [{'ShardId': shard.shard_id,
+                   'HashKeyRange': {'StartingHashKey': str(shard.start),
+                                    'EndingHashKey': str(shard.end)},
+                   'SequenceNumberRange': {'StartingSequenceNumber': '0'}}
+                  for shard in self.shards]
+        return 200, {'Shards': shards}
+
+
+class _Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    operations = {
+        'PutRecord': StubKinesis.put_record,
+        'PutRecords': StubKinesis.put_records,
+        'ListShards': StubKinesis.list_shards,
+    }
+
+    def do_POST(self):
+        stub = self.server.stub
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length).decode('utf-8'))
+        target = self.headers.get('X-Amz-Target', '')
+        operation = self.operations.get(target[len(TARGET_PREFIX):])
+
+        stub.wait()
+        if operation is None:
+            status, response = 400, {'__type': 'UnknownOperationException',
+                                     'message': target}
+        else:
+            status, response = operation(stub, request)
+
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/x-amz-json-1.1')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
@@ -1,3 +1,5 @@
 from .producer import KinesisProducer
+from .budget import BufferFullError
+from .futures import DeliveryTimeoutError
 
-__all__ = ['KinesisProducer']
+__all__ = ['KinesisProducer', 'BufferFullError', 'DeliveryTimeoutError']
@@ -1,44 +1,233 @@
-import time
+import collections
+import itertools
+
+from .adaptive import get_adaptive_limits
+from .clock import monotonic
+from .compression import get_codec
+from .constants import KINESIS_RECORD_MAX_SIZE
+from .metrics import Metrics, RATIO_BUCKETS
 
 
 class RecordAccumulator(object):
+    """Accumulate records in one buffer per partition key.
+
+    Records sent without partition key share the buffer of the None key.
+    The record futures are kept with the buffer they were appended to.
+    Buffers are flushed independently, by size or by time. A buffer ready
+    by size is closed by the append that filled it. The time limit is
+    measured from the oldest record of a buffer, so no record waits more
+    than buffer_time_limit in the accumulator: buffers are kept in the
+    order they were started, so only the oldest ones are checked against
+    the time limit, whatever the number of keys. When more than
+    buffer_count_limit buffers are open, the least recently used one is
+    closed and becomes ready to be flushed.
+
+    The size attribute counts the bytes held by open and closed buffers.
+    With compression, buffers share one codec, which learns the ratio used
+    to estimate the compressed size of the buffers.
+    Metrics count the flushes by reason (size, time, forced or evicted)
+    and observe the aggregated records size as a ratio of the max size
+    and the aggregation latency (age of the oldest record when closed).
+
+    With adaptive_target_latency, the size and time limits follow the
+    AdaptiveLimits in the adaptive attribute, read each time a buffer is
+    closed.
+    """
 
-    def __init__(self, buffer_class, config):
+    def __init__(self, buffer_class, config, metrics=None):
         self.config = config
+        self.metrics = metrics or Metrics()
+        self.buffer_size_limit = config['buffer_size_limit']
         self.buffer_time_limit = config['buffer_time_limit']
+        self.adaptive = get_adaptive_limits(config)
+        self._update_limits()
+        self.buffer_count_limit = config.get('buffer_count_limit', 100)
         self._buffer_class = buffer_class
-        self._reset_buffer()
+        self.max_record_size = buffer_class.max_record_size(config)
+        self._codec = get_codec(config)
+        self._buffers = collections.OrderedDict()
+        self._buffer_started_at = collections.OrderedDict()
+        self._futures = {}
+        self._closed_buffers = []
+        self.size = 0
+
+    def _get_buffer(self, partition_key):
+        """Return the buffer of a partition key, most recently used last."""
+        buf = self._buffers.pop(partition_key, None)
+        if buf is None:
+            if len(self._buffers) >= self.buffer_count_limit:
+                self._close_buffer(next(iter(self._buffers)), 'evicted')
+            buf = self._buffer_class(config=self.config,
+                                     partition_key=partition_key,
+                                     codec=self._codec)
+            buf.size_limit = self.buffer_size_limit
+        self._buffers[partition_key] = buf
+        return buf
+
+    def _close_buffer(self, partition_key, reason):
+        buf = self._buffers.pop(partition_key)
+        started_at = self._buffer_started_at.pop(partition_key)
+        futures = self._futures.pop(partition_key)
+        buffer_size = buf.size
+        data = buf.flush()
+        self.size += len(data) - buffer_size
+        self._closed_buffers.append((partition_key, data, futures))
 
-    def _reset_buffer(self):
-        self._buffer = self._buffer_class(config=self.config)
-        self._buffer_started_at = None
+        self.metrics.incr('flushes_%s' % reason)
+        self.metrics.observe('aggregate_fill_ratio',
+                             float(len(data)) / KINESIS_RECORD_MAX_SIZE,
+                             buckets=RATIO_BUCKETS)
+        latency = monotonic() - started_at
+        self.metrics.observe('aggregation_latency', latency)
+        if self.adaptive is not None:
+            self.adaptive.flushed(reason, latency)
+            self._update_limits()
 
-    def try_append(self, record):
-        """Attempt to accumulate a record. Return False if buffer is full."""
-        success = self._buffer.try_append(record)
-        if success:
-            self._buffer_started_at = time.time()
+    def _update_limits(self):
+        if self.adaptive is not None:
+            self.buffer_size_limit = self.adaptive.size_limit
+            self.buffer_time_limit = self.adaptive.time_limit
+
+    def try_append(self, record, partition_key=None, future=None):
+        """Attempt to accumulate a record. Return False if it can't fit."""
+        success = self._append(record, partition_key, future)
+        if not success and partition_key in self._buffer_started_at:
+            self._close_buffer(partition_key, 'size')
+            success = self._append(record, partition_key, future)
         return success
 
-    def is_ready(self):
-        """Check whether the buffer is ready."""
-        if self._buffer_started_at is None:
+    def _append(self, record, partition_key, future):
+        buf, size = self._open_buffer(partition_key)
+        if not buf.try_append(record):
+            if size is None:
+                del self._buffers[partition_key]
             return False
+        self._appended(partition_key, buf, size,
+                       () if future is None else (future,))
+        return True
+
+    def try_append_many(self, records, partition_key=None, futures=None):
+        """Accumulate a list of records in one pass.
+
+        futures, if any, is the list of the record futures. Buffers are
+        closed as soon as they are full or ready by size. Return the number
+        of records appended: the next record can't fit in an empty buffer.
+        """
+        appended = 0
+        while appended < len(records):
+            buf, size = self._open_buffer(partition_key)
+            start = appended
+            appended = self._fill(buf, records, start)
+            if appended == start:  # Full buffer, or record too large
+                if size is None:
+                    del self._buffers[partition_key]
+                    break
+                self._close_buffer(partition_key, 'size')
+                continue
+            self._appended(partition_key, buf, size,
+                           [] if futures is None else
+                           [future for future in futures[start:appended]
+                            if future is not None])
+        return appended
+
+    @staticmethod
+    def _fill(buf, records, start):
+        """Append records from start until buf is full or ready by size.
+
+        Return the index of the first record not appended.
+        """
+        appended = start
+        for record in itertools.islice(records, start, None):
+            if not buf.try_append(record):
+                break
+            appended += 1
+            if buf.is_ready():
+                break
+        return appended
 
-        if self._buffer.is_ready():
+    def _open_buffer(self, partition_key):
+        """Return the buffer of a partition key and its size.
+
+        The size is None for a new buffer, not started yet.
+        """
+        buf = self._get_buffer(partition_key)
+        if partition_key not in self._buffer_started_at:
+            return buf, None
+        return buf, buf.size
+
+    def _appended(self, partition_key, buf, size, futures):
+        """Account for records appended to a buffer of _open_buffer.
+
+        Start the buffer if it is new, keep the futures of the records and
+        close the buffer if it is ready by size.
+        """
+        if size is None:
+            self._buffer_started_at[partition_key] = monotonic()
+            size = 0
+        self.size += buf.size - size
+        self._futures.setdefault(partition_key, []).extend(futures)
+        if buf.is_ready():
+            self._close_buffer(partition_key, 'size')
+
+    def next_deadline(self):
+        """Return when the next buffer is ready by time, on the monotonic
+        clock. Return None without records to flush."""
+        if self._closed_buffers:
+            return monotonic()
+        started_at = self._oldest_started_at()
+        if started_at is None:
+            return None
+        return started_at + self.buffer_time_limit
+
+    def _oldest_started_at(self):
+        # Buffers are started in order: the first one is the oldest
+        for started_at in self._buffer_started_at.values():
+            return started_at
+        return None
+
+    def oldest_record_age(self):
+        """Return the age of the oldest record of the open buffers."""
+        started_at = self._oldest_started_at()
+        if started_at is None:
+            return 0
+        return monotonic() - started_at
+
+    def is_ready(self):
+        """Check whether a buffer is ready."""
+        if self._closed_buffers:
             return True
 
-        elapsed = time.time() - self._buffer_started_at
-        return elapsed >= self.buffer_time_limit
+        started_at = self._oldest_started_at()
+        return (started_at is not None and
+                monotonic() - started_at >= self.buffer_time_limit)
 
     def has_records(self):
-        """Check whether the buffer has records."""
-        return self._buffer_started_at is not None
+        """Check whether the buffers have records."""
+        return bool(self._closed_buffers or self._buffer_started_at)
+
+    def flush_ready(self):
+        """Close the ready buffers.
+
+        Return a list of tuple like (partition_key, data, futures), in the
+        order the records must be sent.
+        """
+        deadline = monotonic() - self.buffer_time_limit
+        while self._buffer_started_at:
+            partition_key, started_at = next(
+                iter(self._buffer_started_at.items()))
+            if started_at > deadline:
+                break
+            self._close_buffer(partition_key, 'time')
+        return self._pop_closed_buffers()
 
     def flush(self):
-        """Close the buffer and return it."""
-        if self._buffer_started_at is None:
-            return
-        buf = self._buffer.flush()
-        self._reset_buffer()
-        return buf
+        """Close all the buffers and return them like flush_ready."""
+        for partition_key in list(self._buffer_started_at):
+            self._close_buffer(partition_key, 'forced')
+        return self._pop_closed_buffers()
+
+    def _pop_closed_buffers(self):
+        closed_buffers = self._closed_buffers
+        self._closed_buffers = []
+        self.size -= sum(len(data) for _, data, _ in closed_buffers)
+        return closed_buffers
@@ -0,0 +1,78 @@
+import logging
+import threading
+
+from .constants import KB, KINESIS_RECORD_MAX_SIZE
+
+log = logging.getLogger(__name__)
+
+
+class AdaptiveLimits(object):
+    """Buffer size and time limits tuned toward a target latency.
+
+    A record waits for its aggregated record to be ready, then for the
+    put: the time limit is what is left of target_latency once the put
+    latency (moving average) is taken out, so that records are delivered
+    within the target whatever the traffic.
+
+    The size limit follows AIMD: it grows by a step each time a buffer is
+    ready by size and records are delivered within the target (more
+    traffic, fewer and larger puts) and shrinks by a factor each time a
+    put takes longer than the target (larger puts are slower). Throttled
+    puts grow it by a factor, to lower the number of records per second.
+    Limits start from buffer_size_limit and buffer_time_limit.
+
+    Updated by the sender thread and the client threads: thread safe.
+    """
+
+    DECREASE_FACTOR = 0.8
+    INCREASE_STEP = 0.01  # Of the max size
+    MIN_SIZE_LIMIT = 1 * KB
+    MIN_TIME_RATIO = 0.1  # Of the target latency
+    PUT_LATENCY_ALPHA = 0.2
+
+    def __init__(self, target_latency, size_limit, time_limit,
+                 max_size_limit=KINESIS_RECORD_MAX_SIZE):
+        self.target_latency = target_latency
+        self.max_size_limit = max_size_limit
+        self.put_latency = 0
+        self._lock = threading.Lock()
+        self._set_limits(size_limit, time_limit)
+
+    def _set_limits(self, size_limit, time_limit):
+        self.size_limit = int(min(self.max_size_limit,
+                                  max(self.MIN_SIZE_LIMIT, size_limit)))
+        self.time_limit = min(self.target_latency,
+                              max(self.target_latency * self.MIN_TIME_RATIO,
+                                  time_limit))
+
+    def flushed(self, reason, aggregation_latency):
+        """Adapt to a buffer closed by reason after aggregation_latency."""
+        with self._lock:
+            latency = aggregation_latency + self.put_latency
+            if reason == 'size' and latency < self.target_latency:
+                self._set_limits(
+                    self.size_limit +
+                    self.INCREASE_STEP * self.max_size_limit,
+                    self.time_limit)
+
+    def sent(self, put_latency, throttled=False):
+        """Adapt to a put delivered (or given up) after put_latency."""
+        with self._lock:
+            self.put_latency += self.PUT_LATENCY_ALPHA * (
+                put_latency - self.put_latency)
+            size_limit = self.size_limit
+            if throttled:
+                size_limit /= self.DECREASE_FACTOR
+            elif put_latency > self.target_latency:
+                size_limit *= self.DECREASE_FACTOR
+            self._set_limits(size_limit,
+                             self.target_latency - self.put_latency)
+
+
+def get_adaptive_limits(config):
+    """Return the AdaptiveLimits of adaptive_target_latency, if any."""
+    target_latency = config.get('adaptive_target_latency')
+    if target_latency is None:
+        return None
+    return AdaptiveLimits(target_latency, config['buffer_size_limit'],
+                          config['buffer_time_limit'])
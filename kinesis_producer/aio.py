@@ -0,0 +1,261 @@
+import asyncio
+import functools
+import logging
+
+from .accumulator import RecordAccumulator
+from .buffer import get_buffer_class
+from .clock import monotonic
+from .client import get_connection, make_entry
+from .metrics import Metrics
+from .partitioner import random_partitioner
+from .producer import check_record
+from .retry import RetryPolicy, get_error_code
+
+try:
+    from aiobotocore.session import get_session
+except ImportError:
+    get_session = None
+
+log = logging.getLogger(__name__)
+
+
+def make_call(boto_function, **kwargs):
+    """Return a coroutine function calling boto_function with kwargs.
+
+    Coroutine functions, like aiobotocore client methods, are awaited.
+    Other functions are run in the default executor.
+    """
+    if asyncio.iscoroutinefunction(boto_function):
+        return functools.partial(boto_function, **kwargs)
+    loop = asyncio.get_event_loop()
+    return functools.partial(loop.run_in_executor, None,
+                             functools.partial(boto_function, **kwargs))
+
+
+async def call_and_retry(boto_function, max_retries, metrics=None,
+                         retry_policy=None, **kwargs):
+    """Call boto_function and retry its errors following retry_policy.
+
+    The retry policy is the one of the threaded client, RetryPolicy with
+    max_retries by default. With metrics, the latency of each call is
+    observed as put_latency and the retries and throttling errors are
+    counted.
+    """
+    call = make_call(boto_function, **kwargs)
+    if retry_policy is None:
+        retry_policy = RetryPolicy(max_retries)
+
+    retries = 0
+    while True:
+        started_at = monotonic()
+        try:
+            return await call()
+        except Exception as exc:
+            delay = retry_policy.retry_delay(get_error_code(exc), retries,
+                                             metrics)
+            if delay is None:
+                raise
+        finally:
+            if metrics is not None:
+                metrics.observe('put_latency', monotonic() - started_at)
+        await asyncio.sleep(delay)
+        retries += 1
+
+
+class AsyncClient(object):
+    """Asyncio Kinesis client.
+
+    Use aiobotocore when it is installed, boto3 in the default executor
+    otherwise, unless a connection is given.
+    """
+
+    def __init__(self, config, connection=None, metrics=None):
+        self.stream = config['stream_name']
+        self.max_retries = config['kinesis_max_retries']
+        self.retry_policy = RetryPolicy.from_config(config)
+        self.aws_region = config['aws_region']
+        self.endpoint_url = config.get('kinesis_endpoint_url')
+        self.connection = connection
+        self.metrics = metrics or Metrics()
+        self._client_context = None
+
+    async def start(self):
+        if self.connection is not None:
+            return
+        log.debug('Starting client')
+        if get_session is None:
+            self.connection = get_connection(self.aws_region,
+                                             self.endpoint_url)
+        else:
+            self._client_context = get_session().create_client(
+                'kinesis', region_name=self.aws_region,
+                endpoint_url=self.endpoint_url)
+            self.connection = await self._client_context.__aenter__()
+
+    async def put_record(self, record):
+        """Send a record to Kinesis API, like Client.put_record."""
+        entry = make_entry(record)
+
+        log.debug('Sending record: %s', entry['Data'][:100])
+        try:
+            await call_and_retry(self.connection.put_record,
+                                 self.max_retries, metrics=self.metrics,
+                                 retry_policy=self.retry_policy,
+                                 StreamName=self.stream, **entry)
+        except Exception:
+            log.exception('Failed to send records to Kinesis')
+            self.metrics.incr('kinesis_records_failed')
+        else:
+            self.metrics.incr('kinesis_records_sent')
+
+    async def close(self):
+        log.debug('Closing client')
+        if self._client_context is not None:
+            await self._client_context.__aexit__(None, None, None)
+            self._client_context = None
+
+
+class AsyncKinesisProducer(object):
+    """A Kinesis client publishing records from an asyncio event loop.
+
+    Records are aggregated on the event loop and each aggregated record is
+    sent by a task. At most kinesis_concurrency puts are in flight: send
+    waits for a put to complete when the limit is reached.
+    """
+
+    def __init__(self, config, connection=None):
+        log.debug('Starting AsyncKinesisProducer')
+        self.config = config
+        self._closed = False
+
+        if config.get('partitioner', 'random') != 'random':
+            raise ValueError('AsyncKinesisProducer only supports the random'
+                             ' partitioner')
+
+        self._metrics = Metrics(
+            exporters=config.get('metrics_exporters', ()),
+            interval=config.get('metrics_interval', 10))
+
+        buffer_class = get_buffer_class(config)
+        self._max_record_size = buffer_class.max_record_size(config)
+        self._accumulator = RecordAccumulator(buffer_class, config,
+                                              self._metrics)
+        self._client = AsyncClient(config, connection, self._metrics)
+
+        # asyncio primitives are created by _start, on the running loop:
+        # before Python 3.10, they are bound to the loop current when they
+        # are created.
+        self._put_semaphore = None
+        self._start_lock = None
+        self._put_tasks = set()
+        self._linger_task = None
+        self._wakeup = None
+        self._idle = False
+
+        self._metrics.register_gauge('accumulated_bytes',
+                                     lambda: self._accumulator.size)
+        self._metrics.register_gauge('puts_in_flight',
+                                     lambda: len(self._put_tasks))
+        self._metrics.register_gauge('oldest_record_age',
+                                     self._accumulator.oldest_record_age)
+
+    async def _start(self):
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+            self._put_semaphore = asyncio.Semaphore(
+                self.config['kinesis_concurrency'])
+            self._wakeup = asyncio.Event()
+        async with self._start_lock:
+            if self._linger_task is None:
+                await self._client.start()
+                self._linger_task = asyncio.ensure_future(self._linger())
+
+    async def send(self, record, partition_key=None):
+        """Publish a record to Kinesis.
+
+        Record must be bytes type. Wait only when too many puts are in
+        flight.
+        """
+        assert not self._closed, "AsyncKinesisProducer closed but called"
+
+        check_record(record, partition_key, self._max_record_size)
+        await self._start()
+
+        success = self._accumulator.try_append(record, partition_key)
+        assert success, "Failed to accumulate a valid record"
+        self._metrics.incr('records_sent')
+
+        if self._accumulator.is_ready():
+            await self._put(self._accumulator.flush_ready())
+        elif self._idle:
+            self._wakeup.set()  # The linger task now has a deadline
+
+    async def _linger(self):
+        """Flush the buffers reaching buffer_time_limit.
+
+        Sleep until the next flush or metrics export is due. Without
+        deadline, sleep until woken up by send or aclose.
+        """
+        while not self._closed:
+            await self._sleep_until_due()
+            if self._accumulator.is_ready():
+                await self._put(self._accumulator.flush_ready())
+            self._metrics.export_if_due()
+
+    async def _sleep_until_due(self):
+        deadlines = [deadline for deadline
+                     in (self._accumulator.next_deadline(),
+                         self._metrics.next_export())
+                     if deadline is not None]
+        timeout = None
+        if deadlines:
+            timeout = max(0, min(deadlines) - monotonic())
+        self._idle = timeout is None
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._idle = False
+        self._wakeup.clear()
+
+    async def _put(self, buffers):
+        for partition_key, record_data, _ in buffers:
+            log.debug('Flushing to client (length: %i)', len(record_data))
+            if partition_key is None:
+                partition_key = random_partitioner(record_data)
+
+            await self._put_semaphore.acquire()
+            task = asyncio.ensure_future(
+                self._client.put_record((record_data, partition_key)))
+            self._put_tasks.add(task)
+            task.add_done_callback(self._on_put_done)
+
+    def _on_put_done(self, task):
+        self._put_tasks.discard(task)
+        self._put_semaphore.release()
+
+    async def flush(self):
+        """Send all the accumulated records and wait for the puts."""
+        await self._put(self._accumulator.flush())
+        if self._put_tasks:
+            await asyncio.wait(self._put_tasks)
+
+    async def aclose(self):
+        """Send the remaining records and close the producer."""
+        if self._closed:
+            return
+        log.debug('Closing AsyncKinesisProducer')
+        self._closed = True
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+        if self._linger_task is not None:
+            await self._linger_task
+
+        await self.flush()
+        await self._client.close()
+        self._metrics.export()
+
+    def stats(self):
+        """Return a snapshot of the producer metrics, like KinesisProducer."""
+        return self._metrics.snapshot()
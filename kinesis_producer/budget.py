@@ -0,0 +1,82 @@
+import logging
+import threading
+
+from .clock import monotonic
+
+log = logging.getLogger(__name__)
+
+
+class BufferFullError(Exception):
+    """The producer holds max_buffered_bytes and can't accept a record."""
+
+
+class MemoryBudget(object):
+    """Count the bytes held by the producer, up to max_bytes.
+
+    Bytes are acquired by the callers of send and released once sent. When
+    the budget is exhausted, acquire applies the policy: block (until
+    timeout, if any), raise BufferFullError, drop the record or refuse it
+    to be spooled by the caller. A record is always accepted by an empty
+    budget, whatever its size.
+    """
+
+    POLICIES = ('block', 'raise', 'drop', 'spool')
+
+    def __init__(self, max_bytes=None, policy='block', timeout=None):
+        if policy not in self.POLICIES:
+            raise ValueError('Unknown buffer full policy: %s' % policy)
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.timeout = timeout
+        self.used = 0
+        self.dropped = 0
+        self._cond = threading.Condition()
+
+    def _fits(self, size):
+        if self.max_bytes is None or self.used == 0:
+            return True
+        return self.used + size <= self.max_bytes
+
+    def acquire(self, size, count=1):
+        """Reserve size bytes for count records.
+
+        Return False if the records are dropped or must be spooled.
+        """
+        with self._cond:
+            if not self._fits(size):
+                if self.policy == 'spool':
+                    return False
+                if self.policy == 'drop':
+                    self.dropped += count
+                    log.debug('Buffer full, record dropped')
+                    return False
+                if self.policy == 'raise' or not self._wait(size):
+                    raise BufferFullError('Producer buffer is full')
+            self.used += size
+            return True
+
+    def _wait(self, size):
+        """Wait for size bytes to be available, return False on timeout."""
+        if self.timeout is not None:
+            deadline = monotonic() + self.timeout
+
+        while not self._fits(size):
+            if self.timeout is None:
+                self._cond.wait()
+                continue
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return False
+            self._cond.wait(remaining)
+        return True
+
+    def add(self, size):
+        """Count bytes that were not acquired, without waiting."""
+        with self._cond:
+            self.used += size
+
+    def release(self, size):
+        """Free acquired or added bytes and wake up the waiting callers."""
+        with self._cond:
+            self.used -= size
+            self._cond.notify_all()
@@ -1,38 +1,174 @@
-import io
+import hashlib
 
-from .constants import KINESIS_RECORD_MAX_SIZE
+import six
 
+from .compression import PlainWriter, get_codec, max_input_size
+from .constants import (KINESIS_RECORD_MAX_SIZE,
+                        KINESIS_PARTITION_KEY_MAX_SIZE)
 
-class RawBuffer(object):
-    """Bytes buffer with delimiter."""
+KPL_MAGIC = b'\xf3\x89\x9a\xc2'
+KPL_DIGEST_SIZE = 16
 
-    def __init__(self, config):
-        self.record_delimiter = config['record_delimiter']
+
+class Buffer(object):
+    """Base class of the aggregation buffers.
+
+    Subclasses encode the records and may add a header and a trailer of
+    TRAILER_SIZE bytes. Bytes go through a writer which compresses them
+    with the codec, if any, and keeps track of the aggregated record size.
+    """
+
+    TRAILER_SIZE = 0
+
+    def __init__(self, config, partition_key=None, codec=None):
         self.size_limit = config['buffer_size_limit']
-        self._size = 0
-        self._buffer = io.BytesIO()
+        self._writer = PlainWriter() if codec is None else codec.writer()
+
+    @classmethod
+    def _overhead(cls, config):
+        """Return the size added to the largest record a buffer can hold."""
+        raise NotImplementedError()
+
+    @classmethod
+    def max_record_size(cls, config):
+        """Return the size of the largest record a buffer can hold."""
+        max_size = KINESIS_RECORD_MAX_SIZE
+        codec = get_codec(config)
+        if codec is not None:
+            max_size = max_input_size(max_size - codec.header_size())
+        return max_size - cls._overhead(config)
+
+    def _encode(self, record):
+        raise NotImplementedError()
+
+    def _write(self, data):
+        self._writer.write(data)
+
+    def _trailer(self):
+        return b''
 
     def try_append(self, record):
         """Append a record if possible, return False otherwise."""
-        assert self._buffer is not None, 'Buffer is closed!'
+        assert self._writer is not None, 'Buffer is closed!'
 
-        record_length = len(record) + len(self.record_delimiter)
+        encoded = self._encode(record)
 
-        if self._size + record_length > KINESIS_RECORD_MAX_SIZE:
+        if not self._writer.fits(len(encoded) + self.TRAILER_SIZE):
             return False
 
-        self._buffer.write(record)
-        self._buffer.write(self.record_delimiter)
-        self._size += record_length
+        self._write(encoded)
         return True
 
+    @property
+    def size(self):
+        """Size of the flushed buffer (in bytes), estimated if compressed."""
+        return self._writer.size + self.TRAILER_SIZE
+
     def is_ready(self):
         """Whether the buffer should be flushed."""
-        return self._size > self.size_limit
+        return self.size > self.size_limit
 
     def flush(self):
         """Return the buffer content and close the buffer."""
-        assert self._buffer is not None, 'Buffer is closed!'
-        buf = self._buffer.getvalue()
-        self._buffer = None
+        assert self._writer is not None, 'Buffer is closed!'
+        self._writer.write(self._trailer())
+        buf = self._writer.close()
+        self._writer = None
         return buf
+
+
+class RawBuffer(Buffer):
+    """Bytes buffer with delimiter."""
+
+    def __init__(self, config, partition_key=None, codec=None):
+        super(RawBuffer, self).__init__(config, partition_key, codec)
+        self.record_delimiter = config['record_delimiter']
+
+    @classmethod
+    def _overhead(cls, config):
+        return len(config['record_delimiter'])
+
+    def _encode(self, record):
+        return record + self.record_delimiter
+
+
+def _varint(value):
+    """Encode an unsigned integer as a protobuf varint."""
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _field(tag, payload):
+    """Encode a length-delimited protobuf field."""
+    return tag + _varint(len(payload)) + payload
+
+
+class KPLBuffer(Buffer):
+    """Buffer using the KPL aggregated record format.
+
+    The output is the magic number, an AggregatedRecord protobuf message
+    and the MD5 digest of that message. KCL consumers de-aggregate it
+    natively and records can contain any bytes.
+    """
+
+    DEFAULT_PARTITION_KEY = b'a'
+    TRAILER_SIZE = KPL_DIGEST_SIZE
+
+    # AggregatedRecord and Record protobuf field tags
+    TAG_PARTITION_KEY_TABLE = b'\x0a'
+    TAG_RECORDS = b'\x1a'
+    TAG_PARTITION_KEY_INDEX = b'\x08'
+    TAG_DATA = b'\x1a'
+
+    def __init__(self, config, partition_key=None, codec=None):
+        super(KPLBuffer, self).__init__(config, partition_key, codec)
+        if partition_key is None:
+            partition_key = self.DEFAULT_PARTITION_KEY
+        elif isinstance(partition_key, six.text_type):
+            partition_key = partition_key.encode('utf-8')
+
+        self._digest = hashlib.md5()
+        self._writer.write(KPL_MAGIC)
+        self._write(_field(self.TAG_PARTITION_KEY_TABLE, partition_key))
+
+    @classmethod
+    def _overhead(cls, config):
+        # Up to 4 UTF-8 bytes for each of the 256 characters of a key
+        longest_key = b'-' * (4 * KINESIS_PARTITION_KEY_MAX_SIZE)
+        empty_size = cls(config, partition_key=longest_key).size
+        # Data and Record fields both add a tag and a length, plus the
+        # partition key index field
+        field_overhead = 1 + len(_varint(KINESIS_RECORD_MAX_SIZE))
+        return empty_size + 2 * field_overhead + 2
+
+    def _encode(self, record):
+        message = (self.TAG_PARTITION_KEY_INDEX + _varint(0) +
+                   _field(self.TAG_DATA, record))
+        return _field(self.TAG_RECORDS, message)
+
+    def _write(self, data):
+        super(KPLBuffer, self)._write(data)
+        self._digest.update(data)
+
+    def _trailer(self):
+        return self._digest.digest()
+
+
+BUFFER_CLASSES = {
+    'raw': RawBuffer,
+    'kpl': KPLBuffer,
+}
+
+
+def get_buffer_class(config):
+    """Return the buffer class selected by the aggregation_format option."""
+    aggregation_format = config.get('aggregation_format', 'raw')
+    try:
+        return BUFFER_CLASSES[aggregation_format]
+    except KeyError:
+        raise ValueError('Unknown aggregation format: %s' %
+                         aggregation_format)
@@ -1,88 +1,472 @@
+import collections
+import functools
+import heapq
+import itertools
 import logging
-import time
+import threading
 from multiprocessing.pool import ThreadPool
 
-import boto3
-import botocore
+from .clock import monotonic, time_left
+from .futures import DeliveryTimeoutError
+from .metrics import Metrics
+from .ratelimit import get_rate_limiter
+from .retry import (RetryPolicy, RetryScheduler, THROUGHPUT_EXCEEDED,
+                    get_error_code)
 
 log = logging.getLogger(__name__)
 
+# boto3 and botocore are imported when first needed: importing them takes
+# hundreds of milliseconds, a waste for processes which never send.
+
+# Default size of the botocore connection pool
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+
+
+def get_connection(aws_region, endpoint_url=None, botocore_config=None):
+    import boto3
 
-def get_connection(aws_region):
     session = boto3.session.Session()
-    connection = session.client('kinesis', region_name=aws_region)
+    connection = session.client('kinesis', region_name=aws_region,
+                                endpoint_url=endpoint_url,
+                                config=botocore_config)
     return connection
 
 
-def call_and_retry(boto_function, max_retries, **kwargs):
-    """Retry Logic for generic boto client calls.
+def get_botocore_config(config):
+    """Return the botocore Config of the connection options.
 
-    This code follows the exponetial backoff pattern suggested by
-    http://docs.aws.amazon.com/general/latest/gr/api-retries.html
+    The connection pool holds at least a connection per thread of the
+    pool (kinesis_concurrency), so that threads never wait for one.
     """
-    retries = 0
-    while True:
-        if retries:
-            log.warning('Retrying (%i) %s', retries, boto_function)
+    import botocore.config
 
-        try:
-            return boto_function(**kwargs)
-        except botocore.exceptions.ClientError as exc:
-            if retries >= max_retries:
-                raise exc
-            error_code = exc.response.get("Error", {}).get("Code")
-            if error_code == 'ProvisionedThroughputExceededException':
-                time.sleep(2 ** retries * .1)
-                retries += 1
-            else:
-                raise exc
+    options = {'max_pool_connections': config.get(
+        'kinesis_max_pool_connections',
+        max(DEFAULT_MAX_POOL_CONNECTIONS,
+            config.get('kinesis_concurrency', 1)))}
+    for name in ('connect_timeout', 'read_timeout', 'tcp_keepalive'):
+        value = config.get('kinesis_' + name)
+        if value is not None:
+            options[name] = value
+    return botocore.config.Config(**options)
+
+
+def create_connection(config):
+    """Return the boto3 Kinesis client of the config.
+
+    With kinesis_client_factory, the factory is called with the config
+    instead, to reuse a session and its credentials for instance.
+    """
+    factory = config.get('kinesis_client_factory')
+    if factory is not None:
+        return factory(config)
+    return get_connection(config['aws_region'],
+                          config.get('kinesis_endpoint_url'),
+                          get_botocore_config(config))
+
+
+def get_stream_configs(config):
+    """Return the config of each stream by name, stream_name first.
+
+    The streams option maps the names of the other streams to the options
+    they override, like {'clicks': {'buffer_time_limit': 1}}.
+    """
+    configs = collections.OrderedDict([(config['stream_name'], config)])
+    for stream, overrides in sorted(config.get('streams', {}).items()):
+        stream_config = dict(config)
+        stream_config.update(overrides or {})
+        stream_config['stream_name'] = stream
+        configs[stream] = stream_config
+    return configs
+
+
+def make_entry(record):
+    """Return the Kinesis API parameters of a record tuple."""
+    entry = {'Data': record[0], 'PartitionKey': record[1]}
+    if len(record) > 2:
+        entry['ExplicitHashKey'] = record[2]
+    return entry
+
+
+def joined_error():
+    """Return the error of the puts given up by a joined client."""
+    return DeliveryTimeoutError('Kinesis client joined')
+
+
+def make_put_records_error(result):
+    """Return the ClientError of a record rejected by PutRecords."""
+    from botocore.exceptions import ClientError
+
+    error = {'Code': result['ErrorCode'],
+             'Message': result.get('ErrorMessage', '')}
+    return ClientError({'Error': error}, 'PutRecords')
 
 
 class Client(object):
-    """Synchronous Kinesis client."""
+    """Synchronous Kinesis client.
+
+    Failed calls are retried following the retry policy: this client
+    sleeps before retrying, to keep the records in order. With a rate
+    limiter, puts wait for the throughput limits before being sent and the
+    limiter learns from the throttling errors.
+
+    Records are sent to stream_name, or to the stream given to put_record
+    and put_records: each stream of the streams option has its own rate
+    limiter.
+
+    Once joined, the puts waiting for a retry or for the rate limiter, and
+    the puts started afterwards, are given up with DeliveryTimeoutError.
+    """
 
-    def __init__(self, config):
+    def __init__(self, config, metrics=None):
         self.stream = config['stream_name']
         self.max_retries = config['kinesis_max_retries']
-        self.connection = get_connection(config['aws_region'])
+        self.metrics = metrics or Metrics()
+        self.connection = create_connection(config)
+        self.retry_policy = RetryPolicy.from_config(config)
+        self.limiters = dict(
+            (stream, get_rate_limiter(self.connection, stream_config))
+            for stream, stream_config in get_stream_configs(config).items())
+        self.limiter = self.limiters[self.stream]
+        self._joined = threading.Event()
+
+    def warm(self):
+        """Open the connections to Kinesis before the first puts."""
+        self._warm_connection()
+
+    def _warm_connection(self):
+        try:
+            self.connection.list_shards(StreamName=self.stream, MaxResults=1)
+        except Exception:
+            log.warning('Failed to warm a Kinesis connection', exc_info=True)
+
+    def _get_limiter(self, stream):
+        if stream == self.stream:
+            return self.limiter
+        return self.limiters.get(stream)
+
+    def _wait_for_limiter(self, limiter, entries):
+        """Sleep until the entries can be sent under the rate limits.
+
+        Return False if the client is joined: the entries are given up.
+        """
+        if self._joined.is_set():
+            return False
+        if limiter is None:
+            return True
+        delay = limiter.reserve(entries)
+        if delay > 0:
+            self.metrics.observe('rate_limit_delay', delay)
+            return not self._joined.wait(delay)
+        return True
+
+    def _call(self, boto_function, stream, **kwargs):
+        started_at = monotonic()
+        try:
+            return boto_function(StreamName=stream, **kwargs)
+        finally:
+            self.metrics.observe('put_latency', monotonic() - started_at)
+
+    def _schedule(self, delay, func, give_up, priority=0):
+        """Call func after delay seconds, with the priority of the put.
+
+        give_up is called with the error instead if the call is dropped.
+        """
+        if self._joined.wait(delay):
+            give_up(joined_error())
+        else:
+            func()
+
+    def _retry(self, error, limiter, entries, retries, retry_func, give_up,
+               priority):
+        """Retry after a failed call, return False if given up."""
+        error_code = get_error_code(error)
+        if error_code == THROUGHPUT_EXCEEDED and limiter is not None:
+            limiter.throttled(entries)
+        delay = self.retry_policy.retry_delay(error_code, retries,
+                                              self.metrics)
+        if delay is None:
+            return False
+        self._schedule(delay, retry_func, give_up, priority)
+        return True
 
-    def put_record(self, record):
+    def _schedule_retry(self, retries, retry_func, give_up, priority):
+        delay = self.retry_policy.next_delay(retries, self.metrics)
+        if delay is None:
+            return False
+        self._schedule(delay, retry_func, give_up, priority)
+        return True
+
+    def put_record(self, record, callback=None, stream=None, priority=0):
         """Send records to Kinesis API.
 
-        Records is a list of tuple like (data, partition_key).
+        Records is a tuple like (data, partition_key) or
+        (data, partition_key, explicit_hash_key). Once the record is sent
+        or given up, the callback is called with the Kinesis response (with
+        ShardId and SequenceNumber) or the exception. The record is sent to
+        stream, stream_name by default. This client sends the records in
+        the order of the calls, whatever their priority.
+        """
+        self._put_record(make_entry(record), callback, 0,
+                         stream or self.stream, priority)
+
+    def _put_record(self, entry, callback, retries, stream, priority):
+        limiter = self._get_limiter(stream)
+        if not self._wait_for_limiter(limiter, [entry]):
+            self._give_up_record(callback, joined_error())
+            return
+
+        log.debug('Sending record: %s', entry['Data'][:100])
+        try:
+            result = self._call(self.connection.put_record, stream, **entry)
+        except Exception as exc:
+            retry_func = functools.partial(self._put_record, entry, callback,
+                                           retries + 1, stream, priority)
+            give_up = functools.partial(self._give_up_record, callback)
+            if not self._retry(exc, limiter, [entry], retries, retry_func,
+                               give_up, priority):
+                give_up(exc)
+            return
+
+        self._succeeded(limiter, [entry])
+        if callback is not None:
+            callback(result)
+
+    def _succeeded(self, limiter, entries):
+        self.metrics.incr('kinesis_records_sent', len(entries))
+        if limiter is not None:
+            limiter.succeeded(entries)
+
+    def _given_up(self, count, error):
+        log.error('Failed to send %i records to Kinesis: %s', count, error)
+        self.metrics.incr('kinesis_records_failed', count)
+
+    def _give_up_record(self, callback, error):
+        self._given_up(1, error)
+        if callback is not None:
+            callback(error)
+
+    def _give_up_records(self, pending, results, callback, error):
+        """Fail the pending entries with error and call back the results."""
+        self._given_up(len(pending), error)
+        for index in pending:
+            results[index] = error
+        self._put_records_done(results, callback)
+
+    def put_records(self, records, callback=None, stream=None, priority=0):
+        """Send a batch of records to Kinesis API with one PutRecords call.
+
+        Records is a list of tuple like for put_record. Only the records
+        rejected by Kinesis are retried. The callback is called with the
+        list of results of the records, like for put_record.
         """
-        data, partition_key = record
+        entries = [make_entry(record) for record in records]
+
+        log.debug('Sending %i records', len(entries))
+        results = [None] * len(entries)
+        self._put_records(entries, list(range(len(entries))), results,
+                          callback, 0, stream or self.stream, priority)
+
+    def _put_records(self, entries, pending, results, callback, retries,
+                     stream, priority):
+        """Call PutRecords with the pending entries and retry the failed ones.
+
+        Results are stored by entry index.
+        """
+        records = [entries[index] for index in pending]
+        limiter = self._get_limiter(stream)
+        if not self._wait_for_limiter(limiter, records):
+            self._give_up_records(pending, results, callback, joined_error())
+            return
 
-        log.debug('Sending record: %s', data[:100])
         try:
-            call_and_retry(self.connection.put_record, self.max_retries,
-                           StreamName=self.stream, Data=data,
-                           PartitionKey=partition_key)
-        except:
-            log.exception('Failed to send records to Kinesis')
+            response = self._call(self.connection.put_records, stream,
+                                  Records=records)
+        except Exception as exc:
+            retry_func = functools.partial(self._put_records, entries,
+                                           pending, results, callback,
+                                           retries + 1, stream, priority)
+            give_up = functools.partial(self._give_up_records, pending,
+                                        results, callback)
+            if not self._retry(exc, limiter, records, retries, retry_func,
+                               give_up, priority):
+                give_up(exc)
+            return
+
+        failed = self._read_put_records_response(response, entries, pending,
+                                                 results, limiter)
+        self._retry_failed_records(entries, failed, results, callback,
+                                   retries, stream, priority)
+
+    def _read_put_records_response(self, response, entries, pending, results,
+                                   limiter):
+        """Store the results of the pending entries, return the failed ones.
+
+        Count the records sent and feed the limiter.
+        """
+        failed = []
+        throttled = []
+        for index, result in zip(pending, response['Records']):
+            results[index] = result
+            error_code = result.get('ErrorCode')
+            if error_code == THROUGHPUT_EXCEEDED:
+                self.metrics.incr('put_throttles')
+                throttled.append(entries[index])
+            if error_code:
+                failed.append(index)
+
+        if limiter is not None:
+            limiter.throttled(throttled)
+        failed_set = set(failed)
+        self._succeeded(limiter, [entries[index] for index in pending
+                                  if index not in failed_set])
+        return failed
+
+    def _retry_failed_records(self, entries, failed, results, callback,
+                              retries, stream, priority):
+        """Retry the retryable failed entries, give up the other ones."""
+        retryable = [index for index in failed
+                     if self.retry_policy.is_retryable(
+                         results[index]['ErrorCode'])]
+        retry_func = functools.partial(self._put_records, entries,
+                                       retryable, results, callback,
+                                       retries + 1, stream, priority)
+        give_up = functools.partial(self._give_up_records, retryable,
+                                    results, callback)
+        if not (retryable and
+                self._schedule_retry(retries, retry_func, give_up, priority)):
+            retryable = []
+
+        given_up = len(failed) - len(retryable)
+        if given_up:
+            log.error('Failed to send %i records to Kinesis', given_up)
+            self.metrics.incr('kinesis_records_failed', given_up)
+        if not retryable:
+            self._put_records_done(results, callback)
+
+    def _put_records_done(self, results, callback):
+        if callback is not None:
+            callback([make_put_records_error(result)
+                      if isinstance(result, dict) and 'ErrorCode' in result
+                      else result
+                      for result in results])
 
     def close(self):
         log.debug('Closing client')
 
-    def join(self):
+    def join(self, timeout=None):
+        """Wait for the puts, return False if some are still in flight."""
         log.debug('Joining client')
+        self._joined.set()
+        return True
 
 
 class ThreadPoolClient(Client):
-    """Thread pool based asynchronous Kinesis client."""
+    """Thread pool based asynchronous Kinesis client.
+
+    Retries wait in a RetryScheduler thread, so that the pool threads keep
+    sending the other records meanwhile. join waits for the puts, retries
+    included: when its timeout expires, the pending retries are given up
+    with DeliveryTimeoutError and the pool threads are left to finish their
+    call. Puts and retries submitted after join are given up likewise.
+
+    Puts waiting for a pool thread are started by decreasing priority (the
+    priority of put_record and put_records, kept by their retries), in FIFO
+    order within a priority.
+    """
 
-    def __init__(self, config):
-        super(ThreadPoolClient, self).__init__(config)
-        self.pool = ThreadPool(processes=config['kinesis_concurrency'])
+    def __init__(self, config, metrics=None):
+        super(ThreadPoolClient, self).__init__(config, metrics)
+        self.concurrency = config['kinesis_concurrency']
+        self.pool = ThreadPool(processes=self.concurrency)
+        self.scheduler = RetryScheduler()
+        self.scheduler.start()
+        self._in_flight = 0
+        self._idle = threading.Condition()
+        self._tasks = []  # Heap of (-priority, task id, func, args)
+        self._task_ids = itertools.count()
+        self._tasks_lock = threading.Lock()
 
-    def put_record(self, records):
+    def _track(self, callback):
+        """Count a put in flight until its callback is called."""
+        with self._idle:
+            self._in_flight += 1
+        return functools.partial(self._on_done, callback)
+
+    def _on_done(self, callback, result):
+        try:
+            if callback is not None:
+                callback(result)
+        finally:
+            with self._idle:
+                self._in_flight -= 1
+                self._idle.notify_all()
+
+    def _submit(self, func, args=(), priority=0):
+        """Queue a task for the pool, return False once joined."""
+        with self._tasks_lock:
+            if self._joined.is_set():
+                return False
+            heapq.heappush(self._tasks,
+                           (-priority, next(self._task_ids), func, args))
+            self.pool.apply_async(self._run_task)
+        return True
+
+    def _run_task(self):
+        """Run the task of highest priority, one per _submit."""
+        with self._tasks_lock:
+            _, _, func, args = heapq.heappop(self._tasks)
+        func(*args)
+
+    def _schedule(self, delay, func, give_up, priority=0):
+        if not self.scheduler.schedule(delay, self._submit_retry, func,
+                                       give_up, priority):
+            give_up(joined_error())
+
+    def _submit_retry(self, func, give_up, priority):
+        if not self._submit(func, priority=priority):
+            give_up(joined_error())
+
+    def warm(self):
+        """Open a connection per thread of the pool, concurrently."""
+        results = [self.pool.apply_async(self._warm_connection)
+                   for _ in range(self.concurrency)]
+        for result in results:
+            result.wait()
+
+    def put_record(self, records, callback=None, stream=None, priority=0):
         task_func = super(ThreadPoolClient, self).put_record
-        self.pool.apply_async(task_func, args=[records])
+        callback = self._track(callback)
+        if not self._submit(task_func, (records, callback, stream, priority),
+                            priority):
+            self._give_up_record(callback, joined_error())
 
-    def close(self):
-        super(ThreadPoolClient, self).close()
-        self.pool.close()
+    def put_records(self, records, callback=None, stream=None, priority=0):
+        task_func = super(ThreadPoolClient, self).put_records
+        callback = self._track(callback)
+        if not self._submit(task_func, (records, callback, stream, priority),
+                            priority):
+            pending = list(range(len(records)))
+            self._give_up_records(pending, [None] * len(records), callback,
+                                  joined_error())
 
-    def join(self):
+    def join(self, timeout=None):
+        deadline = None if timeout is None else monotonic() + timeout
+        with self._idle:
+            while self._in_flight:
+                remaining = time_left(deadline)
+                if remaining == 0:
+                    break
+                self._idle.wait(remaining)
+            idle = not self._in_flight
         super(ThreadPoolClient, self).join()
-        self.pool.join()
+        for _, (_, give_up, _) in self.scheduler.close():
+            give_up(DeliveryTimeoutError(
+                'Kinesis put retry dropped after %ss' % timeout))
+        with self._tasks_lock:  # No task submitted after close
+            self.pool.close()
+        if idle:
+            self.pool.join()
+        else:
+            log.warning('Kinesis puts still in flight after %ss', timeout)
+        return idle
@@ -0,0 +1,14 @@
+import time
+
+try:
+    monotonic = time.monotonic
+except AttributeError:  # Python 2
+    monotonic = time.time
+
+
+def time_left(deadline):
+    """Return the seconds left before a monotonic deadline (None: no limit).
+    """
+    if deadline is None:
+        return None
+    return max(0, deadline - monotonic())
@@ -0,0 +1,247 @@
+import io
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+from .constants import KINESIS_RECORD_MAX_SIZE
+
+# Upper bound of the compressed size of n bytes: n * FACTOR + OVERHEAD.
+# It covers zlib, gzip, zstd and lz4 frames, headers included.
+BOUND_FACTOR = 1.01
+BOUND_OVERHEAD = 64
+
+
+def max_input_size(max_output_size):
+    """Return how many bytes always compress to max_output_size or less."""
+    return int((max_output_size - BOUND_OVERHEAD) / BOUND_FACTOR)
+
+
+class PlainWriter(object):
+    """Write the bytes of an aggregated record as is."""
+
+    def __init__(self):
+        self._buffer = io.BytesIO()
+        self.size = 0
+
+    def fits(self, size):
+        return self.size + size <= KINESIS_RECORD_MAX_SIZE
+
+    def write(self, data):
+        self._buffer.write(data)
+        self.size += len(data)
+
+    def close(self):
+        return self._buffer.getvalue()
+
+
+class CompressingWriter(object):
+    """Compress the bytes of an aggregated record as they are written.
+
+    The size is estimated from the compression ratio of the previous
+    records of the codec. fits is exact: when the upper bound of the
+    compressed size is over the Kinesis limit, the compressor is flushed
+    to know the actual size.
+    """
+
+    def __init__(self, codec):
+        self._codec = codec
+        self._compressor = codec.compressor()
+        self._buffer = io.BytesIO()
+        self._written = 0
+        self._pending = 0
+        self._raw_size = 0
+        self._output(self._compressor.begin())
+
+    @property
+    def size(self):
+        estimated = int(self._raw_size * self._codec.ratio)
+        return max(self._written, estimated)
+
+    def _output(self, data):
+        self._buffer.write(data)
+        self._written += len(data)
+
+    def _bound(self, size):
+        return (self._written + BOUND_OVERHEAD +
+                (self._pending + size) * BOUND_FACTOR)
+
+    def fits(self, size):
+        if self._bound(size) <= KINESIS_RECORD_MAX_SIZE:
+            return True
+        if self._pending:
+            self._output(self._compressor.sync_flush())
+            self._pending = 0
+        return self._bound(size) <= KINESIS_RECORD_MAX_SIZE
+
+    def write(self, data):
+        self._output(self._compressor.compress(data))
+        self._pending += len(data)
+        self._raw_size += len(data)
+
+    def close(self):
+        self._output(self._compressor.finish())
+        self._codec.update_ratio(self._raw_size, self._written)
+        return self._buffer.getvalue()
+
+
+class Codec(object):
+    """Compression codec of the aggregated records.
+
+    The ratio is a moving average of the compressed size divided by the
+    raw size, used to estimate the size of the records being compressed.
+    """
+
+    name = None
+
+    def __init__(self, level=None):
+        self.level = level
+        self.ratio = 1.0
+
+    def compressor(self):
+        raise NotImplementedError()
+
+    def decompress(self, data):
+        raise NotImplementedError()
+
+    def writer(self):
+        return CompressingWriter(self)
+
+    def header_size(self):
+        """Return the size of the frame header written before the data."""
+        return len(self.compressor().begin())
+
+    def update_ratio(self, raw_size, compressed_size):
+        if raw_size:
+            ratio = float(compressed_size) / raw_size
+            self.ratio = 0.8 * self.ratio + 0.2 * ratio
+
+
+class _ZlibCompressor(object):
+
+    def __init__(self, level, wbits):
+        self._compressobj = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def begin(self):
+        return b''
+
+    def compress(self, data):
+        return self._compressobj.compress(data)
+
+    def sync_flush(self):
+        return self._compressobj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressobj.flush()
+
+
+class ZlibCodec(Codec):
+
+    name = 'zlib'
+    wbits = 15
+
+    def compressor(self):
+        level = self.level
+        if level is None:
+            level = zlib.Z_DEFAULT_COMPRESSION
+        return _ZlibCompressor(level, self.wbits)
+
+    def decompress(self, data):
+        return zlib.decompress(data, self.wbits)
+
+
+class GzipCodec(ZlibCodec):
+
+    name = 'gzip'
+    wbits = 31
+
+
+class _ZstdCompressor(object):
+
+    def __init__(self, level):
+        compressor = zstandard.ZstdCompressor(level=level)
+        self._compressobj = compressor.compressobj()
+
+    def begin(self):
+        return b''
+
+    def compress(self, data):
+        return self._compressobj.compress(data)
+
+    def sync_flush(self):
+        return self._compressobj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self._compressobj.flush()
+
+
+class ZstdCodec(Codec):
+
+    name = 'zstd'
+
+    def compressor(self):
+        return _ZstdCompressor(3 if self.level is None else self.level)
+
+    def decompress(self, data):
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
+class _Lz4Compressor(object):
+    """Auto flushed lz4 frame: nothing is pending between calls."""
+
+    def __init__(self, level):
+        self._compressor = lz4_frame.LZ4FrameCompressor(
+            compression_level=level, auto_flush=True)
+
+    def begin(self):
+        return self._compressor.begin()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def sync_flush(self):
+        return b''
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class Lz4Codec(Codec):
+
+    name = 'lz4'
+
+    def compressor(self):
+        return _Lz4Compressor(0 if self.level is None else self.level)
+
+    def decompress(self, data):
+        return lz4_frame.decompress(data)
+
+
+CODECS = {
+    'zlib': ZlibCodec,
+    'gzip': GzipCodec,
+}
+if zstandard is not None:
+    CODECS['zstd'] = ZstdCodec
+if lz4_frame is not None:
+    CODECS['lz4'] = Lz4Codec
+
+
+def get_codec(config):
+    """Return the codec selected by the compression option, if any."""
+    compression = config.get('compression')
+    if compression is None:
+        return None
+    try:
+        codec_class = CODECS[compression]
+    except KeyError:
+        raise ValueError('Unknown or not installed compression: %s' %
+                         compression)
+    return codec_class(level=config.get('compression_level'))
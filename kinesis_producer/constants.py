@@ -1,4 +1,13 @@
 
-MB = 1024 * 1024
+KB = 1024
+MB = 1024 * KB
 
 KINESIS_RECORD_MAX_SIZE = 1 * MB
+
+KINESIS_PARTITION_KEY_MAX_SIZE = 256
+
+KINESIS_BATCH_MAX_COUNT = 500
+KINESIS_BATCH_MAX_SIZE = 5 * MB
+
+KINESIS_SHARD_MAX_BYTES_PER_SECOND = 1 * MB
+KINESIS_SHARD_MAX_RECORDS_PER_SECOND = 1000
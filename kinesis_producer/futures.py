@@ -0,0 +1,162 @@
+import collections
+import logging
+import os
+import threading
+
+from .clock import monotonic
+
+log = logging.getLogger(__name__)
+
+RecordMetadata = collections.namedtuple('RecordMetadata',
+                                        ['shard_id', 'sequence_number'])
+
+
+class DeliveryTimeoutError(Exception):
+    """The record was not delivered before the timeout."""
+
+
+class RecordFuture(object):
+    """Outcome of the delivery of a record sent to KinesisProducer.
+
+    The result is the RecordMetadata of the aggregated record carrying the
+    record. All the futures of an aggregated record are resolved at once
+    by resolve_futures.
+    """
+
+    __slots__ = ('_done', '_result', '_exception', '_callbacks')
+
+    # Shared by all the futures: waiters are woken up once per aggregate
+    _condition = threading.Condition()
+
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = None
+
+    def done(self):
+        return self._done
+
+    def _wait(self, timeout):
+        with self._condition:
+            if timeout is not None:
+                deadline = monotonic() + timeout
+            while not self._done:
+                if timeout is None:
+                    self._condition.wait()
+                    continue
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    raise DeliveryTimeoutError()
+                self._condition.wait(remaining)
+
+    def result(self, timeout=None):
+        """Return the RecordMetadata or raise the delivery error.
+
+        Raise DeliveryTimeoutError if the record is not delivered in time.
+        """
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """Return the delivery error, None if the record was delivered."""
+        self._wait(timeout)
+        return self._exception
+
+    def add_done_callback(self, func):
+        """Call func with the future once it is resolved.
+
+        Callbacks are called by the thread resolving the future, or right
+        away if the future is already resolved.
+        """
+        with self._condition:
+            if not self._done:
+                if self._callbacks is None:
+                    self._callbacks = []
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def _run_callbacks(self):
+        """Call the callbacks of a resolved future."""
+        for func in self._callbacks:
+            try:
+                func(self)
+            except Exception:
+                log.exception('Uncaught error in record future callback')
+
+
+def _reset_condition():
+    # The condition may be held by a thread of the parent at fork time
+    RecordFuture._condition = threading.Condition()
+
+
+if hasattr(os, 'register_at_fork'):  # Python 3.7+
+    os.register_at_fork(after_in_child=_reset_condition)
+
+
+class PendingCounter(object):
+    """Number of records accepted by the producer and not resolved yet."""
+
+    def __init__(self):
+        self.count = 0
+        self._condition = threading.Condition()
+
+    def add(self, count=1):
+        with self._condition:
+            self.count += count
+
+    def done(self, count=1):
+        with self._condition:
+            self.count -= count
+            if not self.count:
+                self._condition.notify_all()
+
+    def wait(self, timeout=None):
+        """Wait until no record is pending, at most timeout seconds.
+
+        Return the number of records still pending.
+        """
+        with self._condition:
+            if timeout is not None:
+                deadline = monotonic() + timeout
+            while self.count:
+                if timeout is None:
+                    self._condition.wait()
+                    continue
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return self.count
+
+
+def resolve_futures(futures, response):
+    """Resolve the futures of the records of an aggregated record.
+
+    The response is the Kinesis result of the aggregated record, with
+    ShardId and SequenceNumber, or the exception that made it fail.
+    Futures already resolved are left as is. Return the number of futures
+    resolved.
+    """
+    if isinstance(response, Exception):
+        result, exception = None, response
+    else:
+        result = RecordMetadata(response['ShardId'],
+                                response['SequenceNumber'])
+        exception = None
+
+    with RecordFuture._condition:
+        futures = [future for future in futures if not future._done]
+        for future in futures:
+            future._result = result
+            future._exception = exception
+            future._done = True
+        RecordFuture._condition.notify_all()
+
+    for future in futures:
+        if future._callbacks:
+            future._run_callbacks()
+    return len(futures)
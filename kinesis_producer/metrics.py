@@ -0,0 +1,161 @@
+import bisect
+import collections
+import logging
+import socket
+import threading
+
+from .clock import monotonic
+
+log = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+RATIO_BUCKETS = (.1, .2, .3, .4, .5, .6, .7, .8, .9, 1)
+
+
+class Histogram(object):
+    """Count observed values in buckets, like a Prometheus histogram."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def snapshot(self):
+        """Return the cumulative counts like [(upper_bound, count), ...]."""
+        cumulative = 0
+        buckets = []
+        for upper_bound, count in zip(self.buckets + (float('inf'),),
+                                      self.counts):
+            cumulative += count
+            buckets.append((upper_bound, cumulative))
+        return {'buckets': buckets, 'count': cumulative, 'sum': self.sum}
+
+
+class Metrics(object):
+    """Thread safe counters, gauges and histograms of a producer.
+
+    Gauges are functions called when taking a snapshot. The exporters
+    are called with the snapshot every interval seconds, by export_if_due.
+    """
+
+    def __init__(self, exporters=(), interval=10):
+        self.exporters = list(exporters)
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._counters = collections.defaultdict(int)
+        self._histograms = {}
+        self._gauges = {}
+        self._exported_at = monotonic()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram(buckets)
+            histogram.observe(value)
+
+    def register_gauge(self, name, func):
+        self._gauges[name] = func
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = dict((name, histogram.snapshot())
+                              for name, histogram
+                              in self._histograms.items())
+        gauges = dict((name, func()) for name, func in self._gauges.items())
+        return {'counters': counters, 'gauges': gauges,
+                'histograms': histograms}
+
+    def export_if_due(self):
+        """Call the exporters if the interval elapsed since the last call."""
+        now = monotonic()
+        with self._lock:
+            if now - self._exported_at < self.interval:
+                return
+            self._exported_at = now
+        self.export()
+
+    def next_export(self):
+        """Return when the next export is due, None without exporters."""
+        if not self.exporters:
+            return None
+        return self._exported_at + self.interval
+
+    def export(self):
+        if not self.exporters:
+            return
+        stats = self.snapshot()
+        for exporter in self.exporters:
+            try:
+                exporter(stats)
+            except Exception:
+                log.exception('Failed to export metrics with %s', exporter)
+
+
+def format_prometheus(stats, prefix='kinesis_producer'):
+    """Format a stats snapshot with the Prometheus text format."""
+    lines = []
+    for name, value in sorted(stats['counters'].items()):
+        lines.append('# TYPE %s_%s_total counter' % (prefix, name))
+        lines.append('%s_%s_total %s' % (prefix, name, value))
+    for name, value in sorted(stats['gauges'].items()):
+        lines.append('# TYPE %s_%s gauge' % (prefix, name))
+        lines.append('%s_%s %s' % (prefix, name, value))
+    for name, histogram in sorted(stats['histograms'].items()):
+        metric = '%s_%s' % (prefix, name)
+        lines.append('# TYPE %s histogram' % metric)
+        for upper_bound, count in histogram['buckets']:
+            le = '+Inf' if upper_bound == float('inf') else upper_bound
+            lines.append('%s_bucket{le="%s"} %s' % (metric, le, count))
+        lines.append('%s_sum %s' % (metric, histogram['sum']))
+        lines.append('%s_count %s' % (metric, histogram['count']))
+    return '\n'.join(lines) + '\n'
+
+
+class StatsdExporter(object):
+    """Send stats to a StatsD server with the line protocol over UDP.
+
+    Counters are sent as increments since the previous export, gauges as
+    is and histograms as the count and mean of the new observations.
+    """
+
+    def __init__(self, host='localhost', port=8125,
+                 prefix='kinesis_producer'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._previous = {}
+
+    def _delta(self, name, value):
+        delta = value - self._previous.get(name, 0)
+        self._previous[name] = value
+        return delta
+
+    def format(self, stats):
+        lines = []
+        for name, value in sorted(stats['counters'].items()):
+            lines.append('%s.%s:%s|c' % (self.prefix, name,
+                                         self._delta(name, value)))
+        for name, value in sorted(stats['gauges'].items()):
+            lines.append('%s.%s:%s|g' % (self.prefix, name, value))
+        for name, histogram in sorted(stats['histograms'].items()):
+            count = self._delta(name + '.count', histogram['count'])
+            total = self._delta(name + '.sum', histogram['sum'])
+            lines.append('%s.%s.count:%s|c' % (self.prefix, name, count))
+            if count:
+                lines.append('%s.%s.mean:%s|g' % (self.prefix, name,
+                                                  float(total) / count))
+        return lines
+
+    def __call__(self, stats):
+        payload = '\n'.join(self.format(stats)).encode('utf-8')
+        self._socket.sendto(payload, self.address)
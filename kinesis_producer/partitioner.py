@@ -1,7 +1,125 @@
+import itertools
+import logging
 import random
+import threading
+
+from .clock import monotonic
+
+log = logging.getLogger(__name__)
 
 
 def random_partitioner(stream_record):
     """Generate a random partition_key."""
     random_key = str(random.randint(0, 10**12))
     return random_key
+
+
+def list_open_shards(connection, stream):
+    """Return the hash key range of each open shard by shard id.
+
+    A range is a tuple like (starting_hash_key, ending_hash_key) of ints.
+    """
+    shards = {}
+    kwargs = {'StreamName': stream}
+    while True:
+        response = connection.list_shards(**kwargs)
+        for shard in response['Shards']:
+            if 'EndingSequenceNumber' in shard['SequenceNumberRange']:
+                continue  # Closed by a resharding
+            hash_key_range = shard['HashKeyRange']
+            shards[shard['ShardId']] = (
+                int(hash_key_range['StartingHashKey']),
+                int(hash_key_range['EndingHashKey']))
+
+        if not response.get('NextToken'):
+            return shards
+        kwargs = {'NextToken': response['NextToken']}
+
+
+class ShardPartitioner(object):
+    """Spread records over the open shards of a stream.
+
+    The shard hash key ranges are read with ListShards and cached for
+    shard_refresh_interval seconds, by the thread of the first record due,
+    without holding the lock: the other records keep the previous shards
+    meanwhile (random partition keys until the shards are known). Each
+    record gets the ExplicitHashKey
+    of a shard chosen round robin or of the least loaded shard, which
+    counts the bytes sent to each shard since the last refresh.
+
+    Return a tuple like (partition_key, explicit_hash_key). Thread safe, to
+    be shared by the sender pipelines.
+    """
+
+    STRATEGIES = ('round_robin', 'least_loaded')
+
+    def __init__(self, connection, config, strategy='round_robin'):
+        assert strategy in self.STRATEGIES, 'Unknown strategy!'
+        self.connection = connection
+        self.stream = config['stream_name']
+        self.refresh_interval = config.get('shard_refresh_interval', 60)
+        self.strategy = strategy
+        self._shards = {}
+        self._shard_load = {}
+        self._round_robin = None
+        self._refreshed_at = None
+        self._lock = threading.Lock()
+
+    def __call__(self, stream_record):
+        self._refresh_if_stale()
+        with self._lock:
+            return self._partition(stream_record)
+
+    def _partition(self, stream_record):
+        if not self._shards:
+            return random_partitioner(stream_record)
+
+        if self.strategy == 'round_robin':
+            shard_id = next(self._round_robin)
+        else:
+            shard_id = min(self._shard_load, key=self._shard_load.get)
+        self._shard_load[shard_id] += len(stream_record)
+
+        return random_partitioner(stream_record), self._shards[shard_id]
+
+    def _refresh_if_stale(self):
+        with self._lock:
+            stale = (self._refreshed_at is None or
+                     monotonic() - self._refreshed_at >= self.refresh_interval)
+            if stale:
+                self._refreshed_at = monotonic()  # Refreshed by this thread
+        if stale:
+            self._load_shards()
+
+    def refresh(self):
+        """Reload the hash key ranges of the open shards."""
+        with self._lock:
+            self._refreshed_at = monotonic()
+        self._load_shards()
+
+    def _load_shards(self):
+        try:
+            ranges = list_open_shards(self.connection, self.stream)
+        except Exception:
+            log.exception('Failed to list shards, using random partition keys')
+            ranges = {}
+        shards = dict((shard_id, str((start + end) // 2))
+                      for shard_id, (start, end) in ranges.items())
+
+        with self._lock:
+            if self._shards and set(shards) != set(self._shards):
+                log.info('Resharding detected (%i shards)', len(shards))
+
+            self._shards = shards
+            self._shard_load = dict.fromkeys(shards, 0)
+            self._round_robin = itertools.cycle(sorted(shards))
+
+
+def get_partitioner(connection, config):
+    """Return the partitioner selected by the partitioner option."""
+    strategy = config.get('partitioner', 'random')
+    if strategy == 'random':
+        return random_partitioner
+    if strategy in ShardPartitioner.STRATEGIES:
+        return ShardPartitioner(connection, config, strategy=strategy)
+    raise ValueError('Unknown partitioner: %s' % strategy)
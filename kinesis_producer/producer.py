@@ -1,65 +1,539 @@
+import collections
+import itertools
 import logging
+import os
+import threading
+import weakref
 
 import six
 from six.moves import queue
 
-from .sender import Sender
+from .sender import LaneQueue, Sender, lane_key
 from .accumulator import RecordAccumulator
-from .buffer import RawBuffer
-from .client import Client, ThreadPoolClient
-from .partitioner import random_partitioner
-from .constants import KINESIS_RECORD_MAX_SIZE
+from .buffer import get_buffer_class
+from .budget import MemoryBudget
+from .clock import monotonic, time_left
+from .futures import PendingCounter, RecordFuture
+from .metrics import Metrics
+from .client import Client, ThreadPoolClient, get_stream_configs
+from .compression import get_codec
+from .partitioner import get_partitioner
+from .serializer import get_serializer
+from .spool import SpoolReplayer, get_spool
+from .constants import KINESIS_PARTITION_KEY_MAX_SIZE
 
 log = logging.getLogger(__name__)
 
+# Aggregation settings of a priority lane of a stream
+StreamOptions = collections.namedtuple(
+    'StreamOptions',
+    ['stream', 'priority', 'config', 'buffer_class', 'max_record_size',
+     'partitioner', 'codec'])
+
+
+def get_lane_configs(config):
+    """Return the config of each priority lane of a stream, highest first.
+
+    The priority_lanes option maps priorities (integers) to the options
+    their lane overrides, like {1: {'buffer_time_limit': 0}}. The lane 0
+    is the one of the records sent without priority.
+    """
+    lanes = dict(config.get('priority_lanes') or {})
+    lanes.setdefault(0, {})
+    for priority in lanes:
+        if not isinstance(priority, six.integer_types):
+            raise ValueError('Priority must be an integer: %r' % priority)
+    configs = collections.OrderedDict()
+    for priority in sorted(lanes, reverse=True):
+        lane_config = dict(config)
+        lane_config.update(lanes[priority] or {})
+        configs[priority] = lane_config
+    return configs
+
+
+def check_record(record, partition_key, max_record_size):
+    """Raise ValueError if a record can't be sent to Kinesis."""
+    if not isinstance(record, six.binary_type):
+        raise ValueError("Record must be bytes type")
+
+    if len(record) > max_record_size:
+        raise ValueError("Record is larger than max record size")
+
+    check_partition_key(partition_key)
+
+
+def check_records(records, partition_key, max_record_size):
+    """Like check_record for a list of records. Return their total size."""
+    if not all(isinstance(record, six.binary_type) for record in records):
+        raise ValueError("Record must be bytes type")
+
+    sizes = [len(record) for record in records]
+    if max(sizes) > max_record_size:
+        raise ValueError("Record is larger than max record size")
+
+    check_partition_key(partition_key)
+    return sum(sizes)
+
+
+def check_partition_key(partition_key):
+    """Raise ValueError if a partition key can't be sent to Kinesis."""
+    if partition_key is not None:
+        if not isinstance(partition_key, six.string_types):
+            raise ValueError("Partition key must be a string")
+        if not 0 < len(partition_key) <= KINESIS_PARTITION_KEY_MAX_SIZE:
+            raise ValueError("Partition key must have 1 to 256 chars")
+
+
+# Producers not closed yet, reset in a forked child
+_producers = weakref.WeakSet()
+
+
+def _reset_after_fork():
+    for producer in list(_producers):
+        producer._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):  # Python 3.7+
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
 
 class KinesisProducer(object):
-    """A Kinesis client that publishes records to a Kinesis stream."""
+    """A Kinesis client that publishes records to Kinesis streams.
+
+    Records go to stream_name, or to one of the streams option. All the
+    streams share the sender threads and the client.
+
+    Fork safe: a producer inherited by a child process (pre-fork servers,
+    multiprocessing) gets its own threads and client on its first send.
+    """
 
     def __init__(self, config):
         log.debug('Starting KinesisProducer')
         self.config = config
-        self._queue = queue.Queue()
         self._closed = False
+        self._setup()
+        _producers.add(self)
+        if not config.get('lazy_start'):
+            self._start()
 
-        accumulator = RecordAccumulator(RawBuffer, config)
+    def _setup(self):
+        """Create the state shared by the pipelines, started by _start."""
+        config = self.config
+        self._pid = os.getpid()
+        self._budget = MemoryBudget(
+            max_bytes=config.get('max_buffered_bytes'),
+            policy=config.get('buffer_full_policy', 'block'),
+            timeout=config.get('buffer_full_timeout'))
+        self._metrics = Metrics(
+            exporters=config.get('metrics_exporters', ()),
+            interval=config.get('metrics_interval', 10))
+        self._pending = PendingCounter()
+        self._metrics.register_gauge('buffered_bytes',
+                                     lambda: self._budget.used)
+        self._metrics.register_gauge('records_dropped',
+                                     lambda: self._budget.dropped)
+        self._metrics.register_gauge('records_pending',
+                                     lambda: self._pending.count)
+
+        self._serializer = get_serializer(config)
+
+        # Options by lane_key of stream name and priority, None standing
+        # for stream_name. The partitioners need the client: set by _start.
+        self._streams = {}
+        priorities = set()
+        for stream, stream_config in get_stream_configs(config).items():
+            if stream == config['stream_name']:
+                stream = None
+            for priority, lane_config in get_lane_configs(
+                    stream_config).items():
+                buffer_class = get_buffer_class(lane_config)
+                self._streams[lane_key(stream, priority)] = StreamOptions(
+                    stream, priority, lane_config, buffer_class,
+                    buffer_class.max_record_size(lane_config), None,
+                    get_codec(lane_config))
+                priorities.add(priority)
+        self._min_priority = None
+        if len(priorities) > 1:
+            self._min_priority = min(priorities)
+
+        if (config.get('spool_directory') is None and
+                self._budget.policy == 'spool'):
+            raise ValueError('The spool buffer_full_policy needs a'
+                             ' spool_directory')
+
+        self._started = False
+        self._start_lock = threading.Lock()
+        self._client = None
+        self._spool = None
+        self._replayer = None
+        self._queues = []
+        self._senders = []
+
+    def _start(self):
+        """Create the client and start the I/O threads, once.
+
+        Called by __init__, or on the first send with lazy_start or after
+        a fork.
+        """
+        if self._pid != os.getpid():
+            self._after_fork()
+        if self._started:
+            return
+        with self._start_lock:
+            if self._started:
+                return
+            log.debug('Starting KinesisProducer I/O threads')
+            self._create_pipelines()
+            self._started = True
+
+    def _after_fork(self):
+        """Reset the producer inherited by a child process.
+
+        The threads of the parent don't exist in the child and its locks,
+        queues and connections are copies: the child starts over, without
+        the records of the parent (delivered by the parent), on the next
+        send. Its spool is a subdirectory of the parent one, created on
+        start and adopted by the parent spool once the child exited. A
+        closed producer is left as is.
+        """
+        if self._closed or self._pid == os.getpid():
+            return
+        log.debug('KinesisProducer inherited by process %i', os.getpid())
+        directory = self.config.get('spool_directory')
+        if directory is not None:
+            self.config = dict(self.config, spool_directory=os.path.join(
+                directory, 'pid-%i' % os.getpid()))
+        self._setup()
+
+    def _create_pipelines(self):
+        self._create_client()
+        self._spool = get_spool(self.config)
+        if self._spool is not None:
+            self._create_replayer()
+
+        # Each pipeline is a queue and a sender thread with its accumulators
+        accumulators = []
+        for _ in range(self.config.get('sender_count', 1)):
+            sender = self._create_sender(accumulators)
+            self._queues.append(sender.queue)
+            self._senders.append(sender)
+        self._next_queue = itertools.cycle(self._queues)
+
+        self._metrics.register_gauge(
+            'queue_size', lambda: sum(q.qsize() for q in self._queues))
+        self._metrics.register_gauge(
+            'accumulated_bytes', lambda: sum(acc.size for acc in accumulators))
+        self._metrics.register_gauge(
+            'oldest_record_age',
+            lambda: max(acc.oldest_record_age() for acc in accumulators))
+
+        for sender in self._senders:
+            sender.start()
+        if self._replayer is not None:
+            self._replayer.start()
+
+    def _create_client(self):
+        """Create the client shared by the senders and the partitioners."""
+        config = self.config
         if config['kinesis_concurrency'] == 1:
-            client = Client(config)
+            self._client = Client(config, self._metrics)
+        else:
+            self._client = ThreadPoolClient(config, self._metrics)
+        if config.get('kinesis_warm_connections'):
+            self._client.warm()
+
+        # The lanes of a stream share the partitioner of its lane 0
+        partitioners = dict(
+            (key, get_partitioner(self._client.connection, options.config))
+            for key, options in self._streams.items()
+            if not options.priority)
+        for key, options in list(self._streams.items()):
+            self._streams[key] = options._replace(
+                partitioner=partitioners[options.stream])
+
+    def _create_replayer(self):
+        self._replayer = SpoolReplayer(
+            self._spool, Client(self.config, self._metrics),
+            interval=self.config.get('spool_replay_interval', 5),
+            metrics=self._metrics)
+        self._metrics.register_gauge('spooled_bytes',
+                                     lambda: self._spool.size)
+
+    def _create_sender(self, accumulators):
+        """Create the sender of a pipeline, with an accumulator per lane.
+
+        The accumulators are appended to accumulators.
+        """
+        if self._min_priority is None:
+            q = queue.Queue()
         else:
-            client = ThreadPoolClient(config)
-        self._sender = Sender(queue=self._queue,
-                              accumulator=accumulator,
-                              client=client,
-                              partitioner=random_partitioner)
-        self._sender.daemon = True
-        self._sender.start()
-
-    def send(self, record):
+            q = LaneQueue(self._min_priority)
+        options = self._streams[None]
+        accumulator = RecordAccumulator(options.buffer_class, self.config,
+                                        self._metrics)
+        sender = Sender(queue=q,
+                        accumulator=accumulator,
+                        client=self._client,
+                        partitioner=options.partitioner,
+                        batch_size=self.config.get('kinesis_batch_size', 1),
+                        budget=self._budget,
+                        metrics=self._metrics,
+                        close_client=False,
+                        spool=self._spool,
+                        serializer=self._serializer,
+                        pending=self._pending)
+        sender.daemon = True
+        accumulators.append(accumulator)
+        for key, options in self._streams.items():
+            if key is None:
+                continue
+            accumulator = RecordAccumulator(
+                options.buffer_class, options.config, self._metrics)
+            sender.add_stream(
+                options.stream, accumulator, options.partitioner,
+                batch_size=options.config.get('kinesis_batch_size', 1),
+                priority=options.priority)
+            accumulators.append(accumulator)
+        return sender
+
+    def _get_queue(self, partition_key):
+        """Return the queue of the pipeline aggregating a partition key.
+
+        Records of a partition key always go to the same pipeline, records
+        without partition key are spread round robin.
+        """
+        if len(self._queues) == 1:
+            return self._queues[0]
+        if partition_key is None:
+            return next(self._next_queue)
+        return self._queues[hash(partition_key) % len(self._queues)]
+
+    def _get_stream(self, stream, priority=0):
+        """Return the key of a stream lane in the senders and its options."""
+        if stream == self.config['stream_name']:
+            stream = None
+        key = lane_key(stream, priority)
+        try:
+            return key, self._streams[key]
+        except KeyError:
+            if lane_key(stream) in self._streams:
+                raise ValueError('Unknown priority: %s' % priority)
+            raise ValueError('Unknown stream: %s' % stream)
+
+    def send(self, record, partition_key=None, stream=None, priority=0):
         """Publish a record to Kinesis.
 
-        Don't block. Record must be bytes type.
+        Record must be bytes type. Records with the same partition_key are
+        aggregated together and keep their order. Without partition_key, the
+        partitioner picks one for each aggregated record.
+
+        With the serializer option, record is any object the serializer
+        can encode: objects are serialized by the I/O threads, and their
+        future fails if they can't be serialized or are too large once
+        serialized.
+
+        The record goes to stream, one of the streams option, or to
+        stream_name by default. With priority, one of the priority_lanes
+        option, the record is aggregated in the lane of this priority,
+        sent before the records of the lower priorities.
+
+        Don't block, unless max_buffered_bytes is reached: then the
+        buffer_full_policy applies.
+
+        Return a RecordFuture resolved once the record is delivered, or
+        None if the record is dropped or spooled.
         """
         assert not self._closed, "KinesisProducer closed but called anyway"
 
-        if not isinstance(record, six.binary_type):
-            raise ValueError("Record must be bytes type")
+        self._start()
+        key, options = self._get_stream(stream, priority)
+        if self._serializer is None:
+            check_record(record, partition_key, options.max_record_size)
+            size = len(record)
+        else:
+            check_partition_key(partition_key)
+            size = self._serializer.SIZE_ESTIMATE
+
+        if not self._budget.acquire(size):
+            if self._budget.policy == 'spool':
+                self._spool_records([record], partition_key, options)
+            return None
+
+        future = RecordFuture()
+        if self._serializer is None:
+            item = (record, partition_key, future, key)
+        else:
+            item = ([record], partition_key, [future], key)  # A chunk
+        self._pending.add()
+        self._get_queue(partition_key).put(item)
+        self._metrics.incr('records_sent')
+        return future
+
+    def send_many(self, records, partition_key=None, chunk_size=1000,
+                  stream=None, priority=0):
+        """Publish an iterable of records to Kinesis, like send.
+
+        Records are checked, reserved from max_buffered_bytes and queued
+        by chunks of chunk_size records, and appended to the aggregated
+        records a chunk at a time. When a record is invalid, ValueError is
+        raised and none of its chunk is sent (previous chunks are).
 
-        record_size = len(record) + len(self.config['record_delimiter'])
-        if record_size > KINESIS_RECORD_MAX_SIZE:
-            raise ValueError("Record is larger than max record size")
+        Return the list of RecordFuture, with None for dropped or spooled
+        records.
+        """
+        assert not self._closed, "KinesisProducer closed but called anyway"
+
+        self._start()
+        key, options = self._get_stream(stream, priority)
+        futures = []
+        records = iter(records)
+        while True:
+            chunk = list(itertools.islice(records, chunk_size))
+            if not chunk:
+                return futures
+            futures.extend(self._send_chunk(chunk, partition_key, key,
+                                            options))
+
+    def _send_chunk(self, records, partition_key, key, options):
+        if self._serializer is None:
+            size = check_records(records, partition_key,
+                                 options.max_record_size)
+        else:
+            check_partition_key(partition_key)
+            size = self._serializer.SIZE_ESTIMATE * len(records)
 
-        self._queue.put(record)
+        if not self._budget.acquire(size, count=len(records)):
+            if self._budget.policy == 'spool':
+                self._spool_records(records, partition_key, options)
+            return [None] * len(records)
+
+        futures = [RecordFuture() for _ in records]
+        self._pending.add(len(records))
+        self._get_queue(partition_key).put((records, partition_key, futures,
+                                            key))
+        self._metrics.incr('records_sent', len(records))
+        return futures
+
+    def _spool_records(self, records, partition_key, options):
+        """Aggregate records refused by max_buffered_bytes to the spool."""
+        if self._serializer is not None:
+            serialized = self._serializer.serialize(records,
+                                                    options.max_record_size)
+            records = [record for record in serialized
+                       if not isinstance(record, Exception)]
+            self._metrics.incr('records_rejected',
+                               len(serialized) - len(records))
+            if not records:
+                return
+        buf = None
+        for record in records:
+            if buf is not None and not buf.try_append(record):
+                self._spool_buffer(buf, partition_key, options)
+                buf = None
+            if buf is None:
+                buf = options.buffer_class(config=options.config,
+                                           partition_key=partition_key,
+                                           codec=options.codec)
+                buf.try_append(record)
+        self._spool_buffer(buf, partition_key, options)
+        self._metrics.incr('records_spooled', len(records))
+
+    def _spool_buffer(self, buf, partition_key, options):
+        data = buf.flush()
+        if partition_key is None:
+            partition_key = options.partitioner(data)
+        if isinstance(partition_key, tuple):
+            record = (data,) + partition_key
+        else:
+            record = (data, partition_key)
+        if self._spool.append(record, options.stream):
+            self._metrics.incr('kinesis_records_spooled')
+
+    def stats(self):
+        """Return a snapshot of the producer metrics.
+
+        A dict with the counters, gauges and histograms by name.
+        """
+        return self._metrics.snapshot()
+
+    @property
+    def buffered_bytes(self):
+        """Bytes queued, accumulated or being sent to Kinesis."""
+        return self._budget.used
+
+    @property
+    def dropped_records(self):
+        """Number of records dropped by the drop buffer_full_policy."""
+        return self._budget.dropped
+
+    @property
+    def pending_records(self):
+        """Number of records sent and not delivered (or given up) yet."""
+        return self._pending.count
+
+    def flush(self, timeout=None):
+        """Send the queued and aggregated records right away and wait.
+
+        Wait at most timeout seconds for the records to be delivered (or
+        given up), the records sent meanwhile included. The producer stays
+        open. Return the number of records still pending.
+        """
+        assert not self._closed, "KinesisProducer closed but called anyway"
+        log.debug('Flushing KinesisProducer')
+        self._start()
+        for sender in self._senders:
+            sender.request_flush()
+        return self._pending.wait(timeout)
+
+    def warmup(self):
+        """Start the producer and open a connection to Kinesis.
+
+        With lazy_start, call it off the critical path (after the
+        initialization of the application, in a warmup hook) so that the
+        first send doesn't pay for the boto3 import, the client creation
+        and the TLS handshake.
+        """
+        assert not self._closed, "KinesisProducer closed but called anyway"
+        self._start()
+        self._client.warm()
 
     def close(self):
         if self._closed:
             return
+        self._after_fork()
         log.debug('Closing KinesisProducer')
-        self._sender.close()
+        for sender in self._senders:
+            sender.close()
         self._closed = True
+        _producers.discard(self)
+
+    def join(self, timeout=None):
+        """Close the producer and wait for the records to be delivered.
 
-    def join(self):
+        Closing skips the linger of the aggregated records. With timeout,
+        return within timeout seconds, giving up the pending retries and rate
+        limit waits and the records not sent yet, with both clients (their
+        futures fail with DeliveryTimeoutError).
+        Return the number of records still pending (not delivered nor
+        given up), 0 when all the records were handled.
+        """
         self.close()
         log.debug('Joining KinesisProducer')
-        self._queue.join()
-        log.debug('KinesisProducer record queue was joined')
-        self._sender.join()
+        deadline = None if timeout is None else monotonic() + timeout
+        for sender in self._senders:
+            sender.join(time_left(deadline))
+        log.debug('KinesisProducer I/O threads were joined')
+        if self._client is not None:
+            self._client.close()
+            self._client.join(time_left(deadline))
+        if self._replayer is not None:
+            self._replayer.close()
+            self._replayer.join(time_left(deadline))
+            self._spool.close()
+        self._metrics.export()
+
+        pending = self._pending.count
+        if pending:
+            log.warning('KinesisProducer joined with %i records pending',
+                        pending)
+        return pending
@@ -0,0 +1,213 @@
+import bisect
+import hashlib
+import logging
+import threading
+
+import six
+
+from .clock import monotonic
+from .constants import (KINESIS_SHARD_MAX_BYTES_PER_SECOND,
+                        KINESIS_SHARD_MAX_RECORDS_PER_SECOND)
+from .partitioner import list_open_shards
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """Tokens refilled at rate per second, up to one second of tokens.
+
+    reserve takes the tokens even when they are not available yet and
+    returns how long to wait for them, so that callers are paced in turn.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._tokens = float(rate)
+        self._updated_at = monotonic()
+
+    def reserve(self, amount, now):
+        elapsed = now - self._updated_at
+        self._tokens = min(self.rate, self._tokens + elapsed * self.rate)
+        self._updated_at = now
+        self._tokens -= amount
+        if self._tokens >= 0:
+            return 0
+        return -self._tokens / self.rate
+
+
+class Limit(object):
+    """Bytes and records per second limits of a shard or a stream.
+
+    The rates are scaled by a factor lowered on each throttling error and
+    slowly raised back on each successful put (AIMD), to settle just under
+    the actual throughput limit.
+    """
+
+    DECREASE_FACTOR = 0.8
+    INCREASE_STEP = 0.01
+    MIN_FACTOR = 0.1
+
+    def __init__(self, max_bytes=None, max_records=None):
+        self.max_bytes = max_bytes
+        self.max_records = max_records
+        self.factor = 1.0
+        self._bytes = TokenBucket(max_bytes) if max_bytes else None
+        self._records = TokenBucket(max_records) if max_records else None
+
+    def reserve(self, size, count, now):
+        """Take size bytes and count records, return the delay to wait."""
+        delay = 0
+        if self._bytes is not None:
+            delay = self._bytes.reserve(size, now)
+        if self._records is not None:
+            delay = max(delay, self._records.reserve(count, now))
+        return delay
+
+    def _set_factor(self, factor):
+        self.factor = min(1.0, max(self.MIN_FACTOR, factor))
+        if self._bytes is not None:
+            self._bytes.rate = self.max_bytes * self.factor
+        if self._records is not None:
+            self._records.rate = self.max_records * self.factor
+
+    def throttled(self):
+        self._set_factor(self.factor * self.DECREASE_FACTOR)
+
+    def succeeded(self):
+        if self.factor < 1.0:
+            self._set_factor(self.factor + self.INCREASE_STEP)
+
+
+def entry_hash_key(entry):
+    """Return the hash key Kinesis uses to map an entry to a shard."""
+    if 'ExplicitHashKey' in entry:
+        return int(entry['ExplicitHashKey'])
+    partition_key = entry['PartitionKey']
+    if isinstance(partition_key, six.text_type):
+        partition_key = partition_key.encode('utf-8')
+    return int(hashlib.md5(partition_key).hexdigest(), 16)
+
+
+class RateLimiter(object):
+    """Pace puts to stay under the throughput limits of a stream.
+
+    Entries are Kinesis API entries (with Data, PartitionKey and optional
+    ExplicitHashKey). reserve returns how long to wait before sending the
+    entries, throttled and succeeded adjust the rates from the responses.
+
+    This one applies a single limit to the whole stream. Thread safe.
+    """
+
+    def __init__(self, max_bytes=None, max_records=None):
+        self._limit = Limit(max_bytes, max_records)
+        self._lock = threading.Lock()
+
+    def _limits(self, entries):
+        """Return the limits applying to entries, with their entries."""
+        if not entries:
+            return []
+        return [(self._limit, entries)]
+
+    def _refresh_if_stale(self):
+        """Update the limits before using them, outside of the lock."""
+
+    def reserve(self, entries):
+        self._refresh_if_stale()
+        with self._lock:
+            limits = self._limits(entries)
+            now = monotonic()
+            delay = 0
+            for limit, limit_entries in limits:
+                size = sum(len(entry['Data']) + len(entry['PartitionKey'])
+                           for entry in limit_entries)
+                delay = max(delay, limit.reserve(size, len(limit_entries),
+                                                 now))
+            return delay
+
+    def throttled(self, entries):
+        self._refresh_if_stale()
+        with self._lock:
+            for limit, _ in self._limits(entries):
+                limit.throttled()
+
+    def succeeded(self, entries):
+        self._refresh_if_stale()
+        with self._lock:
+            for limit, _ in self._limits(entries):
+                limit.succeeded()
+
+
+class ShardRateLimiter(RateLimiter):
+    """Apply the limits of a shard (1 MB and 1000 records per second) to
+    the entries of each shard.
+
+    The shard hash key ranges are read with ListShards every
+    shard_refresh_interval seconds, by the thread of the first put due,
+    without holding the lock: the other puts keep the previous shards
+    meanwhile. Entries are not paced while the shards are unknown.
+    """
+
+    def __init__(self, connection, config):
+        super(ShardRateLimiter, self).__init__()
+        self.connection = connection
+        self.stream = config['stream_name']
+        self.refresh_interval = config.get('shard_refresh_interval', 60)
+        self._starts = []
+        self._shard_limits = []
+        self._refreshed_at = None
+
+    def _refresh_if_stale(self):
+        with self._lock:
+            stale = (self._refreshed_at is None or
+                     monotonic() - self._refreshed_at >= self.refresh_interval)
+            if stale:
+                self._refreshed_at = monotonic()  # Refreshed by this thread
+        if stale:
+            self._load_shards()
+
+    def refresh(self):
+        """Reload the hash key ranges of the open shards."""
+        with self._lock:
+            self._refreshed_at = monotonic()
+        self._load_shards()
+
+    def _load_shards(self):
+        try:
+            ranges = list_open_shards(self.connection, self.stream)
+        except Exception:
+            log.exception('Failed to list shards, puts are not paced')
+            ranges = {}
+
+        starts = sorted(start for start, _ in ranges.values())
+        with self._lock:
+            previous = dict(zip(self._starts, self._shard_limits))
+            self._starts = starts
+            self._shard_limits = [
+                previous.get(start) or
+                Limit(KINESIS_SHARD_MAX_BYTES_PER_SECOND,
+                      KINESIS_SHARD_MAX_RECORDS_PER_SECOND)
+                for start in starts]
+
+    def _limits(self, entries):
+        if not self._starts:
+            return []
+
+        by_shard = {}
+        for entry in entries:
+            index = bisect.bisect_right(self._starts, entry_hash_key(entry))
+            by_shard.setdefault(max(index - 1, 0), []).append(entry)
+        return [(self._shard_limits[index], shard_entries)
+                for index, shard_entries in by_shard.items()]
+
+
+def get_rate_limiter(connection, config):
+    """Return the rate limiter selected by the rate_limit option, if any."""
+    rate_limit = config.get('rate_limit')
+    if rate_limit is None:
+        return None
+    if rate_limit == 'shard':
+        return ShardRateLimiter(connection, config)
+    if rate_limit == 'stream':
+        return RateLimiter(max_bytes=config.get('rate_limit_bytes'),
+                           max_records=config.get('rate_limit_records'))
+    raise ValueError('Unknown rate limit: %s' % rate_limit)
@@ -0,0 +1,177 @@
+import heapq
+import itertools
+import logging
+import random
+import threading
+
+from .clock import monotonic
+
+log = logging.getLogger(__name__)
+
+THROUGHPUT_EXCEEDED = 'ProvisionedThroughputExceededException'
+
+# Pseudo error code of the connection errors (timeouts, resets...)
+CONNECTION_ERROR = 'ConnectionError'
+
+DEFAULT_RETRYABLE_ERRORS = (
+    THROUGHPUT_EXCEEDED,
+    'KMSThrottlingException',
+    'InternalFailure',
+    'ServiceUnavailable',
+    CONNECTION_ERROR,
+)
+
+
+def get_error_code(error):
+    """Return the error code of an exception or a PutRecords result."""
+    if isinstance(error, dict):
+        return error.get('ErrorCode')
+
+    from botocore import exceptions  # Imported when first needed
+
+    if isinstance(error, exceptions.ClientError):
+        return error.response.get('Error', {}).get('Code')
+    if isinstance(error, (exceptions.ConnectionError,
+                          exceptions.HTTPClientError)):
+        return CONNECTION_ERROR
+    return None
+
+
+class RetryPolicy(object):
+    """When and after how long a failed Kinesis call is retried.
+
+    Errors are retryable when their code is in retryable_errors. A call is
+    retried up to max_retries times, after a full jitter exponential
+    backoff: a random delay between 0 and base * 2 ** retries (at most
+    cap). With a budget, at most budget retries start each second and the
+    other errors are given up, so that retries can't overload a stream.
+    """
+
+    def __init__(self, max_retries, retryable_errors=DEFAULT_RETRYABLE_ERRORS,
+                 budget=None, base=.1, cap=30):
+        self.max_retries = max_retries
+        self.retryable_errors = frozenset(retryable_errors)
+        self.budget = budget
+        self.base = base
+        self.cap = cap
+        self._window_started_at = monotonic()
+        self._window_retries = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['kinesis_max_retries'],
+                   config.get('retryable_errors', DEFAULT_RETRYABLE_ERRORS),
+                   config.get('retry_budget'))
+
+    def is_retryable(self, error_code):
+        return error_code in self.retryable_errors
+
+    def can_retry(self, retries):
+        """Whether a call can be retried, taking a retry from the budget."""
+        if retries >= self.max_retries:
+            return False
+        if self.budget is None:
+            return True
+
+        with self._lock:
+            now = monotonic()
+            if now - self._window_started_at >= 1:
+                self._window_started_at = now
+                self._window_retries = 0
+            if self._window_retries >= self.budget:
+                log.warning('Retry budget exhausted, giving up')
+                return False
+            self._window_retries += 1
+            return True
+
+    def backoff(self, retries):
+        """Return the delay before the retry following retries retries."""
+        return random.uniform(0, min(self.cap, self.base * 2 ** retries))
+
+    def retry_delay(self, error_code, retries, metrics=None):
+        """Return the delay before retrying a call failed with error_code.
+
+        Return None if the call is given up. With metrics, count the
+        throttling errors and the retries.
+        """
+        if error_code == THROUGHPUT_EXCEEDED and metrics is not None:
+            metrics.incr('put_throttles')
+        if not self.is_retryable(error_code):
+            return None
+        return self.next_delay(retries, metrics)
+
+    def next_delay(self, retries, metrics=None):
+        """Like retry_delay, for a call failed with a retryable error."""
+        if not self.can_retry(retries):
+            return None
+        delay = self.backoff(retries)
+        log.warning('Retrying (%i) in %.2fs', retries + 1, delay)
+        if metrics is not None:
+            metrics.incr('put_retries')
+        return delay
+
+
+class RetryScheduler(threading.Thread):
+    """Timer thread calling functions once their delay elapsed.
+
+    Retries wait here, in due order, instead of holding a client thread.
+    Functions must be quick: they usually hand the retry over to a pool.
+    """
+
+    def __init__(self):
+        super(RetryScheduler, self).__init__()
+        self.daemon = True
+        self._heap = []
+        self._counter = itertools.count()  # Keep the order of equal times
+        self._cond = threading.Condition()
+        self._running = True
+
+    def schedule(self, delay, func, *args):
+        """Call func with args after delay, return False once closed."""
+        with self._cond:
+            if not self._running:
+                return False
+            heapq.heappush(self._heap, (monotonic() + delay,
+                                        next(self._counter), func, args))
+            self._cond.notify()
+        return True
+
+    def run(self):
+        while True:
+            due = self._wait_for_due()
+            if due is None:
+                return
+            func, args = due
+            try:
+                func(*args)
+            except Exception:
+                log.exception('Uncaught error in kinesis producer retry')
+
+    def _wait_for_due(self):
+        """Wait for the next function due, return it with its arguments.
+
+        Return None once closed.
+        """
+        with self._cond:
+            while self._running:
+                timeout = None
+                if self._heap:
+                    timeout = self._heap[0][0] - monotonic()
+                    if timeout <= 0:
+                        _, _, func, args = heapq.heappop(self._heap)
+                        return func, args
+                self._cond.wait(timeout)
+        return None
+
+    def close(self):
+        """Stop the thread, dropping the functions not called yet.
+
+        Return the list of (func, args) dropped, in due order.
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+            dropped = [heapq.heappop(self._heap)[2:]
+                       for _ in range(len(self._heap))]
+        return dropped
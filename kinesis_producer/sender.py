@@ -1,81 +1,456 @@
+import collections
+import functools
+import heapq
+import itertools
 import logging
 import threading
 
 from six.moves import queue
 
+from .clock import monotonic, time_left
+from .constants import KINESIS_BATCH_MAX_COUNT, KINESIS_BATCH_MAX_SIZE
+from .futures import resolve_futures
+from .metrics import Metrics
+from .retry import THROUGHPUT_EXCEEDED, get_error_code
+
 log = logging.getLogger(__name__)
 
+# Queued by request_flush
+FLUSH = object()
+
+
+def lane_key(stream, priority=0):
+    """Return the key of the records of a stream and priority in a sender.
+
+    Queued items carry it in place of the stream name.
+    """
+    return (stream, priority) if priority else stream
+
+
+class LaneQueue(queue.Queue):
+    """Queue of a sender with priority lanes.
+
+    Records of the higher priorities are dequeued first, in FIFO order
+    within a priority. FLUSH and the close wake-up take min_priority, so
+    that they come after the records queued before them.
+    """
+
+    def __init__(self, min_priority=0, maxsize=0):
+        self.min_priority = min_priority
+        queue.Queue.__init__(self, maxsize)  # Old style class on Python 2
+
+    def _init(self, maxsize):
+        self.queue = []
+        self._counter = itertools.count()
+
+    def _qsize(self, len=len):
+        return len(self.queue)
+
+    def _put(self, item):
+        priority = self.min_priority
+        if item is not None and item is not FLUSH:
+            key = item[3]
+            priority = key[1] if isinstance(key, tuple) else 0
+        heapq.heappush(self.queue, (-priority, next(self._counter), item))
+
+    def _get(self):
+        return heapq.heappop(self.queue)[2]
+
+
+class StreamState(object):
+    """Accumulator, partitioner and pending batch of a stream in a sender.
+
+    The name is None for the stream_name of the client. adaptive is the
+    AdaptiveLimits of the accumulator, if any, which learns from the puts.
+    A stream has a state per priority lane: the puts of its lanes carry
+    their priority to the client.
+    """
+
+    def __init__(self, name, accumulator, partitioner, batch_size=1,
+                 priority=0):
+        self.name = name
+        self.priority = priority
+        self.call_options = {'stream': name}
+        if priority:
+            self.call_options['priority'] = priority
+        self.accumulator = accumulator
+        self.adaptive = accumulator.adaptive
+        self.partitioner = partitioner
+        self.batch_size = min(batch_size, KINESIS_BATCH_MAX_COUNT)
+        self.batch = []
+        self.batch_futures = []
+        self.batch_bytes = 0
+
 
 class Sender(threading.Thread):
-    """I/O thread accumulating records and flushing to client."""
+    """I/O thread accumulating records and flushing to client.
+
+    Queued items are tuples like (record, partition_key, future, stream).
+    Records of the None stream go to the accumulator, the records of the
+    streams added with add_stream to their own accumulator: one thread
+    serves all the streams. Records of a priority lane are queued with
+    the lane_key of their stream and priority, to a LaneQueue.
+
+    With a serializer, records are queued by lists of objects (even one),
+    serialized by chunks in this thread: the futures of the objects that
+    can't be serialized or are too large once serialized fail with the
+    error.
+
+    With pending, a PendingCounter, the sender counts the records resolved.
 
-    def __init__(self, queue, accumulator, client, partitioner):
+    With close_client, the sender closes and joins the client once all the
+    records are sent. Otherwise, the client is shared with other senders
+    and closed by its owner. With a spool, the aggregated records the
+    client fails to deliver are appended to it.
+    """
+
+    def __init__(self, queue, accumulator, client, partitioner,
+                 batch_size=1, budget=None, metrics=None, close_client=True,
+                 spool=None, serializer=None, pending=None):
         super(Sender, self).__init__()
         self.queue = queue
-        self._accumulator = accumulator
+        self._streams = collections.OrderedDict()
+        self.add_stream(None, accumulator, partitioner, batch_size)
         self._client = client
-        self._partitioner = partitioner
+        self._budget = budget
+        self._metrics = metrics or Metrics()
+        self._accumulated = 0
+        self._close_client = close_client
+        self._spool = spool
+        self._serializer = serializer
+        self._pending = pending
         self._running = True
         self._closed = threading.Event()
 
+    def add_stream(self, name, accumulator, partitioner, batch_size=1,
+                   priority=0):
+        """Accumulate the records of another stream or lane, before starting.
+
+        Lanes are flushed and sent by decreasing priority.
+        """
+        self._streams[lane_key(name, priority)] = StreamState(
+            name, accumulator, partitioner, batch_size, priority)
+        ordered = sorted(self._streams.items(),
+                         key=lambda item: -item[1].priority)
+        self._streams = collections.OrderedDict(ordered)
+
+    def has_records(self):
+        return any(stream.accumulator.has_records()
+                   for stream in self._streams.values())
+
     def run(self):
         while self._running:
-            try:
-                self.run_once()
-            except Exception:
-                log.exception("Uncaught error in kinesis producer I/O thread")
+            self._run_once_logged()
 
         log.debug("Beginning shutdown of kinesis producer I/O thread, sending"
                   " remaining records.")
 
-        while not self.queue.empty() or self._accumulator.has_records():
-            try:
-                self.run_once()
-            except Exception:
-                log.exception("Uncaught error in kinesis producer I/O thread")
+        while not self.queue.empty() or self.has_records():
+            self._run_once_logged()
 
-        log.debug("Accumulator is now empty, kinesis producer I/O thread can"
-                  " close.")
+        self.send_batch()
 
-        self._client.close()
+        log.debug("Accumulators are now empty, kinesis producer I/O thread"
+                  " can close.")
+
+        if self._close_client:
+            self._client.close()
 
         self._closed.set()
         log.debug("Kinesis producer I/O thread is now closed")
 
-    def run_once(self):
-        """Accumulate records and flush when accumulator is ready."""
+    def _run_once_logged(self):
+        try:
+            self.run_once()
+        except Exception:
+            log.exception("Uncaught error in kinesis producer I/O thread")
+
+    def run_once(self, timeout=None):
+        """Accumulate records and flush when accumulator is ready.
+
+        Wait for a record until the next flush or metrics export is due, or
+        at most timeout seconds. Without deadline nor timeout, wait until a
+        record is queued or the sender is closed.
+        """
+        record_size = 0
         try:
-            record = self.queue.get(timeout=0.05)
+            item = self.queue.get(timeout=self._wait_timeout(timeout))
         except queue.Empty:
-            record = None
+            item = None
         else:
-            success = self._accumulator.try_append(record)
-            if not success:
-                self.flush()
-                success = self._accumulator.try_append(record)
-                assert success, "Failed to accumulate even after flushing"
-
+            record_size = self._accumulate_item(item)
             self.queue.task_done()
 
-        is_ready = self._accumulator.is_ready()
-        force_flush = not self._running and record is None
+        self._flush_after(item)
+        if self.queue.empty() or item is FLUSH:
+            self.send_batch()
+
+        self._update_budget(record_size)
+        self._metrics.export_if_due()
+
+    def _accumulate_item(self, item):
+        """Accumulate a queued record or chunk, return its size.
+
+        The futures of an item that fails to be accumulated fail with the
+        error.
+        """
+        if item is FLUSH or item is None:  # None wakes up a closed sender
+            return 0
+        try:
+            return self._accumulate_record(*item)
+        except Exception as exc:
+            log.exception('Failed to accumulate records')
+            return self._fail_item(item, exc)
+
+    def _accumulate_record(self, record, partition_key, future, name):
+        stream = self._streams[name]
+        if isinstance(record, list):
+            return self._accumulate_many(stream, record, partition_key,
+                                         future)
+        return self._accumulate(stream, record, partition_key, future)
 
-        if is_ready or force_flush:
+    def _fail_item(self, item, error):
+        """Fail the futures of a queued item, return its size."""
+        records, _, futures, _ = item
+        if not isinstance(records, list):
+            records, futures = [records], [futures]
+        self._fail([future for future in futures or () if future is not None],
+                   error)
+        if self._serializer is not None:
+            return self._serializer.SIZE_ESTIMATE * len(records)
+        return sum(len(record) for record in records)
+
+    def _flush_after(self, item):
+        """Flush the ready buffers, or all of them on request or closing."""
+        if item is FLUSH or (item is None and not self._running):
             self.flush()
+            return
+        for stream in self._streams.values():
+            if stream.accumulator.is_ready():
+                self._send(stream, stream.accumulator.flush_ready())
+
+    def _wait_timeout(self, timeout):
+        """Return how long run_once can wait for a record."""
+        if not self._running:
+            return 0
+
+        deadlines = [stream.accumulator.next_deadline()
+                     for stream in self._streams.values()]
+        deadlines.append(self._metrics.next_export())
+        deadlines = [deadline for deadline in deadlines
+                     if deadline is not None]
+        if deadlines:
+            wait = max(0, min(deadlines) - monotonic())
+            if timeout is None or wait < timeout:
+                timeout = wait
+        return timeout
+
+    def _accumulate(self, stream, record, partition_key, future):
+        accumulator = stream.accumulator
+        success = accumulator.try_append(record, partition_key, future)
+        if not success:
+            self._flush_stream(stream)
+            success = accumulator.try_append(record, partition_key, future)
+            assert success, "Failed to accumulate even after flushing"
+        return len(record)
+
+    def _accumulate_many(self, stream, records, partition_key, futures):
+        """Accumulate a chunk of records queued by send_many."""
+        if self._serializer is None:
+            size = sum(len(record) for record in records)
+        else:
+            size = self._serializer.SIZE_ESTIMATE * len(records)
+            records, futures = self._serialize(stream, records, futures)
+
+        accumulator = stream.accumulator
+        appended = accumulator.try_append_many(records, partition_key,
+                                               futures)
+        if appended < len(records):
+            self._flush_stream(stream)
+            remaining = records[appended:]
+            appended = accumulator.try_append_many(
+                remaining, partition_key, futures[appended:])
+            assert appended == len(remaining), \
+                "Failed to accumulate even after flushing"
+        return size
+
+    def _serialize(self, stream, objs, futures):
+        """Serialize objects, return the list of records and their futures.
+
+        Objects that can't be sent are left out and their future fails.
+        """
+        if futures is None:
+            futures = [None] * len(objs)
+        records = self._serializer.serialize(
+            objs, stream.accumulator.max_record_size)
+
+        valid_records = []
+        valid_futures = []
+        for record, future in zip(records, futures):
+            if isinstance(record, Exception):
+                self._reject(future, record)
+            else:
+                valid_records.append(record)
+                valid_futures.append(future)
+        return valid_records, valid_futures
+
+    def _reject(self, future, error):
+        log.error('Failed to serialize record: %s', error)
+        self._metrics.incr('records_rejected')
+        if future is not None:
+            self._fail([future], error)
+
+    def _fail(self, futures, error):
+        """Fail the futures not resolved yet."""
+        resolved = resolve_futures(futures, error)
+        if self._pending is not None:
+            self._pending.done(resolved)
 
     def flush(self):
-        """Get the record by flushing the accumulator and send it to client."""
-        record_data = self._accumulator.flush()
-        if record_data:
+        """Flush all the accumulator buffers and send them to client."""
+        for stream in self._streams.values():
+            self._send(stream, stream.accumulator.flush())
+        self._update_budget()
+
+    def _flush_stream(self, stream):
+        self._send(stream, stream.accumulator.flush())
+        self._update_budget()
+
+    def _update_budget(self, dequeued=0):
+        """Count the bytes moved from the queue to the accumulators."""
+        if self._budget is None:
+            return
+        accumulated = sum(stream.accumulator.size
+                          for stream in self._streams.values())
+        delta = accumulated - self._accumulated - dequeued
+        self._accumulated = accumulated
+        if delta > 0:
+            self._budget.add(delta)
+        elif delta < 0:
+            self._budget.release(-delta)
+
+    def _send(self, stream, buffers):
+        for partition_key, record_data, futures in buffers:
             log.debug('Flushing to client (length: %i)', len(record_data))
-            record = (record_data, self._partitioner(record_data))
-            self._client.put_record(record)
+            if partition_key is None:
+                partition_key = stream.partitioner(record_data)
+            if isinstance(partition_key, tuple):
+                record = (record_data,) + partition_key
+            else:
+                record = (record_data, partition_key)
+            if stream.batch_size > 1:
+                self._append_to_batch(stream, record, futures)
+            else:
+                callback = self._in_flight(stream, record, futures)
+                self._client.put_record(record, callback=callback,
+                                        **stream.call_options)
+
+    def _in_flight(self, stream, record, futures):
+        """Count bytes sent to client, return the callback for the result."""
+        if self._budget is not None:
+            self._budget.add(len(record[0]))
+        elif (not futures and self._spool is None and
+              stream.adaptive is None):
+            return None
+        return functools.partial(self._on_sent, stream, monotonic(), record,
+                                 futures)
+
+    def _on_sent(self, stream, sent_at, record, futures, result):
+        if self._budget is not None:
+            self._budget.release(len(record[0]))
+        if stream.adaptive is not None:
+            self._adapt(stream, sent_at, [result])
+        self._resolve(stream, [record], [futures], [result])
+
+    def _on_batch_sent(self, stream, sent_at, size, batch, batch_futures,
+                       results):
+        if self._budget is not None:
+            self._budget.release(size)
+        if stream.adaptive is not None:
+            self._adapt(stream, sent_at, results)
+        self._resolve(stream, batch, batch_futures, results)
+
+    def _resolve(self, stream, records, records_futures, results):
+        """Resolve the futures of sent records, spool the failed records."""
+        for record, futures, result in zip(records, records_futures, results):
+            if isinstance(result, Exception):
+                self._spool_record(stream.name, record)
+            if futures:
+                resolved = resolve_futures(futures, result)
+                if self._pending is not None:
+                    self._pending.done(resolved)
+
+    def _adapt(self, stream, sent_at, results):
+        """Feed the put latency and throttling to the adaptive limits."""
+        throttled = any(get_error_code(result) == THROUGHPUT_EXCEEDED
+                        for result in results
+                        if isinstance(result, Exception))
+        stream.adaptive.sent(monotonic() - sent_at, throttled)
+
+    def _spool_record(self, name, record):
+        """Keep an undelivered record in the spool, if any."""
+        if self._spool is not None and self._spool.append(record, name):
+            self._metrics.incr('kinesis_records_spooled')
+
+    def _append_to_batch(self, stream, record, futures):
+        record_size = len(record[0]) + len(record[1])
+        if stream.batch_bytes + record_size > KINESIS_BATCH_MAX_SIZE:
+            self._send_stream_batch(stream)
+
+        stream.batch.append(record)
+        stream.batch_futures.append(futures)
+        stream.batch_bytes += record_size
+
+        if len(stream.batch) >= stream.batch_size:
+            self._send_stream_batch(stream)
+
+    def send_batch(self):
+        """Send the pending records to client, a call per stream."""
+        for stream in self._streams.values():
+            self._send_stream_batch(stream)
+
+    def _send_stream_batch(self, stream):
+        if not stream.batch:
+            return
+        log.debug('Sending batch to client (records: %i, length: %i)',
+                  len(stream.batch), stream.batch_bytes)
+        batch_data_size = sum(len(record[0]) for record in stream.batch)
+
+        callback = None
+        if self._budget is not None:
+            self._budget.add(batch_data_size)
+        if (self._budget is not None or self._spool is not None or
+                stream.adaptive is not None or any(stream.batch_futures)):
+            callback = functools.partial(self._on_batch_sent, stream,
+                                         monotonic(), batch_data_size,
+                                         stream.batch, stream.batch_futures)
+
+        self._client.put_records(stream.batch, callback=callback,
+                                 **stream.call_options)
+        stream.batch = []
+        stream.batch_futures = []
+        stream.batch_bytes = 0
+
+    def request_flush(self):
+        """Send the queued and accumulated records without waiting."""
+        self.queue.put(FLUSH)
 
     def close(self):
         log.debug("Closing kinesis producer I/O thread")
         self._running = False
+        self.queue.put(None)  # Wake up the I/O thread
+
+    def join(self, timeout=None):
+        """Wait at most timeout seconds for the thread to send the records.
 
-    def join(self):
+        Return False if the thread is still running.
+        """
         log.debug("Joining kinesis producer I/O thread")
-        self._closed.wait()
-        self._client.join()
+        deadline = None if timeout is None else monotonic() + timeout
+        if not self._closed.wait(timeout):
+            return False
+        if self._close_client:
+            if not self._client.join(time_left(deadline)):
+                return False
+            self._metrics.export()
+        return True
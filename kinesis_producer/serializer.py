@@ -0,0 +1,132 @@
+import json
+
+import six
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from .constants import KB
+
+
+class Serializer(object):
+    """Encode the objects sent to KinesisProducer to bytes.
+
+    Objects are serialized by the sender threads, off the caller threads.
+    Until then, an object counts for SIZE_ESTIMATE bytes in the memory
+    budget. dumps_many encodes a chunk of send_many at once.
+    """
+
+    name = None
+    SIZE_ESTIMATE = 1 * KB
+
+    def dumps(self, obj):
+        raise NotImplementedError()
+
+    def dumps_many(self, objs):
+        dumps = self.dumps
+        return [dumps(obj) for obj in objs]
+
+    def serialize(self, objs, max_record_size):
+        """Encode objects, never raise.
+
+        Return the list of records, with the exception instead of the
+        record of the objects that can't be encoded, aren't encoded to
+        bytes or are larger than max_record_size.
+        """
+        try:
+            records = self.dumps_many(objs)
+        except Exception:
+            records = [self._dumps(obj) for obj in objs]  # Find the culprits
+        return [self._check(record, max_record_size) for record in records]
+
+    @staticmethod
+    def _check(record, max_record_size):
+        """Return the record, or the error making it unsendable."""
+        if isinstance(record, Exception):
+            return record
+        if not isinstance(record, six.binary_type):
+            return ValueError("Serializer returned %s, not bytes" %
+                              type(record).__name__)
+        if len(record) > max_record_size:
+            return ValueError("Record is larger than max record size")
+        return record
+
+    def _dumps(self, obj):
+        try:
+            return self.dumps(obj)
+        except Exception as exc:
+            return exc
+
+
+class JsonSerializer(Serializer):
+
+    name = 'json'
+
+    def __init__(self):
+        self._encode = json.JSONEncoder(separators=(',', ':')).encode
+
+    def dumps(self, obj):
+        return self._encode(obj).encode('utf-8')
+
+
+class OrjsonSerializer(Serializer):
+
+    name = 'orjson'
+
+    def dumps(self, obj):
+        return orjson.dumps(obj)
+
+
+class MsgpackSerializer(Serializer):
+
+    name = 'msgpack'
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def dumps_many(self, objs):
+        pack = msgpack.Packer(use_bin_type=True).pack  # Reuse its buffer
+        return [pack(obj) for obj in objs]
+
+
+class CallableSerializer(Serializer):
+    """Serializer of a function returning the bytes of an object."""
+
+    name = 'callable'
+
+    def __init__(self, func):
+        self.dumps = func
+
+
+SERIALIZERS = {
+    'json': JsonSerializer,
+}
+if orjson is not None:
+    SERIALIZERS['orjson'] = OrjsonSerializer
+if msgpack is not None:
+    SERIALIZERS['msgpack'] = MsgpackSerializer
+
+
+def get_serializer(config):
+    """Return the serializer of the serializer option, if any.
+
+    The option is the name of a serializer or a function.
+    """
+    serializer = config.get('serializer')
+    if serializer is None:
+        return None
+    if callable(serializer):
+        return CallableSerializer(serializer)
+    try:
+        serializer_class = SERIALIZERS[serializer]
+    except KeyError:
+        raise ValueError('Unknown or not installed serializer: %s' %
+                         serializer)
+    return serializer_class()
@@ -0,0 +1,294 @@
+import errno
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from .constants import MB
+
+log = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = '.log'
+# Subdirectories of the spools of forked processes, by pid
+PID_PREFIX = 'pid-'
+
+# Record header: payload length and CRC32
+HEADER = struct.Struct('>II')
+# Payload header: partition key, explicit hash key and stream lengths
+KEYS_HEADER = struct.Struct('>HHH')
+
+FSYNC_POLICIES = ('always', 'segment', 'never')
+
+
+def encode_record(record, stream=None):
+    """Encode a record tuple like (data, partition_key[, hash_key]).
+
+    The stream is kept with the record, None standing for stream_name.
+    """
+    partition_key = record[1].encode('utf-8')
+    hash_key = record[2].encode('ascii') if len(record) > 2 else b''
+    stream = stream.encode('utf-8') if stream else b''
+    payload = (KEYS_HEADER.pack(len(partition_key), len(hash_key),
+                                len(stream)) +
+               partition_key + hash_key + stream + record[0])
+    return HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + \
+        payload
+
+
+def decode_record(payload):
+    """Return the record tuple and the stream of an encoded record."""
+    key_size, hash_key_size, stream_size = KEYS_HEADER.unpack_from(payload)
+    offset = KEYS_HEADER.size
+    partition_key = payload[offset:offset + key_size].decode('utf-8')
+    offset += key_size
+    hash_key = payload[offset:offset + hash_key_size].decode('ascii')
+    offset += hash_key_size
+    stream = payload[offset:offset + stream_size].decode('utf-8') or None
+    data = payload[offset + stream_size:]
+    if hash_key:
+        return (data, partition_key, hash_key), stream
+    return (data, partition_key), stream
+
+
+def read_segment(path, offset=0):
+    """Yield (next_offset, record, stream) for the records of a segment.
+
+    The file is memory-mapped. Reading stops at the first truncated or
+    corrupted record, like the tail of a segment written during a crash.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= offset:
+            return
+        segment = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            while offset + HEADER.size <= size:
+                length, crc = HEADER.unpack_from(segment, offset)
+                start = offset + HEADER.size
+                payload = segment[start:start + length]
+                if (len(payload) < length or
+                        zlib.crc32(payload) & 0xffffffff != crc):
+                    log.warning('Corrupted spool record in %s at %i',
+                                path, offset)
+                    return
+                offset = start + length
+                record, stream = decode_record(payload)
+                yield offset, record, stream
+        finally:
+            segment.close()
+
+
+def pid_alive(pid):
+    """Return False if no process has this pid."""
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        return exc.errno != errno.ESRCH  # EPERM: alive, another user's
+    return True
+
+
+def find_orphans(directory):
+    """Return the spool subdirectories of the exited processes.
+
+    The subdirectories of an exited process come before it.
+    """
+    orphans = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        pid = name[len(PID_PREFIX):]
+        if (name.startswith(PID_PREFIX) and pid.isdigit() and
+                os.path.isdir(path) and not pid_alive(int(pid))):
+            orphans.extend(find_orphans(path))
+            orphans.append(path)
+    return orphans
+
+
+class Spool(object):
+    """Append-only log of records on disk, in segment files.
+
+    Records are appended to the active segment, which is closed once it
+    reaches segment_size bytes; closed segments are replayed oldest first
+    and removed once sent. Records are refused beyond max_bytes on disk.
+    fsync is called after each record (always), when closing a segment
+    (segment) or never. Segments left by a previous process are replayed,
+    like the ones of the exited processes forked with a producer (spooling
+    to the pid-<pid> subdirectories), moved here by adopt_orphans.
+    Thread safe.
+    """
+
+    def __init__(self, directory, max_bytes=1024 * MB, segment_size=16 * MB,
+                 fsync='segment'):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('Unknown spool fsync policy: %s' % fsync)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._active = None
+        self._active_size = 0
+
+        names = sorted(name for name in os.listdir(directory)
+                       if name.endswith(SEGMENT_SUFFIX))
+        self._segments = [os.path.join(directory, name) for name in names]
+        self.size = sum(os.path.getsize(path) for path in self._segments)
+        self._next_id = 1
+        if names:
+            self._next_id = int(names[-1][:-len(SEGMENT_SUFFIX)]) + 1
+        self.adopt_orphans()
+
+    def adopt_orphans(self):
+        """Move the segments of the exited forked processes to this spool."""
+        for directory in find_orphans(self.directory):
+            names = sorted(name for name in os.listdir(directory)
+                           if name.endswith(SEGMENT_SUFFIX))
+            for name in names:
+                self._adopt(os.path.join(directory, name))
+            try:
+                os.rmdir(directory)
+            except OSError:
+                pass  # Adopted by another process, or not empty yet
+
+    def _adopt(self, path):
+        with self._lock:
+            target = os.path.join(
+                self.directory, '%020i%s' % (self._next_id, SEGMENT_SUFFIX))
+            try:
+                os.rename(path, target)  # Atomic: one process adopts it
+            except OSError:
+                return
+            log.info('Adopted spool segment %s', path)
+            self._next_id += 1
+            self._segments.append(target)
+            self.size += os.path.getsize(target)
+
+    def append(self, record, stream=None):
+        """Append a record tuple, return False if the spool is full."""
+        encoded = encode_record(record, stream)
+        with self._lock:
+            if self.size + len(encoded) > self.max_bytes:
+                log.error('Spool is full, record dropped')
+                return False
+
+            if self._active is None:
+                self._open_segment()
+            self._active.write(encoded)
+            self._active.flush()
+            if self.fsync == 'always':
+                os.fsync(self._active.fileno())
+            self._active_size += len(encoded)
+            self.size += len(encoded)
+
+            if self._active_size >= self.segment_size:
+                self._close_segment()
+            return True
+
+    def _open_segment(self):
+        path = os.path.join(self.directory,
+                            '%020i%s' % (self._next_id, SEGMENT_SUFFIX))
+        self._next_id += 1
+        self._active = open(path, 'ab')
+        self._active_size = 0
+
+    def _close_segment(self):
+        if self.fsync != 'never':
+            os.fsync(self._active.fileno())
+        self._active.close()
+        self._segments.append(self._active.name)
+        self._active = None
+
+    def rotate(self):
+        """Close the active segment, so that its records can be replayed."""
+        with self._lock:
+            if self._active is not None:
+                self._close_segment()
+
+    def oldest_segment(self):
+        """Return the path of the oldest closed segment, None if none."""
+        with self._lock:
+            return self._segments[0] if self._segments else None
+
+    def remove(self, path):
+        """Remove a replayed segment."""
+        with self._lock:
+            self._segments.remove(path)
+            self.size -= os.path.getsize(path)
+            os.remove(path)
+
+    def close(self):
+        self.rotate()
+
+
+class SpoolReplayer(threading.Thread):
+    """Thread sending the spooled records every interval seconds.
+
+    Segments are sent oldest first, one record at a time with a
+    synchronous client. On the first failure, the replay stops until the
+    next interval and resumes from the failed record (segments are
+    replayed from the start after a restart: records may be sent twice).
+    """
+
+    def __init__(self, spool, client, interval=5, metrics=None):
+        super(SpoolReplayer, self).__init__()
+        self.daemon = True
+        self.spool = spool
+        self.client = client
+        self.interval = interval
+        self.metrics = metrics
+        self._offsets = {}
+        self._closed = threading.Event()
+
+    def run(self):
+        while not self._closed.wait(self.interval):
+            try:
+                self.replay()
+            except Exception:
+                log.exception('Uncaught error in kinesis producer replayer')
+
+    def replay(self):
+        """Send the spooled records, return False if a record failed."""
+        self.spool.adopt_orphans()
+        self.spool.rotate()
+        while not self._closed.is_set():
+            path = self.spool.oldest_segment()
+            if path is None:
+                return True
+            if not self._replay_segment(path):
+                return False
+            self._offsets.pop(path, None)
+            self.spool.remove(path)
+        return False
+
+    def _replay_segment(self, path):
+        results = []
+        segment = read_segment(path, self._offsets.get(path, 0))
+        for offset, record, stream in segment:
+            if self._closed.is_set():
+                return False
+            self.client.put_record(record, callback=results.append,
+                                   stream=stream)
+            if isinstance(results.pop(), Exception):
+                log.warning('Failed to replay spooled records, will retry')
+                return False
+            self._offsets[path] = offset
+            if self.metrics is not None:
+                self.metrics.incr('kinesis_records_replayed')
+        return True
+
+    def close(self):
+        self._closed.set()
+
+
+def get_spool(config):
+    """Return the spool of the spool_directory option, if any."""
+    directory = config.get('spool_directory')
+    if directory is None:
+        return None
+    return Spool(directory,
+                 max_bytes=config.get('spool_max_bytes', 1024 * MB),
+                 segment_size=config.get('spool_segment_size', 16 * MB),
+                 fsync=config.get('spool_fsync', 'segment'))
@@ -11,13 +11,28 @@ setup(
     author_email='pbastida@ludia.com',
     url='https://github.com/ludia/kinesis_producer',
     license='MIT',
-    packages=find_packages(exclude=['tests']),
+    packages=find_packages(exclude=['tests', 'benchmarks']),
     zip_safe=False,
     install_requires=[
         'six',
         'boto3',
         ],
     extras_require={
+        'aio': [
+            'aiobotocore',
+            ],
+        'lz4': [
+            'lz4',
+            ],
+        'msgpack': [
+            'msgpack',
+            ],
+        'orjson': [
+            'orjson',
+            ],
+        'zstd': [
+            'zstandard',
+            ],
         'test': [
             'tox',
             'pytest',
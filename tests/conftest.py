@@ -1,3 +1,5 @@
+import sys
+
 import boto3
 
 from moto import mock_kinesis
@@ -6,6 +8,22 @@ import pytest
 
 TEST_STREAM_NAME = 'STREAM_NAME'
 
+if sys.version_info < (3, 5):
+    collect_ignore = ['test_aio.py']
+
+
+def shard(shard_id, start, end, closed=False):
+    """Return a shard of a ListShards response."""
+    sequence_number_range = {'StartingSequenceNumber': '1'}
+    if closed:
+        sequence_number_range['EndingSequenceNumber'] = '2'
+    return {
+        'ShardId': shard_id,
+        'HashKeyRange': {'StartingHashKey': str(start),
+                         'EndingHashKey': str(end)},
+        'SequenceNumberRange': sequence_number_range,
+    }
+
 
 @pytest.fixture(scope="module")
 def config():
@@ -2,6 +2,7 @@ import time
 
 from kinesis_producer.accumulator import RecordAccumulator
 from kinesis_producer.buffer import RawBuffer
+from kinesis_producer.clock import monotonic
 
 
 CONFIG = {
@@ -48,6 +49,14 @@ def test_append_timeout():
     assert not acc.is_ready()
 
 
+def test_append_timeout_from_oldest_record():
+    acc = RecordAccumulator(RawBuffer, CONFIG)
+    for _ in range(4):
+        acc.try_append(b'-')
+        time.sleep(0.04)
+    assert acc.is_ready()
+
+
 def test_append_empty_timeout():
     acc = RecordAccumulator(RawBuffer, CONFIG)
     time.sleep(0.2)
@@ -73,7 +82,163 @@ def test_flush():
     acc.try_append(b'123')
     acc.try_append(b'456')
     acc.try_append(b'789')
-    assert acc.flush() == b'123X456X789X'
+    assert acc.flush() == [(None, b'123X456X789X', [])]
 
     acc.try_append(b'ABC')
-    assert acc.flush() == b'ABCX'
+    assert acc.flush() == [(None, b'ABCX', [])]
+
+
+def test_flush_empty():
+    acc = RecordAccumulator(RawBuffer, CONFIG)
+    assert acc.flush() == []
+
+
+def test_append_partition_keys():
+    acc = RecordAccumulator(RawBuffer, CONFIG)
+    acc.try_append(b'1', 'a')
+    acc.try_append(b'2', 'b')
+    acc.try_append(b'3', 'a')
+    acc.try_append(b'4')
+
+    assert acc.flush() == [
+        ('a', b'1X3X', []), ('b', b'2X', []), (None, b'4X', [])]
+
+
+def test_flush_ready_per_partition_key():
+    acc = RecordAccumulator(RawBuffer, CONFIG)
+    acc.try_append(b'-' * 200, 'a')
+    acc.try_append(b'-', 'b')
+
+    assert acc.is_ready()
+    assert acc.flush_ready() == [('a', b'-' * 200 + b'X', [])]
+    assert not acc.is_ready()
+    assert acc.has_records()
+
+    assert acc.flush() == [('b', b'-X', [])]
+
+
+def test_append_to_full_buffer_keeps_order():
+    acc = RecordAccumulator(RawBuffer, CONFIG)
+    acc.try_append(b'-' * (1024 * 1024 - 1), 'a')
+    acc.try_append(b'1', 'a')
+
+    assert acc.is_ready()
+    buffers = acc.flush()
+    assert [partition_key for partition_key, _, _ in buffers] == ['a', 'a']
+    assert buffers[1][1] == b'1X'
+
+
+def test_buffer_count_limit():
+    config = dict(CONFIG, buffer_count_limit=2)
+    acc = RecordAccumulator(RawBuffer, config)
+    acc.try_append(b'1', 'a')
+    acc.try_append(b'2', 'b')
+    acc.try_append(b'3', 'a')
+    acc.try_append(b'4', 'c')
+
+    # The least recently used buffer is closed
+    assert acc.flush_ready() == [('b', b'2X', [])]
+    assert acc.flush() == [('a', b'1X3X', []), ('c', b'4X', [])]
+
+
+def test_size():
+    acc = RecordAccumulator(RawBuffer, CONFIG)
+    acc.try_append(b'123', 'a')
+    acc.try_append(b'456', 'b')
+    assert acc.size == 8
+
+    acc.try_append(b'-' * 200, 'a')
+    assert acc.size == 209
+
+    acc.flush_ready()
+    assert acc.size == 4
+
+    acc.flush()
+    assert acc.size == 0
+
+
+def test_flush_reasons_metrics():
+    config = dict(CONFIG, buffer_count_limit=2)
+    acc = RecordAccumulator(RawBuffer, config)
+    acc.try_append(b'-' * 200, 'a')
+    acc.try_append(b'-', 'b')
+    acc.flush_ready()
+
+    acc.try_append(b'-', 'c')
+    acc.try_append(b'-', 'd')
+    time.sleep(0.2)
+    acc.flush_ready()
+
+    acc.try_append(b'-', 'e')
+    acc.flush()
+
+    stats = acc.metrics.snapshot()
+    assert stats['counters'] == {
+        'flushes_size': 1,
+        'flushes_evicted': 1,
+        'flushes_time': 2,
+        'flushes_forced': 1,
+    }
+    assert stats['histograms']['aggregate_fill_ratio']['count'] == 5
+    assert stats['histograms']['aggregation_latency']['count'] == 5
+
+
+def test_futures():
+    acc = RecordAccumulator(RawBuffer, CONFIG)
+    acc.try_append(b'1', 'a', future='F1')
+    acc.try_append(b'2', 'b', future='F2')
+    acc.try_append(b'3', 'a', future='F3')
+
+    assert acc.flush() == [('a', b'1X3X', ['F1', 'F3']), ('b', b'2X', ['F2'])]
+
+
+def test_append_many():
+    acc = RecordAccumulator(RawBuffer, CONFIG)
+    appended = acc.try_append_many([b'1', b'2', b'3'], 'a',
+                                   futures=['F1', 'F2', None])
+    assert appended == 3
+    assert not acc.is_ready()
+
+    assert acc.flush() == [('a', b'1X2X3X', ['F1', 'F2'])]
+
+
+def test_append_many_closes_ready_buffers():
+    acc = RecordAccumulator(RawBuffer, CONFIG)
+    appended = acc.try_append_many([b'-' * 60] * 5)
+    assert appended == 5
+
+    flushed = acc.flush_ready()
+    assert [data for _, data, _ in flushed] == [(b'-' * 60 + b'X') * 2] * 2
+    assert acc.flush() == [(None, b'-' * 60 + b'X', [])]
+
+
+def test_append_many_over_kinesis_record_size():
+    acc = RecordAccumulator(RawBuffer, CONFIG)
+    appended = acc.try_append_many([b'-', b'-' * (1024 * 1024), b'-'])
+    assert appended == 1
+
+
+def test_next_deadline():
+    acc = RecordAccumulator(RawBuffer, dict(CONFIG, buffer_count_limit=1))
+    assert acc.next_deadline() is None
+
+    before = monotonic()
+    acc.try_append(b'-')
+    assert before + 0.1 <= acc.next_deadline() <= monotonic() + 0.1
+
+    acc.try_append(b'-', 'a')  # Closes the evicted buffer
+    assert acc.next_deadline() <= monotonic()
+
+
+def test_oldest_record_age():
+    acc = RecordAccumulator(RawBuffer, CONFIG)
+    assert acc.oldest_record_age() == 0
+
+    acc.try_append(b'-', 'a')
+    time.sleep(0.05)
+    acc.try_append(b'-', 'b')
+    acc.try_append(b'-', 'a')
+    assert acc.oldest_record_age() >= 0.05
+
+    acc.flush()
+    assert acc.oldest_record_age() == 0
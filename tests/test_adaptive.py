@@ -0,0 +1,84 @@
+import pytest
+
+from kinesis_producer.accumulator import RecordAccumulator
+from kinesis_producer.adaptive import AdaptiveLimits, get_adaptive_limits
+from kinesis_producer.buffer import RawBuffer
+from kinesis_producer.constants import KINESIS_RECORD_MAX_SIZE
+
+
+def test_time_limit_follows_put_latency():
+    limits = AdaptiveLimits(1, size_limit=100000, time_limit=0.5)
+    assert limits.time_limit == 0.5
+
+    limits.sent(0.5)
+    assert limits.put_latency == pytest.approx(0.1)
+    assert limits.time_limit == pytest.approx(0.9)
+
+    for _ in range(100):
+        limits.sent(2)
+    assert limits.time_limit == pytest.approx(0.1)  # 10% of the target
+
+
+def test_size_limit_increase():
+    limits = AdaptiveLimits(1, size_limit=100000, time_limit=0.5)
+
+    limits.flushed('time', 0.5)
+    assert limits.size_limit == 100000
+
+    limits.flushed('size', 2)  # Over the target
+    assert limits.size_limit == 100000
+
+    limits.flushed('size', 0.1)
+    assert limits.size_limit == 100000 + KINESIS_RECORD_MAX_SIZE // 100
+
+    for _ in range(200):
+        limits.flushed('size', 0.1)
+    assert limits.size_limit == KINESIS_RECORD_MAX_SIZE
+
+
+def test_size_limit_decrease():
+    limits = AdaptiveLimits(1, size_limit=100000, time_limit=0.5)
+
+    limits.sent(0.5)
+    assert limits.size_limit == 100000
+
+    limits.sent(2)
+    assert limits.size_limit == 80000
+
+    for _ in range(100):
+        limits.sent(2)
+    assert limits.size_limit == AdaptiveLimits.MIN_SIZE_LIMIT
+
+
+def test_size_limit_throttled():
+    limits = AdaptiveLimits(1, size_limit=80000, time_limit=0.5)
+
+    limits.sent(0.1, throttled=True)
+    assert limits.size_limit == 100000
+
+
+def test_get_adaptive_limits(config):
+    assert get_adaptive_limits(config) is None
+
+    limits = get_adaptive_limits(dict(config, buffer_size_limit=10000,
+                                      adaptive_target_latency=0.1))
+    assert limits.target_latency == 0.1
+    assert limits.size_limit == 10000
+    assert limits.time_limit == 0.1  # Up to the target
+
+
+def test_accumulator(config):
+    config = dict(config, buffer_size_limit=10000, buffer_time_limit=0.1,
+                  adaptive_target_latency=1)
+    accumulator = RecordAccumulator(RawBuffer, config)
+    accumulator.adaptive.sent(0.5)
+
+    accumulator.try_append(b'-' * 10001)
+    accumulator.flush_ready()
+
+    assert accumulator.buffer_time_limit == pytest.approx(0.9)
+    assert accumulator.buffer_size_limit == \
+        10000 + KINESIS_RECORD_MAX_SIZE // 100
+
+    accumulator.try_append(b'-' * 10001)
+    assert not accumulator.is_ready()  # With the new size limit
@@ -0,0 +1,185 @@
+import asyncio
+
+import botocore.exceptions
+import mock
+import pytest
+
+from kinesis_producer.aio import (AsyncKinesisProducer, AsyncClient,
+                                  call_and_retry)
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class StubConnection(object):
+    """Asynchronous stand-in for an aiobotocore Kinesis client."""
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.records = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def put_record(self, **kwargs):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(self.latency)
+        self.in_flight -= 1
+        self.records.append(kwargs)
+        return {'ShardId': 'shardId-000000000000', 'SequenceNumber': '1'}
+
+
+def test_send_and_close(config):
+    connection = StubConnection()
+
+    async def produce():
+        producer = AsyncKinesisProducer(config, connection=connection)
+        await producer.send(b'-')
+        await producer.send(b'-', partition_key='key')
+        await producer.aclose()
+
+    run(produce())
+
+    data = dict((r['PartitionKey'], r['Data']) for r in connection.records)
+    assert data.pop('key') == b'-\n'
+    assert list(data.values()) == [b'-\n']
+
+
+def test_created_outside_the_loop(config):
+    connection = StubConnection()
+    producer = AsyncKinesisProducer(config, connection=connection)
+
+    async def produce():
+        await producer.send(b'-')
+        await producer.aclose()
+
+    run(produce())
+    assert len(connection.records) == 1
+
+
+def test_close_unstarted(config):
+    producer = AsyncKinesisProducer(config, connection=StubConnection())
+    run(producer.aclose())
+
+
+def test_send_immediate(config):
+    connection = StubConnection()
+
+    async def produce():
+        producer = AsyncKinesisProducer(config, connection=connection)
+        await producer.send(b'-' * 200)
+        await asyncio.sleep(0.01)
+        assert len(connection.records) == 1
+        await producer.aclose()
+
+    run(produce())
+
+
+def test_send_linger(config):
+    connection = StubConnection()
+
+    async def produce():
+        producer = AsyncKinesisProducer(config, connection=connection)
+        await producer.send(b'-' * 50)
+        await asyncio.sleep(0.1)
+        assert len(connection.records) == 0
+
+        await asyncio.sleep(0.2)
+        assert len(connection.records) == 1
+        await producer.aclose()
+
+    run(produce())
+
+
+def test_flush(config):
+    connection = StubConnection()
+
+    async def produce():
+        producer = AsyncKinesisProducer(config, connection=connection)
+        await producer.send(b'-')
+        await producer.flush()
+        assert len(connection.records) == 1
+        await producer.aclose()
+
+    run(produce())
+
+
+def test_bounded_in_flight_puts(config):
+    config = dict(config, kinesis_concurrency=2)
+    connection = StubConnection(latency=0.01)
+
+    async def produce():
+        producer = AsyncKinesisProducer(config, connection=connection)
+        for _ in range(10):
+            await producer.send(b'-' * 200)
+        await producer.aclose()
+
+    run(produce())
+
+    assert len(connection.records) == 10
+    assert connection.max_in_flight == 2
+
+
+def test_send_invalid_record(config):
+    async def produce():
+        producer = AsyncKinesisProducer(config, connection=StubConnection())
+        with pytest.raises(ValueError):
+            await producer.send(123)
+        await producer.aclose()
+
+    run(produce())
+
+
+def test_shard_partitioner_not_supported(config):
+    with pytest.raises(ValueError):
+        AsyncKinesisProducer(dict(config, partitioner='round_robin'))
+
+
+def test_send_with_boto3(kinesis, config):
+    async def produce():
+        producer = AsyncKinesisProducer(config)
+        await producer.send(b'-')
+        await producer.aclose()
+
+    with mock.patch('kinesis_producer.aio.get_session', None):
+        run(produce())
+
+    records = kinesis.read_records_from_stream()
+    assert len(records) == 1
+    assert records[0]['Data'] == b'-\n'
+
+
+def test_client_handle_error(config):
+    connection = mock.Mock()
+    connection.put_record.side_effect = Exception()
+    client = AsyncClient(config, connection=connection)
+
+    run(client.put_record((b'data', 'part')))
+
+
+def test_retry_logic_throughput_error():
+    error = {'Error': {'Code': 'ProvisionedThroughputExceededException'}}
+    exc = botocore.exceptions.ClientError(error, None)
+
+    func = mock.Mock()
+    func.side_effect = [exc, 'RESPONSE']
+
+    resp = run(call_and_retry(func, 2, arg='ARG'))
+
+    assert resp == 'RESPONSE'
+
+
+def test_retry_logic_client_error():
+    error = {'Error': {'Code': 'SomeError'}}
+    exc = botocore.exceptions.ClientError(error, None)
+
+    func = mock.Mock()
+    func.side_effect = exc
+
+    with pytest.raises(botocore.exceptions.ClientError):
+        run(call_and_retry(func, 2, arg='ARG'))
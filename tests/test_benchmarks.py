@@ -0,0 +1,81 @@
+import boto3
+import pytest
+
+from benchmarks.run import compare, percentile, run_case
+from benchmarks.stub import StubKinesis
+
+
+@pytest.fixture()
+def stub(clean_boto_configuration):
+    with StubKinesis(shard_count=2) as stub:
+        yield stub
+
+
+def get_connection(stub):
+    return boto3.client('kinesis', region_name='us-east-1',
+                        endpoint_url=stub.endpoint_url)
+
+
+def test_stub_put_record(stub):
+    response = get_connection(stub).put_record(
+        StreamName='benchmark', Data=b'data', PartitionKey='key')
+
+    assert response['ShardId'].startswith('shardId-')
+    assert stub.records == 1
+    assert stub.bytes == len(b'data') + len('key')
+
+
+def test_stub_throttle(stub):
+    stub.throttle_rate = 1
+    response = get_connection(stub).put_records(
+        StreamName='benchmark',
+        Records=[{'Data': b'data', 'PartitionKey': 'key'}] * 2)
+
+    assert response['FailedRecordCount'] == 2
+    assert stub.throttled == 2
+
+
+def test_stub_enforce_limits(stub):
+    stub.enforce_limits = True
+    response = get_connection(stub).put_records(
+        StreamName='benchmark',
+        Records=[{'Data': b'x' * 600000, 'PartitionKey': 'key'}] * 2)
+
+    assert response['FailedRecordCount'] == 1
+
+
+def test_stub_list_shards(stub):
+    response = get_connection(stub).list_shards(StreamName='benchmark')
+
+    assert len(response['Shards']) == 2
+    assert response['Shards'][1]['HashKeyRange']['EndingHashKey'] == \
+        str(2 ** 128 - 1)
+
+
+def test_run_case(stub):
+    case = {'records': 100, 'record_size': 10, 'buffer_size_limit': 500,
+            'buffer_time_limit': 0.1, 'kinesis_batch_size': 1,
+            'kinesis_concurrency': 2}
+
+    results = run_case(case, stub.endpoint_url)
+
+    assert results['records_failed'] == 0
+    assert results['records_per_second'] > 0
+    assert results['latency_p50'] <= results['latency_p99']
+    assert stub.bytes > 100 * 10
+
+
+def test_percentile():
+    assert percentile([], 50) is None
+    assert percentile(list(range(101)), 50) == 50
+    assert percentile(list(range(101)), 99) == 99
+
+
+def test_compare():
+    previous = {'records_per_second': 1000, 'latency_p99': 0.1}
+
+    assert compare({'records_per_second': 950, 'latency_p99': 0.1},
+                   previous, 0.1) == []
+    assert compare({'records_per_second': 800, 'latency_p99': 0.2},
+                   previous, 0.1) == [('records_per_second', 1000, 800),
+                                      ('latency_p99', 0.1, 0.2)]
@@ -0,0 +1,91 @@
+import threading
+import time
+
+import pytest
+
+from kinesis_producer.budget import MemoryBudget, BufferFullError
+
+
+def test_unlimited():
+    budget = MemoryBudget()
+    assert budget.acquire(10 ** 9)
+    assert budget.used == 10 ** 9
+
+    budget.release(10 ** 9)
+    assert budget.used == 0
+
+
+def test_acquire_release():
+    budget = MemoryBudget(max_bytes=100, policy='raise')
+    assert budget.acquire(60)
+    assert budget.acquire(40)
+
+    with pytest.raises(BufferFullError):
+        budget.acquire(1)
+
+    budget.release(60)
+    assert budget.acquire(1)
+    assert budget.used == 41
+
+
+def test_empty_budget_accepts_large_record():
+    budget = MemoryBudget(max_bytes=100, policy='raise')
+    assert budget.acquire(1000)
+
+
+def test_add_ignores_limit():
+    budget = MemoryBudget(max_bytes=100, policy='raise')
+    budget.add(1000)
+    assert budget.used == 1000
+
+
+def test_drop():
+    budget = MemoryBudget(max_bytes=100, policy='drop')
+    assert budget.acquire(100)
+    assert not budget.acquire(1)
+    assert budget.dropped == 1
+    assert budget.used == 100
+
+
+def test_block():
+    budget = MemoryBudget(max_bytes=100, policy='block')
+    budget.acquire(100)
+
+    timer = threading.Timer(0.1, budget.release, args=[100])
+    timer.start()
+
+    started_at = time.time()
+    assert budget.acquire(50)
+    assert time.time() - started_at >= 0.05
+    assert budget.used == 50
+    timer.join()
+
+
+def test_block_timeout():
+    budget = MemoryBudget(max_bytes=100, policy='block', timeout=0.1)
+    budget.acquire(100)
+
+    started_at = time.time()
+    with pytest.raises(BufferFullError):
+        budget.acquire(50)
+    assert time.time() - started_at >= 0.1
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        MemoryBudget(policy='unknown')
+
+
+def test_drop_count():
+    budget = MemoryBudget(max_bytes=100, policy='drop')
+    assert budget.acquire(100)
+    assert not budget.acquire(10, count=5)
+    assert budget.dropped == 5
+
+
+def test_spool():
+    budget = MemoryBudget(max_bytes=100, policy='spool')
+    assert budget.acquire(100)
+    assert not budget.acquire(1)
+    assert budget.dropped == 0
+    assert budget.used == 100
@@ -1,6 +1,11 @@
+import hashlib
+import os
+
 import pytest
 
-from kinesis_producer.buffer import RawBuffer
+from kinesis_producer.buffer import RawBuffer, KPLBuffer, get_buffer_class
+from kinesis_producer.compression import CODECS, ZlibCodec
+from kinesis_producer.constants import KINESIS_RECORD_MAX_SIZE
 
 CONFIG = {
     'record_delimiter': b'X',
@@ -58,3 +63,162 @@ def test_closed():
 
     with pytest.raises(AssertionError):
         buf.flush()
+
+
+def _read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = bytearray(data[pos:pos + 1])[0]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def _read_fields(data):
+    pos = 0
+    while pos < len(data):
+        key, pos = _read_varint(data, pos)
+        if key & 0x07 == 0:
+            value, pos = _read_varint(data, pos)
+        else:
+            length, pos = _read_varint(data, pos)
+            value, pos = data[pos:pos + length], pos + length
+        yield key >> 3, value
+
+
+def decode_kpl(value):
+    assert value[:4] == b'\xf3\x89\x9a\xc2'
+    message, digest = value[4:-16], value[-16:]
+    assert hashlib.md5(message).digest() == digest
+
+    keys, records = [], []
+    for field, field_value in _read_fields(message):
+        if field == 1:
+            keys.append(field_value)
+        elif field == 3:
+            record = dict(_read_fields(field_value))
+            records.append((keys[record[1]], record[3]))
+    return records
+
+
+def test_kpl_append():
+    buf = KPLBuffer(CONFIG)
+
+    buf.try_append(b'123')
+    buf.try_append(b'4X6')
+    buf.try_append(b'\n' * 200)
+
+    records = decode_kpl(buf.flush())
+
+    assert [data for _, data in records] == [b'123', b'4X6', b'\n' * 200]
+    assert all(key == b'a' for key, _ in records)
+
+
+def test_kpl_partition_key():
+    buf = KPLBuffer(CONFIG, partition_key=u'key')
+    buf.try_append(b'123')
+
+    assert decode_kpl(buf.flush()) == [(b'key', b'123')]
+
+
+def test_kpl_is_ready():
+    buf = KPLBuffer(CONFIG)
+
+    buf.try_append(b'-' * 50)
+    assert not buf.is_ready()
+
+    buf.try_append(b'-' * 50)
+    assert buf.is_ready()
+
+
+def test_kpl_try_append_response():
+    buf = KPLBuffer(CONFIG)
+
+    assert buf.try_append(b'-' * 1024)
+    assert not buf.try_append(b'-' * (1024 * 1023))
+
+
+@pytest.mark.parametrize('partition_key', [None, u'\xe9' * 256,
+                                           u'\U0001f600' * 256])
+def test_kpl_max_record_size(partition_key):
+    max_size = KPLBuffer.max_record_size(CONFIG)
+
+    buf = KPLBuffer(CONFIG, partition_key=partition_key)
+    assert buf.try_append(b'-' * max_size)
+    assert len(buf.flush()) <= KINESIS_RECORD_MAX_SIZE
+
+
+def test_kpl_closed():
+    buf = KPLBuffer(CONFIG)
+    buf.flush()
+
+    with pytest.raises(AssertionError):
+        buf.try_append(b'-')
+
+    with pytest.raises(AssertionError):
+        buf.flush()
+
+
+def test_get_buffer_class():
+    assert get_buffer_class({}) is RawBuffer
+    assert get_buffer_class({'aggregation_format': 'raw'}) is RawBuffer
+    assert get_buffer_class({'aggregation_format': 'kpl'}) is KPLBuffer
+
+    with pytest.raises(ValueError):
+        get_buffer_class({'aggregation_format': 'unknown'})
+
+
+def test_compressed_append():
+    codec = ZlibCodec()
+    buf = RawBuffer(CONFIG, codec=codec)
+
+    buf.try_append(b'123')
+    buf.try_append(b'456')
+
+    assert codec.decompress(buf.flush()) == b'123X456X'
+
+
+def test_compressed_kpl_append():
+    codec = ZlibCodec()
+    buf = KPLBuffer(CONFIG, codec=codec)
+
+    buf.try_append(b'123')
+    buf.try_append(b'456')
+
+    records = decode_kpl(codec.decompress(buf.flush()))
+    assert [data for _, data in records] == [b'123', b'456']
+
+
+def test_compressed_is_ready():
+    codec = ZlibCodec()
+    codec.ratio = 0.1
+    buf = RawBuffer(CONFIG, codec=codec)
+
+    buf.try_append(b'-' * 600)
+    assert not buf.is_ready()
+
+    buf.try_append(b'-' * 600)
+    assert buf.is_ready()
+
+
+def test_compressed_max_record_size():
+    config = dict(CONFIG, compression='zlib')
+    max_size = RawBuffer.max_record_size(config)
+    assert max_size < RawBuffer.max_record_size(CONFIG)
+
+    buf = RawBuffer(config, codec=ZlibCodec())
+    assert buf.try_append(b'-' * max_size)
+
+
+@pytest.mark.parametrize('buffer_class', [RawBuffer, KPLBuffer])
+@pytest.mark.parametrize('compression', sorted(CODECS))
+def test_compressed_max_record_size_codecs(buffer_class, compression):
+    config = dict(CONFIG, compression=compression)
+    max_size = buffer_class.max_record_size(config)
+
+    codec = CODECS[compression]()
+    buf = buffer_class(config, codec=codec)
+    assert buf.try_append(os.urandom(max_size))  # Incompressible
+    assert len(buf.flush()) <= KINESIS_RECORD_MAX_SIZE
@@ -1,10 +1,14 @@
+import threading
 import time
 
 import mock
 import pytest
 
 import botocore.exceptions
-from kinesis_producer.client import Client, ThreadPoolClient, call_and_retry
+from kinesis_producer.client import (Client, ThreadPoolClient,
+                                     create_connection, get_botocore_config,
+                                     get_stream_configs)
+from kinesis_producer.futures import DeliveryTimeoutError
 
 
 def test_init(kinesis):
@@ -51,56 +55,6 @@ def test_send_records_handle_error(config, kinesis):
         client.put_record(record)
 
 
-def test_retry_logic_call():
-    func = mock.Mock()
-    resp = call_and_retry(func, 3, arg='ARG')
-
-    assert resp == func.return_value
-    func.assert_called_once_with(arg='ARG')
-
-
-def test_retry_logic_unknown_exception():
-    func = mock.Mock()
-    func.side_effect = Exception()
-
-    with pytest.raises(Exception):
-        call_and_retry(func, 3, arg='ARG')
-
-
-def test_retry_logic_client_error():
-    error = {'Error': {'Code': 'SomeError'}}
-    exc = botocore.exceptions.ClientError(error, None)
-
-    func = mock.Mock()
-    func.side_effect = exc
-
-    with pytest.raises(botocore.exceptions.ClientError):
-        call_and_retry(func, 3, arg='ARG')
-
-
-def test_retry_logic_throughput_error():
-    error = {'Error': {'Code': 'ProvisionedThroughputExceededException'}}
-    exc = botocore.exceptions.ClientError(error, None)
-
-    func = mock.Mock()
-    func.side_effect = [exc, exc, 'RESPONSE']
-
-    resp = call_and_retry(func, 2, arg='ARG')
-
-    assert resp == 'RESPONSE'
-
-
-def test_retry_logic_throughput_error_give_up():
-    error = {'Error': {'Code': 'ProvisionedThroughputExceededException'}}
-    exc = botocore.exceptions.ClientError(error, None)
-
-    func = mock.Mock()
-    func.side_effect = [exc, exc, exc]
-
-    with pytest.raises(botocore.exceptions.ClientError):
-        call_and_retry(func, 2, arg='ARG')
-
-
 TEST_DATA = [('data-%0i' % i).encode() for i in range(20)]
 
 
@@ -147,3 +101,480 @@ def test_threadpool_async(kinesis):
     client.join()
 
     assert len(TEST_DATA) == len(records)
+
+
+def test_send_records(kinesis, config):
+    client = Client(config)
+
+    records = [(data, 'part') for data in TEST_DATA]
+    client.put_records(records)
+
+    records = kinesis.read_records_from_stream()
+
+    assert len(TEST_DATA) == len(records)
+    assert [r['Data'] for r in records] == TEST_DATA
+
+
+def test_send_records_retry_failed_records(config):
+    with mock.patch('kinesis_producer.client.get_connection'):
+        client = Client(config)
+
+    failed = {'ErrorCode': 'ProvisionedThroughputExceededException'}
+    client.connection.put_records.side_effect = [
+        {'FailedRecordCount': 1, 'Records': [{}, failed, {}]},
+        {'FailedRecordCount': 0, 'Records': [{}]},
+    ]
+
+    client.put_records([(b'a', 'p'), (b'b', 'p'), (b'c', 'p')])
+
+    calls = client.connection.put_records.call_args_list
+    assert len(calls) == 2
+    assert calls[1][1]['Records'] == [{'Data': b'b', 'PartitionKey': 'p'}]
+
+
+def test_send_records_give_up(config):
+    with mock.patch('kinesis_producer.client.get_connection'):
+        client = Client(config)
+
+    failed = {'ErrorCode': 'InternalFailure'}
+    client.connection.put_records.return_value = {
+        'FailedRecordCount': 1, 'Records': [failed],
+    }
+
+    with mock.patch.object(client._joined, 'wait', return_value=False):
+        client.put_records([(b'a', 'p')])
+
+    assert client.connection.put_records.call_count == 4
+
+
+def test_threadpool_send_records(kinesis):
+    config = {
+        'aws_region': 'us-east-1',
+        'stream_name': 'STREAM_NAME',
+        'kinesis_max_retries': 3,
+        'kinesis_concurrency': 2,
+    }
+    client = ThreadPoolClient(config)
+
+    client.put_records([(data, 'part') for data in TEST_DATA[:10]])
+    client.put_records([(data, 'part') for data in TEST_DATA[10:]])
+
+    client.close()
+    client.join()
+    records = kinesis.read_records_from_stream()
+
+    assert sorted(TEST_DATA) == sorted(r['Data'] for r in records)
+
+
+def test_send_record_explicit_hash_key(config):
+    with mock.patch('kinesis_producer.client.get_connection'):
+        client = Client(config)
+
+    client.put_record((b'data', 'part', '42'))
+
+    client.connection.put_record.assert_called_once_with(
+        StreamName='STREAM_NAME', Data=b'data', PartitionKey='part',
+        ExplicitHashKey='42')
+
+
+def test_send_records_metrics(config):
+    with mock.patch('kinesis_producer.client.get_connection'):
+        client = Client(config)
+
+    failed = {'ErrorCode': 'ProvisionedThroughputExceededException'}
+    client.connection.put_records.side_effect = [
+        {'FailedRecordCount': 1, 'Records': [{}, failed]},
+        {'FailedRecordCount': 0, 'Records': [{}]},
+    ]
+
+    client.put_records([(b'a', 'p'), (b'b', 'p')])
+
+    counters = client.metrics.snapshot()['counters']
+    assert counters == {'kinesis_records_sent': 2, 'put_throttles': 1,
+                        'put_retries': 1}
+
+
+def test_send_record_callback(kinesis, config):
+    client = Client(config)
+    callback = mock.Mock()
+
+    client.put_record((b'data', 'part'), callback=callback)
+
+    response = callback.call_args[0][0]
+    assert response['ShardId'] == 'shardId-000000000000'
+
+
+def test_send_record_callback_error(config):
+    with mock.patch('kinesis_producer.client.get_connection'):
+        client = Client(config)
+    error = Exception()
+    client.connection.put_record.side_effect = error
+    callback = mock.Mock()
+
+    client.put_record((b'data', 'part'), callback=callback)
+
+    callback.assert_called_once_with(error)
+
+
+def test_send_records_callback(config):
+    with mock.patch('kinesis_producer.client.get_connection'):
+        client = Client(config)
+
+    failed = {'ErrorCode': 'InternalFailure', 'ErrorMessage': 'Oops'}
+    success = {'ShardId': 'shardId-000000000000', 'SequenceNumber': '1'}
+    client.connection.put_records.side_effect = [
+        {'FailedRecordCount': 1, 'Records': [success, failed]},
+    ] + [{'FailedRecordCount': 1, 'Records': [failed]}] * 3
+    callback = mock.Mock()
+
+    with mock.patch.object(client._joined, 'wait', return_value=False):
+        client.put_records([(b'a', 'p'), (b'b', 'p')], callback=callback)
+
+    results = callback.call_args[0][0]
+    assert results[0] == success
+    assert isinstance(results[1], botocore.exceptions.ClientError)
+    assert results[1].response['Error']['Code'] == 'InternalFailure'
+
+
+def test_send_record_rate_limit(config):
+    config = dict(config, rate_limit='stream', rate_limit_records=1)
+    with mock.patch('kinesis_producer.client.get_connection'):
+        client = Client(config)
+
+    with mock.patch.object(client._joined, 'wait',
+                           return_value=False) as sleep:
+        client.put_record((b'a', 'p'))
+        assert not sleep.called
+
+        client.put_record((b'b', 'p'))
+        assert sleep.call_args[0][0] == pytest.approx(1, abs=0.1)
+
+    assert client.metrics.snapshot()['histograms']['rate_limit_delay'][
+        'count'] == 1
+
+
+def test_send_records_throttled_lowers_rate_limit(config):
+    config = dict(config, rate_limit='stream', rate_limit_records=100)
+    with mock.patch('kinesis_producer.client.get_connection'):
+        client = Client(config)
+
+    failed = {'ErrorCode': 'ProvisionedThroughputExceededException'}
+    client.connection.put_records.side_effect = [
+        {'FailedRecordCount': 1, 'Records': [{}, failed]},
+        {'FailedRecordCount': 0, 'Records': [{}]},
+    ]
+
+    with mock.patch('time.sleep'):
+        client.put_records([(b'a', 'p'), (b'b', 'p')])
+
+    assert client.limiter._limit.factor == pytest.approx(0.8 + 0.01 * 2)
+
+
+@pytest.mark.parametrize('exc', [
+    botocore.exceptions.ClientError(
+        {'Error': {'Code': 'ProvisionedThroughputExceededException'}}, None),
+    botocore.exceptions.ClientError(
+        {'Error': {'Code': 'InternalFailure'}}, None),
+    botocore.exceptions.ClientError(
+        {'Error': {'Code': 'KMSThrottlingException'}}, None),
+    botocore.exceptions.EndpointConnectionError(endpoint_url='URL'),
+])
+def test_send_record_retryable_errors(config, exc):
+    with mock.patch('kinesis_producer.client.get_connection'):
+        client = Client(config)
+    client.connection.put_record.side_effect = [exc, {'ShardId': 'S'}]
+    callback = mock.Mock()
+
+    with mock.patch('time.sleep'):
+        client.put_record((b'data', 'part'), callback=callback)
+
+    callback.assert_called_once_with({'ShardId': 'S'})
+    stats = client.metrics.snapshot()
+    assert stats['counters']['put_retries'] == 1
+    assert stats['histograms']['put_latency']['count'] == 2
+
+
+def test_send_record_give_up(config):
+    error = {'Error': {'Code': 'ProvisionedThroughputExceededException'}}
+    exc = botocore.exceptions.ClientError(error, None)
+    with mock.patch('kinesis_producer.client.get_connection'):
+        client = Client(dict(config, kinesis_max_retries=2))
+    client.connection.put_record.side_effect = exc
+    callback = mock.Mock()
+
+    with mock.patch('time.sleep'):
+        client.put_record((b'data', 'part'), callback=callback)
+
+    callback.assert_called_once_with(exc)
+    assert client.connection.put_record.call_count == 3
+    assert client.metrics.snapshot()['counters'] == {
+        'put_retries': 2, 'put_throttles': 3, 'kinesis_records_failed': 1}
+
+
+def test_send_records_not_retryable(config):
+    with mock.patch('kinesis_producer.client.get_connection'):
+        client = Client(config)
+
+    failed = {'ErrorCode': 'ValidationException'}
+    client.connection.put_records.return_value = {
+        'FailedRecordCount': 1, 'Records': [{}, failed],
+    }
+    callback = mock.Mock()
+
+    client.put_records([(b'a', 'p'), (b'b', 'p')], callback=callback)
+
+    assert client.connection.put_records.call_count == 1
+    assert client.metrics.snapshot()['counters'][
+        'kinesis_records_failed'] == 1
+    assert callback.called
+
+
+def test_threadpool_retry_does_not_block(config):
+    config = dict(config, kinesis_concurrency=1)
+    with mock.patch('kinesis_producer.client.get_connection'):
+        client = ThreadPoolClient(config)
+    client.retry_policy.base = 0.5
+
+    error = {'Error': {'Code': 'ProvisionedThroughputExceededException'}}
+    throttled = botocore.exceptions.ClientError(error, None)
+    responses = {b'a': [throttled, 'A'], b'b': ['B']}
+
+    def put_record(Data, **kwargs):
+        response = responses[Data].pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    client.connection.put_record.side_effect = put_record
+    results = []
+
+    with mock.patch('random.uniform', return_value=0.2):
+        client.put_record((b'a', 'p'), callback=results.append)
+        time.sleep(0.1)  # 'a' is throttled and waits for its retry
+        client.put_record((b'b', 'p'), callback=results.append)
+        time.sleep(0.05)
+        assert results == ['B']
+
+        client.close()
+        client.join()
+    assert results == ['B', 'A']
+
+
+def test_botocore_config(config):
+    botocore_config = get_botocore_config(config)
+    assert botocore_config.max_pool_connections == 10
+
+    botocore_config = get_botocore_config(dict(
+        config, kinesis_concurrency=32, kinesis_connect_timeout=2,
+        kinesis_read_timeout=5, kinesis_tcp_keepalive=True))
+    assert botocore_config.max_pool_connections == 32
+    assert botocore_config.connect_timeout == 2
+    assert botocore_config.read_timeout == 5
+    assert botocore_config.tcp_keepalive is True
+
+    botocore_config = get_botocore_config(dict(
+        config, kinesis_max_pool_connections=4))
+    assert botocore_config.max_pool_connections == 4
+
+
+def test_client_factory(config):
+    connection = mock.Mock()
+    factory = mock.Mock(return_value=connection)
+
+    client = Client(dict(config, kinesis_client_factory=factory))
+
+    assert client.connection is connection
+    factory.assert_called_once_with(dict(config,
+                                         kinesis_client_factory=factory))
+
+
+def test_create_connection(config):
+    with mock.patch('kinesis_producer.client.get_connection') as get:
+        create_connection(config)
+
+    aws_region, endpoint_url, botocore_config = get.call_args[0]
+    assert aws_region == 'us-east-1'
+    assert endpoint_url is None
+    assert botocore_config.max_pool_connections == 10
+
+
+def test_warm(config):
+    with mock.patch('kinesis_producer.client.get_connection'):
+        client = Client(config)
+
+    client.warm()
+
+    client.connection.list_shards.assert_called_once_with(
+        StreamName='STREAM_NAME', MaxResults=1)
+
+
+def test_warm_error(config):
+    with mock.patch('kinesis_producer.client.get_connection'):
+        client = Client(config)
+    client.connection.list_shards.side_effect = Exception('down')
+
+    client.warm()  # Best effort
+
+
+def test_threadpool_warm(config):
+    with mock.patch('kinesis_producer.client.get_connection'):
+        client = ThreadPoolClient(dict(config, kinesis_concurrency=3))
+
+    client.warm()
+    client.join()
+
+    assert client.connection.list_shards.call_count == 3
+
+
+def test_stream_configs(config):
+    configs = get_stream_configs(dict(config, streams={
+        'b': {'buffer_time_limit': 1}, 'a': None}))
+
+    assert list(configs) == ['STREAM_NAME', 'a', 'b']
+    assert configs['a']['stream_name'] == 'a'
+    assert configs['b']['buffer_time_limit'] == 1
+    assert configs['b']['buffer_size_limit'] == config['buffer_size_limit']
+
+
+def test_send_record_to_stream(config):
+    with mock.patch('kinesis_producer.client.get_connection'):
+        client = Client(dict(config, streams={'other': {}}))
+
+    client.put_record((b'data', 'part'), stream='other')
+
+    client.connection.put_record.assert_called_once_with(
+        StreamName='other', Data=b'data', PartitionKey='part')
+
+
+def test_threadpool_join_timeout(config):
+    with mock.patch('kinesis_producer.client.get_connection'):
+        client = ThreadPoolClient(dict(config, kinesis_concurrency=2))
+    done = threading.Event()
+    client.connection.put_record.side_effect = lambda **kwargs: done.wait(5)
+
+    client.put_record((b'-', 'p'))
+    started_at = time.time()
+    assert not client.join(timeout=0.1)
+    assert time.time() - started_at < 1
+    done.set()
+
+
+def test_join_gives_up_sleeping_puts(config):
+    config = dict(config, rate_limit='stream', rate_limit_records=1)
+    with mock.patch('kinesis_producer.client.get_connection'):
+        client = Client(config)
+    client.connection.put_record.return_value = {}
+    client.put_record((b'a', 'p'))
+    results = []
+
+    put = threading.Thread(target=client.put_record, args=((b'b', 'p'),),
+                           kwargs={'callback': results.append})
+    put.start()  # Waits for the rate limiter
+    time.sleep(0.1)
+    started_at = time.time()
+    assert client.join(timeout=0)
+    put.join(1)
+    assert time.time() - started_at < 0.5
+    assert isinstance(results[0], DeliveryTimeoutError)
+
+    client.put_records([(b'c', 'p')], callback=results.append)
+    assert isinstance(results[1][0], DeliveryTimeoutError)
+    assert client.connection.put_record.call_count == 1
+
+
+def test_threadpool_join_timeout_gives_up_retries(config):
+    with mock.patch('kinesis_producer.client.get_connection'):
+        client = ThreadPoolClient(dict(config, kinesis_concurrency=2))
+    error = {'Error': {'Code': 'ProvisionedThroughputExceededException'}}
+    throttled = botocore.exceptions.ClientError(error, None)
+    client.connection.put_record.side_effect = throttled
+    client.connection.put_records.return_value = {'Records': [
+        {'ErrorCode': 'ProvisionedThroughputExceededException'}]}
+    results = []
+
+    with mock.patch('random.uniform', return_value=10):
+        client.put_record((b'a', 'p'), callback=results.append)
+        client.put_records([(b'b', 'p')], callback=results.append)
+        assert not client.join(timeout=0.1)
+
+    assert len(results) == 2
+    assert isinstance(results[0], DeliveryTimeoutError)
+    assert isinstance(results[1][0], DeliveryTimeoutError)
+    assert client.metrics.snapshot()['counters'][
+        'kinesis_records_failed'] == 2
+
+
+def test_threadpool_put_after_join(config):
+    with mock.patch('kinesis_producer.client.get_connection'):
+        client = ThreadPoolClient(dict(config, kinesis_concurrency=2))
+    client.join()
+    results = []
+
+    client.put_record((b'a', 'p'), callback=results.append)
+    client.put_records([(b'b', 'p'), (b'c', 'p')], callback=results.append)
+
+    assert not client.connection.put_record.called
+    assert isinstance(results[0], DeliveryTimeoutError)
+    assert [type(result) for result in results[1]] == \
+        [DeliveryTimeoutError] * 2
+
+
+def test_threadpool_priority(config):
+    config = dict(config, kinesis_concurrency=1)
+    with mock.patch('kinesis_producer.client.get_connection'):
+        client = ThreadPoolClient(config)
+    started = threading.Event()
+    release = threading.Event()
+    sent = []
+
+    def put_record(Data, **kwargs):
+        sent.append(Data)
+        started.set()
+        release.wait(5)
+        return {}
+
+    client.connection.put_record.side_effect = put_record
+    client.put_record((b'busy', 'p'))
+    started.wait(5)  # The pool thread is busy
+    client.put_record((b'low', 'p'))
+    client.put_record((b'high', 'p'), priority=1)
+    release.set()
+    client.close()
+    client.join()
+
+    assert sent == [b'busy', b'high', b'low']
+
+
+def test_threadpool_retry_keeps_priority(config):
+    config = dict(config, kinesis_concurrency=1)
+    with mock.patch('kinesis_producer.client.get_connection'):
+        client = ThreadPoolClient(config)
+    error = {'Error': {'Code': 'ProvisionedThroughputExceededException'}}
+    throttled = botocore.exceptions.ClientError(error, None)
+    started = threading.Event()
+    release = threading.Event()
+    sent = []
+
+    def put_record(Data, **kwargs):
+        sent.append(Data)
+        if Data == b'busy':
+            started.set()
+            release.wait(5)
+        elif Data == b'high' and len(sent) == 1:
+            raise throttled
+        return {}
+
+    client.connection.put_record.side_effect = put_record
+    with mock.patch('random.uniform', return_value=0.01):
+        client.put_record((b'high', 'p'), priority=1)
+        client.put_record((b'busy', 'p'))
+        started.wait(5)  # The pool thread is busy
+        client.put_record((b'low', 'p'))
+        deadline = time.time() + 5
+        while len(client._tasks) < 2 and time.time() < deadline:
+            time.sleep(0.01)  # Until the retry waits for the pool thread
+        release.set()
+        client.close()
+        client.join()
+
+    assert sent == [b'high', b'busy', b'high', b'low']
@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+from kinesis_producer.compression import CODECS, get_codec, ZlibCodec
+from kinesis_producer.constants import KINESIS_RECORD_MAX_SIZE
+
+
+@pytest.fixture(params=sorted(CODECS))
+def codec(request):
+    return CODECS[request.param]()
+
+
+def test_get_codec():
+    assert get_codec({}) is None
+    assert isinstance(get_codec({'compression': 'zlib'}), ZlibCodec)
+    assert get_codec({'compression': 'gzip',
+                      'compression_level': 9}).level == 9
+
+    with pytest.raises(ValueError):
+        get_codec({'compression': 'unknown'})
+
+
+def test_writer(codec):
+    writer = codec.writer()
+    writer.write(b'123')
+    writer.write(b'456')
+
+    assert codec.decompress(writer.close()) == b'123456'
+
+
+def test_writer_sync_flush(codec):
+    writer = codec.writer()
+    writer.write(b'-' * 1000)
+    assert not writer.fits(KINESIS_RECORD_MAX_SIZE)  # Flush the compressor
+    writer.write(b'+' * 1000)
+
+    assert codec.decompress(writer.close()) == b'-' * 1000 + b'+' * 1000
+
+
+def test_writer_fits_incompressible(codec):
+    data = os.urandom(KINESIS_RECORD_MAX_SIZE)
+
+    writer = codec.writer()
+    while writer.fits(1000):
+        writer.write(data[:1000])
+        data = data[1000:]
+
+    assert len(writer.close()) <= KINESIS_RECORD_MAX_SIZE
+
+
+def test_writer_fills_compressed_record(codec):
+    record = b'{"id": %i, "name": "some name", "values": [1, 2, 3]}\n'
+    writer = codec.writer()
+    i = 0
+    while writer.fits(len(record % i)):
+        writer.write(record % i)
+        i += 1
+
+    compressed = writer.close()
+    assert len(compressed) <= KINESIS_RECORD_MAX_SIZE
+    assert len(compressed) > KINESIS_RECORD_MAX_SIZE * 0.9
+    assert i * len(record) > 2 * KINESIS_RECORD_MAX_SIZE
+
+
+def test_ratio(codec):
+    writer = codec.writer()
+    writer.write(b'-' * 10000)
+    writer.close()
+    assert codec.ratio < 0.9
+
+    writer = codec.writer()
+    writer.write(b'-' * 10000)
+    assert writer.size < 9000
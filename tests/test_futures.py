@@ -0,0 +1,87 @@
+import threading
+
+import mock
+import pytest
+
+from kinesis_producer.futures import (PendingCounter, RecordFuture,
+                                      RecordMetadata, DeliveryTimeoutError,
+                                      resolve_futures)
+
+RESPONSE = {'ShardId': 'shardId-000000000000', 'SequenceNumber': '42'}
+
+
+def test_resolve():
+    futures = [RecordFuture(), RecordFuture()]
+    assert not futures[0].done()
+
+    resolve_futures(futures, RESPONSE)
+
+    expected = RecordMetadata('shardId-000000000000', '42')
+    for future in futures:
+        assert future.done()
+        assert future.result() == expected
+        assert future.exception() is None
+
+
+def test_resolve_error():
+    future = RecordFuture()
+    error = ValueError()
+
+    resolve_futures([future], error)
+
+    assert future.exception() is error
+    with pytest.raises(ValueError):
+        future.result()
+
+
+def test_timeout():
+    future = RecordFuture()
+
+    with pytest.raises(DeliveryTimeoutError):
+        future.result(timeout=0.01)
+
+
+def test_wait():
+    future = RecordFuture()
+    timer = threading.Timer(0.05, resolve_futures, args=[[future], RESPONSE])
+    timer.start()
+
+    assert future.result(timeout=1).sequence_number == '42'
+    timer.join()
+
+
+def test_callbacks():
+    future = RecordFuture()
+    callback = mock.Mock()
+    future.add_done_callback(callback)
+    assert not callback.called
+
+    resolve_futures([future], RESPONSE)
+    callback.assert_called_once_with(future)
+
+    late_callback = mock.Mock()
+    future.add_done_callback(late_callback)
+    late_callback.assert_called_once_with(future)
+
+
+def test_callback_error():
+    future = RecordFuture()
+    callback = mock.Mock()
+    future.add_done_callback(mock.Mock(side_effect=Exception()))
+    future.add_done_callback(callback)
+
+    resolve_futures([future], RESPONSE)
+    assert callback.called
+
+
+def test_pending_counter():
+    pending = PendingCounter()
+    assert pending.wait() == 0
+
+    pending.add(3)
+    assert pending.wait(timeout=0.01) == 3
+
+    timer = threading.Timer(0.05, pending.done, args=(3,))
+    timer.start()
+    assert pending.wait(timeout=5) == 0
+    timer.join()
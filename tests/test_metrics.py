@@ -0,0 +1,124 @@
+import socket
+
+import mock
+
+from kinesis_producer.clock import monotonic
+from kinesis_producer.metrics import (Metrics, Histogram, StatsdExporter,
+                                      format_prometheus)
+
+
+def test_histogram():
+    histogram = Histogram((1, 2))
+    histogram.observe(0.5)
+    histogram.observe(1)
+    histogram.observe(1.5)
+    histogram.observe(10)
+
+    snapshot = histogram.snapshot()
+    assert snapshot['buckets'] == [(1, 2), (2, 3), (float('inf'), 4)]
+    assert snapshot['count'] == 4
+    assert snapshot['sum'] == 13
+
+
+def test_snapshot():
+    metrics = Metrics()
+    metrics.incr('counter')
+    metrics.incr('counter', 2)
+    metrics.observe('latency', 0.1)
+    metrics.register_gauge('gauge', lambda: 42)
+
+    stats = metrics.snapshot()
+    assert stats['counters'] == {'counter': 3}
+    assert stats['gauges'] == {'gauge': 42}
+    assert stats['histograms']['latency']['count'] == 1
+
+
+def test_export_if_due():
+    exporter = mock.Mock()
+    metrics = Metrics(exporters=[exporter], interval=0)
+    metrics.incr('counter')
+
+    metrics.export_if_due()
+    exporter.assert_called_once_with(metrics.snapshot())
+
+
+def test_export_not_due():
+    exporter = mock.Mock()
+    metrics = Metrics(exporters=[exporter], interval=60)
+
+    metrics.export_if_due()
+    assert not exporter.called
+
+
+def test_export_error():
+    exporter = mock.Mock(side_effect=Exception())
+    metrics = Metrics(exporters=[exporter, exporter])
+
+    metrics.export()
+    assert exporter.call_count == 2
+
+
+def test_format_prometheus():
+    metrics = Metrics()
+    metrics.incr('records_sent', 3)
+    metrics.register_gauge('queue_size', lambda: 1)
+    metrics.observe('put_latency', 0.2, buckets=(0.1, 1))
+
+    text = format_prometheus(metrics.snapshot())
+
+    assert text == '\n'.join([
+        '# TYPE kinesis_producer_records_sent_total counter',
+        'kinesis_producer_records_sent_total 3',
+        '# TYPE kinesis_producer_queue_size gauge',
+        'kinesis_producer_queue_size 1',
+        '# TYPE kinesis_producer_put_latency histogram',
+        'kinesis_producer_put_latency_bucket{le="0.1"} 0',
+        'kinesis_producer_put_latency_bucket{le="1"} 1',
+        'kinesis_producer_put_latency_bucket{le="+Inf"} 1',
+        'kinesis_producer_put_latency_sum 0.2',
+        'kinesis_producer_put_latency_count 1',
+    ]) + '\n'
+
+
+def test_statsd_format():
+    metrics = Metrics()
+    exporter = StatsdExporter(prefix='kp')
+
+    metrics.incr('records_sent', 3)
+    metrics.register_gauge('queue_size', lambda: 1)
+    metrics.observe('put_latency', 0.5)
+    metrics.observe('put_latency', 1.5)
+    assert exporter.format(metrics.snapshot()) == [
+        'kp.records_sent:3|c',
+        'kp.queue_size:1|g',
+        'kp.put_latency.count:2|c',
+        'kp.put_latency.mean:1.0|g',
+    ]
+
+    metrics.incr('records_sent')
+    assert exporter.format(metrics.snapshot()) == [
+        'kp.records_sent:1|c',
+        'kp.queue_size:1|g',
+        'kp.put_latency.count:0|c',
+    ]
+
+
+def test_statsd_send():
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    server.settimeout(1)
+
+    exporter = StatsdExporter(port=server.getsockname()[1], host='127.0.0.1')
+    metrics = Metrics(exporters=[exporter])
+    metrics.incr('records_sent')
+    metrics.export()
+
+    assert server.recv(1024) == b'kinesis_producer.records_sent:1|c'
+    server.close()
+
+
+def test_next_export():
+    assert Metrics().next_export() is None
+
+    metrics = Metrics(exporters=[mock.Mock()], interval=60)
+    assert metrics.next_export() - monotonic() > 59
@@ -1,6 +1,13 @@
+import threading
+
+import boto3
+import mock
+import pytest
 import six
 
-from kinesis_producer.partitioner import random_partitioner
+from conftest import shard
+from kinesis_producer.partitioner import (random_partitioner, get_partitioner,
+                                          ShardPartitioner)
 
 
 def test_random_key_is_string():
@@ -13,3 +20,121 @@ def test_random_key_changes():
     key2 = random_partitioner(None)
     key3 = random_partitioner(None)
     assert key1 != key2 != key3
+
+
+CONFIG = {'stream_name': 'STREAM_NAME'}
+
+SHARDS = {'Shards': [
+    shard('shard-0', 0, 99, closed=True),
+    shard('shard-1', 0, 49),
+    shard('shard-2', 50, 99),
+]}
+
+
+def test_shard_partitioner_round_robin():
+    connection = mock.Mock()
+    connection.list_shards.return_value = SHARDS
+    partitioner = ShardPartitioner(connection, CONFIG)
+
+    hash_keys = [partitioner(b'-')[1] for _ in range(4)]
+
+    assert hash_keys == ['24', '74', '24', '74']
+    connection.list_shards.assert_called_once_with(StreamName='STREAM_NAME')
+
+
+def test_shard_partitioner_least_loaded():
+    connection = mock.Mock()
+    connection.list_shards.return_value = SHARDS
+    partitioner = ShardPartitioner(connection, CONFIG,
+                                   strategy='least_loaded')
+
+    partition_key, hash_key = partitioner(b'-' * 100)
+    assert isinstance(partition_key, six.string_types)
+    assert hash_key == '24'
+
+    assert partitioner(b'-' * 10)[1] == '74'
+    assert partitioner(b'-' * 10)[1] == '74'
+    assert partitioner(b'-' * 100)[1] == '74'
+    assert partitioner(b'-' * 10)[1] == '24'
+
+
+def test_shard_partitioner_pagination():
+    connection = mock.Mock()
+    connection.list_shards.side_effect = [
+        {'Shards': [shard('shard-1', 0, 49)], 'NextToken': 'TOKEN'},
+        {'Shards': [shard('shard-2', 50, 99)]},
+    ]
+    partitioner = ShardPartitioner(connection, CONFIG)
+    partitioner.refresh()
+
+    assert sorted(partitioner._shards) == ['shard-1', 'shard-2']
+    connection.list_shards.assert_called_with(NextToken='TOKEN')
+
+
+def test_shard_partitioner_refresh():
+    connection = mock.Mock()
+    connection.list_shards.return_value = SHARDS
+    config = dict(CONFIG, shard_refresh_interval=0)
+    partitioner = ShardPartitioner(connection, config)
+
+    partitioner(b'-')
+    partitioner(b'-')
+
+    assert connection.list_shards.call_count == 2
+
+
+def test_shard_partitioner_refresh_outside_lock():
+    connection = mock.Mock()
+    connection.list_shards.return_value = SHARDS
+    partitioner = ShardPartitioner(connection, CONFIG)
+    partitioner(b'-')
+
+    listing = threading.Event()
+    release = threading.Event()
+
+    def list_shards(**kwargs):
+        listing.set()
+        release.wait(5)
+        return SHARDS
+
+    connection.list_shards.side_effect = list_shards
+    partitioner._refreshed_at -= partitioner.refresh_interval
+    refresh = threading.Thread(target=partitioner, args=(b'-',))
+    refresh.start()
+    assert listing.wait(5)
+
+    assert partitioner(b'-')[1] == '74'  # Not blocked, previous shards
+    assert refresh.is_alive()
+    release.set()
+    refresh.join()
+    assert connection.list_shards.call_count == 2
+
+
+def test_shard_partitioner_list_shards_error():
+    connection = mock.Mock()
+    connection.list_shards.side_effect = Exception()
+    partitioner = ShardPartitioner(connection, CONFIG)
+
+    key = partitioner(b'-')
+    assert isinstance(key, six.string_types)
+
+
+def test_get_partitioner():
+    connection = mock.Mock()
+    assert get_partitioner(connection, {}) is random_partitioner
+
+    config = dict(CONFIG, partitioner='least_loaded')
+    partitioner = get_partitioner(connection, config)
+    assert isinstance(partitioner, ShardPartitioner)
+    assert partitioner.strategy == 'least_loaded'
+
+    with pytest.raises(ValueError):
+        get_partitioner(connection, {'partitioner': 'unknown'})
+
+
+def test_shard_partitioner_with_kinesis(kinesis):
+    connection = boto3.client('kinesis')
+    partitioner = ShardPartitioner(connection, CONFIG)
+
+    partition_key, hash_key = partitioner(b'-')
+    assert int(hash_key) > 0
@@ -1,7 +1,17 @@
+import gzip
+import io
+import os
+import subprocess
+import sys
+import threading
 import time
 
+import boto3
+import mock
 import pytest
 
+from kinesis_producer import BufferFullError, DeliveryTimeoutError
+from kinesis_producer import producer as producer_module
 from kinesis_producer.producer import KinesisProducer
 
 
@@ -28,6 +38,22 @@ def test_send_invalid_record(kinesis, config):
     c.join()
 
 
+def test_send_invalid_partition_key(kinesis, config):
+    c = KinesisProducer(config)
+
+    with pytest.raises(ValueError):
+        c.send(b'-', partition_key=123)
+
+    with pytest.raises(ValueError):
+        c.send(b'-', partition_key='')
+
+    with pytest.raises(ValueError):
+        c.send(b'-', partition_key='-' * 257)
+
+    c.close()
+    c.join()
+
+
 def test_send_record_size_limit(kinesis, config):
     c = KinesisProducer(config)
     c.send(b'-' * (1024 * 1024 - 1))
@@ -88,3 +114,497 @@ def test_send_with_threadpool_client(kinesis, config):
     records = kinesis.read_records_from_stream()
     assert len(records) == 1
     assert records[0]['Data'] == b'-\n'
+
+
+def test_send_with_partition_key(kinesis, config):
+    c = KinesisProducer(config)
+    c.send(b'1', partition_key='a')
+    c.send(b'2', partition_key='b')
+    c.send(b'3', partition_key='a')
+    c.close()
+    c.join()
+
+    records = kinesis.read_records_from_stream()
+    data = dict((r['PartitionKey'], r['Data']) for r in records)
+    assert data == {'a': b'1\n3\n', 'b': b'2\n'}
+
+
+def test_send_with_shard_partitioner(kinesis, config):
+    config = dict(config, partitioner='round_robin')
+    c = KinesisProducer(config)
+    c.send(b'-')
+    c.close()
+    c.join()
+
+    records = kinesis.read_records_from_stream()
+    assert len(records) == 1
+    assert records[0]['Data'] == b'-\n'
+
+
+def test_send_with_kpl_aggregation(kinesis, config):
+    config = dict(config, aggregation_format='kpl')
+    c = KinesisProducer(config)
+    c.send(b'-\n-')
+    c.send(b'-')
+    c.close()
+    c.join()
+
+    records = kinesis.read_records_from_stream()
+    assert len(records) == 1
+    assert records[0]['Data'].startswith(b'\xf3\x89\x9a\xc2')
+
+
+def test_send_with_batch(kinesis, config):
+    config = dict(config, kinesis_batch_size=10)
+    c = KinesisProducer(config)
+    for _ in range(5):
+        c.send(b'-' * 200)
+    c.close()
+    c.join()
+
+    records = kinesis.read_records_from_stream()
+    assert len(records) == 5
+    assert records[0]['Data'] == b'-' * 200 + b'\n'
+
+
+def test_buffered_bytes(kinesis, config):
+    c = KinesisProducer(config)
+    c.send(b'-' * 50)
+    assert c.buffered_bytes >= 50
+
+    c.close()
+    c.join()
+    assert c.buffered_bytes == 0
+
+
+def test_buffer_full_raise(kinesis, config):
+    config = dict(config, max_buffered_bytes=100, buffer_full_policy='raise')
+    c = KinesisProducer(config)
+
+    with mock.patch.object(c._senders[0], 'run_once'):  # Nothing is sent
+        c.send(b'-' * 100)
+        with pytest.raises(BufferFullError):
+            c.send(b'-')
+
+    c.close()
+    c.join()
+
+
+def test_buffer_full_drop(kinesis, config):
+    config = dict(config, max_buffered_bytes=100, buffer_full_policy='drop')
+    c = KinesisProducer(config)
+
+    with mock.patch.object(c._senders[0], 'run_once'):  # Nothing is sent
+        c.send(b'-' * 100)
+        c.send(b'-')
+    assert c.dropped_records == 1
+
+    c.close()
+    c.join()
+
+    records = kinesis.read_records_from_stream()
+    assert len(records) == 1
+    assert records[0]['Data'] == b'-' * 100 + b'\n'
+
+
+def test_stats(kinesis, config):
+    exporter = mock.Mock()
+    config = dict(config, metrics_exporters=[exporter])
+    c = KinesisProducer(config)
+    c.send(b'-')
+    c.close()
+    c.join()
+
+    stats = c.stats()
+    assert stats['counters']['records_sent'] == 1
+    assert stats['counters']['flushes_forced'] == 1
+    assert stats['counters']['kinesis_records_sent'] == 1
+    assert stats['gauges']['queue_size'] == 0
+    assert stats['gauges']['oldest_record_age'] == 0
+    assert stats['histograms']['put_latency']['count'] == 1
+
+    exporter.assert_called_once_with(stats)
+
+
+def test_send_future(kinesis, config):
+    c = KinesisProducer(config)
+    future1 = c.send(b'-')
+    future2 = c.send(b'-')
+    c.close()
+    c.join()
+
+    records = kinesis.read_records_from_stream()
+    assert future1.result(timeout=1).shard_id == 'shardId-000000000000'
+    assert future1.result() == future2.result()
+    assert future1.result().sequence_number == records[0]['SequenceNumber']
+
+
+def test_send_with_compression(kinesis, config):
+    config = dict(config, compression='gzip')
+    c = KinesisProducer(config)
+    c.send(b'-' * 1000)
+    c.close()
+    c.join()
+
+    records = kinesis.read_records_from_stream()
+    assert len(records) == 1
+    assert gzip.GzipFile(fileobj=io.BytesIO(records[0]['Data'])).read() == \
+        b'-' * 1000 + b'\n'
+
+
+def test_send_many(kinesis, config):
+    c = KinesisProducer(config)
+    futures = c.send_many((b'%i' % i for i in range(5)), chunk_size=2)
+    c.close()
+    c.join()
+
+    records = kinesis.read_records_from_stream()
+    assert len(records) == 1
+    assert records[0]['Data'] == b'0\n1\n2\n3\n4\n'
+    assert len(futures) == 5
+    assert futures[0].result(timeout=1) == futures[4].result(timeout=1)
+    assert c.stats()['counters']['records_sent'] == 5
+
+
+def test_send_many_invalid_record(kinesis, config):
+    c = KinesisProducer(config)
+
+    with pytest.raises(ValueError):
+        c.send_many([b'-', 123])
+
+    with pytest.raises(ValueError):
+        c.send_many([b'-'], partition_key='')
+
+    c.close()
+    c.join()
+
+    records = kinesis.read_records_from_stream()
+    assert len(records) == 0
+
+
+def test_send_with_sender_pipelines(kinesis, config):
+    config = dict(config, sender_count=3)
+    c = KinesisProducer(config)
+    for i in range(10):
+        c.send(b'%i' % i, partition_key='a')
+        c.send(b'-')
+    c.close()
+    c.join()
+
+    records = kinesis.read_records_from_stream()
+    data = [r['Data'] for r in records if r['PartitionKey'] == 'a']
+    assert data == [b''.join(b'%i\n' % i for i in range(10))]
+    assert sum(r['Data'].count(b'-') for r in records) == 10
+    assert c.stats()['counters']['records_sent'] == 20
+
+
+def test_send_failed_records_to_spool(kinesis, config, tmpdir):
+    config = dict(config, spool_directory=str(tmpdir),
+                  spool_replay_interval=0.1)
+    c = KinesisProducer(config)
+
+    with mock.patch.object(c._client.connection, 'put_record',
+                           side_effect=Exception()):
+        future = c.send(b'-')
+        with pytest.raises(Exception):
+            future.result(timeout=1)
+    assert c.stats()['counters']['kinesis_records_spooled'] == 1
+
+    time.sleep(0.3)  # Let the replayer send the spooled record
+    c.close()
+    c.join()
+
+    records = kinesis.read_records_from_stream()
+    assert [r['Data'] for r in records] == [b'-\n']
+    assert c.stats()['counters']['kinesis_records_replayed'] == 1
+    assert c.stats()['gauges']['spooled_bytes'] == 0
+
+
+def test_buffer_full_spool(kinesis, config, tmpdir):
+    config = dict(config, max_buffered_bytes=100, buffer_full_policy='spool',
+                  spool_directory=str(tmpdir))
+    c = KinesisProducer(config)
+
+    with mock.patch.object(c._senders[0], 'run_once'):  # Nothing is sent
+        c.send(b'-' * 100)
+        assert c.send(b'1') is None
+        assert c.send_many([b'2', b'3'], partition_key='a') == [None, None]
+    assert c.stats()['counters']['records_spooled'] == 3
+    assert c.stats()['counters']['kinesis_records_spooled'] == 2
+
+    c.close()
+    c.join()
+
+    records = kinesis.read_records_from_stream()
+    assert [r['Data'] for r in records] == [b'-' * 100 + b'\n']
+    assert len(os.listdir(str(tmpdir))) == 1
+
+
+def test_buffer_full_spool_objects(kinesis, config, tmpdir):
+    config = dict(config, max_buffered_bytes=100, buffer_full_policy='spool',
+                  spool_directory=str(tmpdir), serializer='json')
+    c = KinesisProducer(config)
+
+    with mock.patch.object(c._senders[0], 'run_once'):  # Nothing is sent
+        c.send({'a': 0})
+        assert c.send(object()) is None
+        assert c.send_many([{'a': 1}, object()]) == [None, None]
+    counters = c.stats()['counters']
+    assert counters['records_spooled'] == 1
+    assert counters['records_rejected'] == 2
+
+    c.close()
+    c.join()
+
+
+def test_buffer_full_spool_needs_directory(kinesis, config):
+    config = dict(config, buffer_full_policy='spool')
+    with pytest.raises(ValueError):
+        KinesisProducer(config)
+
+
+def test_warm_connections(kinesis, config):
+    with mock.patch('kinesis_producer.client.Client.warm') as warm:
+        c = KinesisProducer(config=dict(config, kinesis_concurrency=1,
+                                        kinesis_warm_connections=True))
+    c.close()
+    c.join()
+
+    warm.assert_called_once_with()
+
+
+def test_send_to_streams(kinesis, config):
+    boto3.client('kinesis').create_stream(StreamName='OTHER', ShardCount=1)
+    config = dict(config, streams={'OTHER': {'record_delimiter': b'|'}})
+    c = KinesisProducer(config)
+    c.send(b'1')
+    c.send(b'2', stream='OTHER')
+    c.send_many([b'3', b'4'], stream='OTHER')
+    c.close()
+    c.join()
+
+    assert len(c._senders) == 1
+    records = kinesis.read_records_from_stream()
+    assert [r['Data'] for r in records] == [b'1\n']
+    kinesis.stream_name = 'OTHER'
+    records = kinesis.read_records_from_stream()
+    assert [r['Data'] for r in records] == [b'2|3|4|']
+
+
+def test_send_to_unknown_stream(kinesis, config):
+    c = KinesisProducer(config)
+
+    with pytest.raises(ValueError):
+        c.send(b'-', stream='UNKNOWN')
+
+    c.close()
+    c.join()
+
+
+def test_send_objects(kinesis, config):
+    c = KinesisProducer(dict(config, serializer='json'))
+    future = c.send({'a': 1})
+    futures = c.send_many([[1], object()])
+    c.send([2])  # Not a chunk
+    c.close()
+    c.join()
+
+    assert future.exception() is None
+    assert isinstance(futures[1].exception(), TypeError)
+    records = kinesis.read_records_from_stream()
+    assert [r['Data'] for r in records] == [b'{"a":1}\n[1]\n[2]\n']
+    assert c.stats()['counters']['records_rejected'] == 1
+
+
+def test_send_objects_not_bytes(kinesis, config):
+    c = KinesisProducer(dict(config, serializer=lambda obj: u'%s' % obj))
+    future = c.send(1)
+    assert c.flush(timeout=5) == 0
+    assert isinstance(future.exception(), ValueError)
+    c.close()
+    c.join()
+
+
+def test_flush(kinesis, config):
+    c = KinesisProducer(dict(config, buffer_time_limit=60))
+    future = c.send(b'-')
+
+    assert c.flush(timeout=5) == 0
+    assert future.done()
+    assert c.pending_records == 0
+
+    c.send(b'-')
+    c.close()
+    assert c.join() == 0
+    assert len(kinesis.read_records_from_stream()) == 2
+
+
+def test_join_timeout(kinesis, config):
+    c = KinesisProducer(dict(config, kinesis_concurrency=2))
+    done = threading.Event()
+    with mock.patch.object(c._client.connection, 'put_record',
+                           side_effect=lambda **kwargs: done.wait(5)):
+        c.send(b'-')
+        started_at = time.time()
+        assert c.join(timeout=0.2) == 1
+        assert time.time() - started_at < 1
+        done.set()
+
+
+@pytest.mark.parametrize('concurrency', [1, 2])
+def test_join_timeout_sender(kinesis, config, concurrency):
+    c = KinesisProducer(dict(config, kinesis_concurrency=concurrency))
+    sender = c._senders[0]
+    run_once = sender.run_once
+    done = threading.Event()
+
+    def slow_run_once(*args, **kwargs):
+        done.wait(5)
+        return run_once(*args, **kwargs)
+
+    with mock.patch.object(sender, 'run_once', side_effect=slow_run_once):
+        future = c.send(b'-')
+        assert c.join(timeout=0.2) == 1
+        done.set()
+        sender.join(5)
+
+    assert isinstance(future.exception(5), DeliveryTimeoutError)
+    assert c._pending.count == 0
+
+
+def test_import_without_boto3():
+    code = ('import sys, kinesis_producer; '
+            'print("boto3" in sys.modules or "botocore" in sys.modules)')
+    output = subprocess.check_output([sys.executable, '-c', code])
+    assert output.strip() == b'False'
+
+
+def test_lazy_start(kinesis, config):
+    threads = threading.active_count()
+    c = KinesisProducer(dict(config, lazy_start=True, kinesis_concurrency=1))
+
+    assert c._client is None
+    assert threading.active_count() == threads
+
+    c.send(b'-')
+    assert c._client is not None
+    c.close()
+    assert c.join() == 0
+    assert len(kinesis.read_records_from_stream()) == 1
+
+
+def test_lazy_start_warmup(kinesis, config):
+    c = KinesisProducer(dict(config, lazy_start=True, kinesis_concurrency=1))
+    with mock.patch('kinesis_producer.client.Client.warm') as warm:
+        c.warmup()
+    warm.assert_called_once_with()
+    assert len(c._senders) == 1
+    c.close()
+    c.join()
+
+
+def test_lazy_start_join_unstarted(kinesis, config):
+    c = KinesisProducer(dict(config, lazy_start=True))
+    c.close()
+    assert c.join() == 0
+    assert c._client is None
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+def test_fork(kinesis, config):
+    c = KinesisProducer(dict(config, buffer_time_limit=60))
+    c.send(b'parent')  # Aggregated in the parent at fork time
+
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            future = c.send(b'child')
+            assert c.join(timeout=5) == 0
+            assert future.exception() is None
+            records = kinesis.read_records_from_stream()
+            if [r['Data'] for r in records] == [b'child\n']:
+                status = 0
+        finally:
+            os._exit(status)
+
+    _, status = os.waitpid(pid, 0)
+    assert status == 0
+    c.close()
+    assert c.join() == 0
+    records = kinesis.read_records_from_stream()
+    assert [r['Data'] for r in records] == [b'parent\n']
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+def test_fork_spool(kinesis, config, tmpdir):
+    config = dict(config, max_buffered_bytes=100, buffer_full_policy='spool',
+                  spool_directory=str(tmpdir), buffer_time_limit=60)
+    c = KinesisProducer(config)
+
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            c.send(b'-' * 100)
+            assert c.send(b'child') is None  # Spooled
+            assert c.join(timeout=5) == 0
+            if os.listdir(str(tmpdir)) == ['pid-%i' % os.getpid()]:
+                status = 0
+        finally:
+            os._exit(status)
+
+    _, status = os.waitpid(pid, 0)
+    assert status == 0
+    c.close()
+    c.join()
+
+    c = KinesisProducer(config)
+    assert c._replayer.replay()
+    c.close()
+    c.join()
+    records = kinesis.read_records_from_stream()
+    assert [r['Data'] for r in records] == [b'child\n']
+    assert os.listdir(str(tmpdir)) == []
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+def test_fork_without_send(kinesis, config, tmpdir):
+    c = KinesisProducer(dict(config, spool_directory=str(tmpdir)))
+    closed = KinesisProducer(config)
+    closed.close()
+    closed.join()
+    assert c in producer_module._producers
+    assert closed not in producer_module._producers
+
+    parent = os.getpid()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            if c._pid != parent and closed._pid == parent:  # Not reset
+                status = 0
+        finally:
+            os._exit(status)
+
+    _, status = os.waitpid(pid, 0)
+    assert status == 0
+    assert os.listdir(str(tmpdir)) == []  # No spool for the child
+    c.close()
+    c.join()
+
+
+def test_send_with_priority(kinesis, config):
+    c = KinesisProducer(dict(config, buffer_time_limit=60,
+                             priority_lanes={1: {'buffer_time_limit': 0}}))
+    future = c.send(b'urgent', priority=1)
+    c.send(b'bulk')
+
+    future.result(timeout=5)  # Without waiting for the bulk records
+    with pytest.raises(ValueError):
+        c.send(b'-', priority=2)
+    c.close()
+    c.join()
+
+    records = kinesis.read_records_from_stream()
+    assert [r['Data'] for r in records] == [b'urgent\n', b'bulk\n']
@@ -0,0 +1,166 @@
+import threading
+
+import mock
+import pytest
+
+from conftest import shard
+from kinesis_producer.ratelimit import (TokenBucket, Limit, RateLimiter,
+                                        ShardRateLimiter, entry_hash_key,
+                                        get_rate_limiter)
+
+
+CONFIG = {'stream_name': 'STREAM_NAME'}
+
+HALF = 2 ** 127
+
+SHARDS = {'Shards': [
+    shard('shard-1', 0, HALF - 1),
+    shard('shard-2', HALF, 2 ** 128 - 1),
+]}
+
+
+def entry(data, partition_key='a', explicit_hash_key=None):
+    entry = {'Data': data, 'PartitionKey': partition_key}
+    if explicit_hash_key is not None:
+        entry['ExplicitHashKey'] = str(explicit_hash_key)
+    return entry
+
+
+def test_token_bucket():
+    bucket = TokenBucket(100)
+    now = bucket._updated_at
+
+    assert bucket.reserve(100, now) == 0
+    assert bucket.reserve(50, now) == pytest.approx(0.5)
+    assert bucket.reserve(50, now + 1) == pytest.approx(0.)
+
+
+def test_token_bucket_capacity():
+    bucket = TokenBucket(100)
+    now = bucket._updated_at
+
+    assert bucket.reserve(100, now + 10) == 0
+    assert bucket.reserve(100, now + 10) == pytest.approx(1)
+
+
+def test_limit_aimd():
+    limit = Limit(max_bytes=100, max_records=10)
+
+    limit.throttled()
+    assert limit.factor == pytest.approx(0.8)
+    assert limit._bytes.rate == pytest.approx(80)
+    assert limit._records.rate == pytest.approx(8)
+
+    limit.succeeded()
+    assert limit.factor == pytest.approx(0.81)
+
+    for _ in range(100):
+        limit.throttled()
+    assert limit.factor == Limit.MIN_FACTOR
+
+    for _ in range(1000):
+        limit.succeeded()
+    assert limit.factor == 1.0
+
+
+def test_limit_records():
+    limit = Limit(max_records=10)
+    now = limit._records._updated_at
+
+    assert limit.reserve(10 ** 9, 10, now) == 0
+    assert limit.reserve(0, 5, now) == pytest.approx(0.5)
+
+
+def test_stream_rate_limiter():
+    limiter = RateLimiter(max_bytes=100)
+
+    assert limiter.reserve([entry(b'-' * 49), entry(b'-' * 49)]) == 0
+    assert limiter.reserve([entry(b'-' * 49)]) > 0.45
+
+    limiter.throttled([])
+    assert limiter._limit.factor == 1.0
+    limiter.throttled([entry(b'-')])
+    assert limiter._limit.factor < 1.0
+
+
+def test_entry_hash_key():
+    assert entry_hash_key(entry(b'-', explicit_hash_key=42)) == 42
+    assert entry_hash_key(entry(b'-', 'a')) == \
+        0x0cc175b9c0f1b6a831c399e269772661  # md5('a')
+
+
+def test_shard_rate_limiter():
+    connection = mock.Mock()
+    connection.list_shards.return_value = SHARDS
+    limiter = ShardRateLimiter(connection, CONFIG)
+
+    shard1 = entry(b'-' * (1024 * 1024 - 1), explicit_hash_key=0)
+    shard2 = entry(b'-' * 1024, explicit_hash_key=HALF)
+    assert limiter.reserve([shard1]) == 0
+    assert limiter.reserve([shard2]) == 0
+    assert limiter.reserve([shard1]) > 0.9
+
+    limiter.throttled([shard2])
+    factors = [limit.factor for limit in limiter._shard_limits]
+    assert factors == [1.0, pytest.approx(0.8)]
+    connection.list_shards.assert_called_once_with(StreamName='STREAM_NAME')
+
+
+def test_shard_rate_limiter_keeps_limits_on_refresh():
+    connection = mock.Mock()
+    connection.list_shards.return_value = SHARDS
+    limiter = ShardRateLimiter(connection, CONFIG)
+
+    limiter.throttled([entry(b'-', explicit_hash_key=0)])
+    limiter.refresh()
+    assert limiter._shard_limits[0].factor == pytest.approx(0.8)
+
+
+def test_shard_rate_limiter_refresh_outside_lock():
+    connection = mock.Mock()
+    connection.list_shards.return_value = SHARDS
+    limiter = ShardRateLimiter(connection, CONFIG)
+    limiter.reserve([entry(b'-')])
+
+    listing = threading.Event()
+    release = threading.Event()
+
+    def list_shards(**kwargs):
+        listing.set()
+        release.wait(5)
+        return SHARDS
+
+    connection.list_shards.side_effect = list_shards
+    limiter._refreshed_at -= limiter.refresh_interval
+    refresh = threading.Thread(target=limiter.reserve, args=([entry(b'-')],))
+    refresh.start()
+    assert listing.wait(5)
+
+    assert limiter.reserve([entry(b'-')]) == 0  # Not blocked by ListShards
+    assert refresh.is_alive()
+    release.set()
+    refresh.join()
+    assert connection.list_shards.call_count == 2
+
+
+def test_shard_rate_limiter_list_shards_error():
+    connection = mock.Mock()
+    connection.list_shards.side_effect = Exception()
+    limiter = ShardRateLimiter(connection, CONFIG)
+
+    assert limiter.reserve([entry(b'-' * 1024 * 1024)] * 10) == 0
+
+
+def test_get_rate_limiter():
+    connection = mock.Mock()
+    assert get_rate_limiter(connection, CONFIG) is None
+
+    config = dict(CONFIG, rate_limit='shard')
+    assert isinstance(get_rate_limiter(connection, config), ShardRateLimiter)
+
+    config = dict(CONFIG, rate_limit='stream', rate_limit_records=10)
+    limiter = get_rate_limiter(connection, config)
+    assert limiter._limit.max_records == 10
+
+    with pytest.raises(ValueError):
+        get_rate_limiter(connection, dict(CONFIG, rate_limit='unknown'))
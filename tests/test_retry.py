@@ -0,0 +1,122 @@
+import threading
+import time
+
+import botocore.exceptions
+import mock
+
+from kinesis_producer.metrics import Metrics
+from kinesis_producer.retry import (RetryPolicy, RetryScheduler,
+                                    CONNECTION_ERROR, get_error_code)
+
+
+def client_error(code):
+    return botocore.exceptions.ClientError({'Error': {'Code': code}}, None)
+
+
+def test_get_error_code():
+    assert get_error_code(client_error('InternalFailure')) == \
+        'InternalFailure'
+    assert get_error_code({'ErrorCode': 'InternalFailure'}) == \
+        'InternalFailure'
+    assert get_error_code({'ShardId': 'shardId-000000000000'}) is None
+    assert get_error_code(Exception()) is None
+
+    exc = botocore.exceptions.EndpointConnectionError(endpoint_url='URL')
+    assert get_error_code(exc) == CONNECTION_ERROR
+    exc = botocore.exceptions.ReadTimeoutError(endpoint_url='URL')
+    assert get_error_code(exc) == CONNECTION_ERROR
+
+
+def test_retryable_errors():
+    policy = RetryPolicy(3)
+    assert policy.is_retryable('ProvisionedThroughputExceededException')
+    assert policy.is_retryable('KMSThrottlingException')
+    assert policy.is_retryable(CONNECTION_ERROR)
+    assert not policy.is_retryable('ValidationException')
+    assert not policy.is_retryable(None)
+
+    policy = RetryPolicy.from_config({'kinesis_max_retries': 3,
+                                      'retryable_errors': ['SomeError']})
+    assert policy.is_retryable('SomeError')
+    assert not policy.is_retryable('InternalFailure')
+
+
+def test_max_retries():
+    policy = RetryPolicy(2)
+    assert policy.can_retry(0)
+    assert policy.can_retry(1)
+    assert not policy.can_retry(2)
+
+
+def test_retry_budget():
+    policy = RetryPolicy(10, budget=2)
+    assert policy.can_retry(0)
+    assert policy.can_retry(0)
+    assert not policy.can_retry(0)
+
+    policy._window_started_at -= 1
+    assert policy.can_retry(0)
+
+
+def test_full_jitter_backoff():
+    policy = RetryPolicy(10, base=1, cap=5)
+    delays = [policy.backoff(2) for _ in range(100)]
+    assert all(0 <= delay <= 4 for delay in delays)
+    assert len(set(delays)) > 1
+    assert all(0 <= policy.backoff(10) <= 5 for _ in range(100))
+
+
+def test_retry_delay():
+    policy = RetryPolicy(1, base=1, cap=1)
+    metrics = Metrics()
+
+    assert 0 <= policy.retry_delay(
+        'ProvisionedThroughputExceededException', 0, metrics) <= 1
+    assert policy.retry_delay('ValidationException', 0, metrics) is None
+    assert policy.retry_delay('InternalFailure', 1, metrics) is None
+    assert metrics.snapshot()['counters'] == {'put_retries': 1,
+                                              'put_throttles': 1}
+
+
+def test_scheduler():
+    scheduler = RetryScheduler()
+    scheduler.start()
+    calls = []
+    done = threading.Event()
+
+    scheduler.schedule(0.1, calls.append, 'late')
+    scheduler.schedule(0.05, calls.append, 'early')
+    scheduler.schedule(0.15, done.set)
+    assert calls == []
+
+    assert done.wait(1)
+    assert calls == ['early', 'late']
+    scheduler.close()
+    scheduler.join(1)
+    assert not scheduler.is_alive()
+
+
+def test_scheduler_error():
+    scheduler = RetryScheduler()
+    scheduler.start()
+    done = threading.Event()
+
+    scheduler.schedule(0, mock.Mock(side_effect=Exception()))
+    scheduler.schedule(0, done.set)
+    assert done.wait(1)
+    scheduler.close()
+
+
+def test_scheduler_close_drops_pending():
+    scheduler = RetryScheduler()
+    scheduler.start()
+    func = mock.Mock()
+
+    scheduler.schedule(10, func, 'late')
+    scheduler.schedule(5, func, 'early')
+    started_at = time.time()
+    assert scheduler.close() == [(func, ('early',)), (func, ('late',))]
+    scheduler.join(1)
+    assert time.time() - started_at < 1
+    assert not func.called
+    assert not scheduler.schedule(0, func)
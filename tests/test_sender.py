@@ -1,10 +1,16 @@
+import time
+
 from six.moves import queue
 
 import mock
 
-from kinesis_producer.sender import Sender
+from kinesis_producer.sender import FLUSH, LaneQueue, Sender, lane_key
 from kinesis_producer.accumulator import RecordAccumulator
 from kinesis_producer.buffer import RawBuffer
+from kinesis_producer.budget import MemoryBudget
+from kinesis_producer.futures import (PendingCounter, RecordFuture,
+                                      RecordMetadata)
+from kinesis_producer.serializer import JsonSerializer
 
 
 def partitioner(record):
@@ -38,7 +44,8 @@ def test_flush(config):
 
     sender.flush()
     expected_record = (b'-\n', 4)
-    client.put_record.assert_called_once_with(expected_record)
+    client.put_record.assert_called_once_with(expected_record,
+                                              callback=None, stream=None)
 
 
 def test_accumulate(config):
@@ -49,12 +56,12 @@ def test_accumulate(config):
     sender = Sender(queue=q, accumulator=accumulator,
                     client=client, partitioner=partitioner)
 
-    sender.run_once()
+    sender.run_once(timeout=0)
     assert not accumulator.has_records()
 
-    q.put(b'-')
+    q.put((b'-', None, None, None))
 
-    sender.run_once()
+    sender.run_once(timeout=0)
     assert accumulator.has_records()
 
 
@@ -67,7 +74,7 @@ def test_flush_if_ready(config):
                     client=client, partitioner=partitioner)
 
     accumulator.try_append(b'-' * 200)
-    sender.run_once()
+    sender.run_once(timeout=0)
 
     assert client.put_record.called
     assert not accumulator.has_records()
@@ -82,8 +89,439 @@ def test_flush_if_full(config):
                     client=client, partitioner=partitioner)
 
     accumulator.try_append(b'-' * (1024 * 1024 - 1))
-    q.put(b'-' * 50)
+    q.put((b'-' * 50, None, None, None))
+    sender.run_once(timeout=0)
+
+    assert client.put_record.called
+    assert accumulator.has_records()
+
+
+def test_batch(config):
+    q = queue.Queue()
+    accumulator = RecordAccumulator(RawBuffer, config)
+    client = mock.Mock()
+
+    sender = Sender(queue=q, accumulator=accumulator,
+                    client=client, partitioner=lambda record: 'key',
+                    batch_size=2)
+
+    q.put((b'-' * 200, None, None, None))
+    q.put((b'-' * 200, None, None, None))
+    q.put((b'-', None, None, None))
+    sender.run_once(timeout=0)
+
+    assert not client.put_record.called
+    assert not client.put_records.called
+
+    sender.run_once(timeout=0)
+
+    expected_records = [(b'-' * 200 + b'\n', 'key')] * 2
+    client.put_records.assert_called_once_with(expected_records,
+                                               callback=None, stream=None)
+
+
+def test_batch_sent_when_queue_is_empty(config):
+    q = queue.Queue()
+    accumulator = RecordAccumulator(RawBuffer, config)
+    client = mock.Mock()
+
+    sender = Sender(queue=q, accumulator=accumulator,
+                    client=client, partitioner=lambda record: 'key',
+                    batch_size=10)
+
+    accumulator.try_append(b'-' * 200)
+    sender.run_once(timeout=0)
+
+    client.put_records.assert_called_once_with(
+        [(b'-' * 200 + b'\n', 'key')], callback=None, stream=None)
+
+
+def test_batch_size_limit(config):
+    q = queue.Queue()
+    accumulator = RecordAccumulator(RawBuffer, config)
+    client = mock.Mock()
+
+    sender = Sender(queue=q, accumulator=accumulator,
+                    client=client, partitioner=lambda record: 'key',
+                    batch_size=500)
+
+    for _ in range(6):
+        q.put((b'-' * (1024 * 1024 - 1), None, None, None))
+    for _ in range(6):
+        sender.run_once(timeout=0)
+
+    batch = client.put_records.call_args_list[0][0][0]
+    assert len(batch) == 4
+
+
+def test_flush_explicit_hash_key(config):
+    q = queue.Queue()
+    accumulator = RecordAccumulator(RawBuffer, config)
+    client = mock.Mock()
+
+    sender = Sender(queue=q, accumulator=accumulator, client=client,
+                    partitioner=lambda record: ('key', '42'))
+
+    accumulator.try_append(b'-')
+    sender.flush()
+
+    client.put_record.assert_called_once_with((b'-\n', 'key', '42'),
+                                              callback=None, stream=None)
+
+
+def test_budget(config):
+    q = queue.Queue()
+    accumulator = RecordAccumulator(RawBuffer, config)
+    client = mock.Mock()
+    budget = MemoryBudget()
+
+    sender = Sender(queue=q, accumulator=accumulator, client=client,
+                    partitioner=partitioner, budget=budget)
+
+    budget.acquire(50)
+    q.put((b'-' * 50, None, None, None))
+    sender.run_once(timeout=0)
+    assert budget.used == 51  # Accumulated with the delimiter
+
+    sender.flush()
+    assert budget.used == 51  # In flight
+    callback = client.put_record.call_args[1]['callback']
+
+    callback({'ShardId': 'shardId-000000000000', 'SequenceNumber': '1'})
+    assert budget.used == 0
+
+
+def test_budget_batch(config):
+    q = queue.Queue()
+    accumulator = RecordAccumulator(RawBuffer, config)
+    client = mock.Mock()
+    budget = MemoryBudget()
+
+    sender = Sender(queue=q, accumulator=accumulator, client=client,
+                    partitioner=lambda record: 'key', batch_size=10,
+                    budget=budget)
+
+    budget.acquire(200)
+    q.put((b'-' * 200, None, None, None))
+    sender.run_once(timeout=0)
+    assert budget.used == 201
+
+    client.put_records.call_args[1]['callback']([Exception()])
+    assert budget.used == 0
+
+
+def test_futures(config):
+    q = queue.Queue()
+    accumulator = RecordAccumulator(RawBuffer, config)
+    client = mock.Mock()
+
+    sender = Sender(queue=q, accumulator=accumulator,
+                    client=client, partitioner=partitioner)
+
+    futures = [RecordFuture(), RecordFuture()]
+    for future in futures:
+        q.put((b'-', None, future, None))
+        sender.run_once(timeout=0)
+    sender.flush()
+
+    callback = client.put_record.call_args[1]['callback']
+    assert not futures[0].done()
+
+    callback({'ShardId': 'shardId-000000000000', 'SequenceNumber': '1'})
+    expected = RecordMetadata('shardId-000000000000', '1')
+    assert [future.result() for future in futures] == [expected, expected]
+
+
+def test_futures_batch(config):
+    q = queue.Queue()
+    accumulator = RecordAccumulator(RawBuffer, config)
+    client = mock.Mock()
+
+    sender = Sender(queue=q, accumulator=accumulator,
+                    client=client, partitioner=lambda record: 'key',
+                    batch_size=10)
+
+    futures = [RecordFuture(), RecordFuture()]
+    q.put((b'-', 'a', futures[0], None))
+    q.put((b'-', 'b', futures[1], None))
+    sender.run_once(timeout=0)
+    sender.run_once(timeout=0)
+    sender.flush()
+    sender.send_batch()
+
+    error = Exception()
+    callback = client.put_records.call_args[1]['callback']
+    callback([{'ShardId': 'shardId-000000000000', 'SequenceNumber': '1'},
+              error])
+
+    assert futures[0].result().sequence_number == '1'
+    assert futures[1].exception() is error
+
+
+def test_accumulate_many(config):
+    q = queue.Queue()
+    accumulator = RecordAccumulator(RawBuffer, config)
+    client = mock.Mock()
+    budget = MemoryBudget()
+
+    sender = Sender(queue=q, accumulator=accumulator, client=client,
+                    partitioner=partitioner, budget=budget)
+
+    futures = [RecordFuture(), RecordFuture()]
+    budget.acquire(2)
+    q.put(([b'1', b'2'], 'a', futures, None))
+
+    sender.run_once(timeout=0)
+    assert q.unfinished_tasks == 0
+    assert budget.used == 4
+
+    sender.flush()
+    client.put_record.assert_called_once_with((b'1\n2\n', 'a'),
+                                              callback=mock.ANY, stream=None)
+
+
+def test_wait_until_deadline(config):
+    q = queue.Queue()
+    accumulator = RecordAccumulator(RawBuffer, config)
+    client = mock.Mock()
+
+    sender = Sender(queue=q, accumulator=accumulator,
+                    client=client, partitioner=partitioner)
+
+    q.put((b'-', None, None, None))
     sender.run_once()
+    assert not client.put_record.called
 
+    started_at = time.time()
+    sender.run_once()  # Wait for the buffer_time_limit
+    assert time.time() - started_at >= 0.1
     assert client.put_record.called
+
+
+def test_close_wakes_up_sender(config):
+    q = queue.Queue()
+    accumulator = RecordAccumulator(RawBuffer, config)
+    client = mock.Mock()
+
+    sender = Sender(queue=q, accumulator=accumulator,
+                    client=client, partitioner=partitioner)
+    sender.start()
+    time.sleep(0.1)  # Idle, waiting for records
+
+    started_at = time.time()
+    sender.close()
+    sender.join()
+    assert time.time() - started_at < 0.1
+    assert q.unfinished_tasks == 0
+
+
+def test_spool_failed_records(config):
+    q = queue.Queue()
+    accumulator = RecordAccumulator(RawBuffer, config)
+    client = mock.Mock()
+    spool = mock.Mock()
+
+    sender = Sender(queue=q, accumulator=accumulator, client=client,
+                    partitioner=partitioner, spool=spool)
+
+    accumulator.try_append(b'-')
+    sender.flush()
+    client.put_record.call_args[1]['callback']({'ShardId': 'shardId-0'})
+    assert not spool.append.called
+
+    accumulator.try_append(b'-')
+    sender.flush()
+    client.put_record.call_args[1]['callback'](Exception())
+    spool.append.assert_called_once_with((b'-\n', 4), None)
+
+
+def test_spool_failed_batch_records(config):
+    q = queue.Queue()
+    accumulator = RecordAccumulator(RawBuffer, config)
+    client = mock.Mock()
+    spool = mock.Mock()
+
+    sender = Sender(queue=q, accumulator=accumulator, client=client,
+                    partitioner=partitioner, batch_size=10, spool=spool)
+
+    accumulator.try_append(b'1', 'a')
+    accumulator.try_append(b'2', 'b')
+    sender.flush()
+    sender.send_batch()
+    client.put_records.call_args[1]['callback']([{}, Exception()])
+
+    spool.append.assert_called_once_with((b'2\n', 'b'), None)
+
+
+def test_streams(config):
+    q = queue.Queue()
+    accumulator = RecordAccumulator(RawBuffer, config)
+    other_accumulator = RecordAccumulator(RawBuffer, config)
+    client = mock.Mock()
+
+    sender = Sender(queue=q, accumulator=accumulator,
+                    client=client, partitioner=partitioner)
+    sender.add_stream('other', other_accumulator,
+                      partitioner=lambda record: 'key', batch_size=10)
+
+    q.put((b'1', None, None, None))
+    q.put((b'2', None, None, 'other'))
+    sender.run_once(timeout=0)
+    sender.run_once(timeout=0)
     assert accumulator.has_records()
+    assert other_accumulator.has_records()
+
+    sender.flush()
+    sender.send_batch()
+    client.put_record.assert_called_once_with((b'1\n', 4), callback=None,
+                                              stream=None)
+    client.put_records.assert_called_once_with([(b'2\n', 'key')],
+                                               callback=None, stream='other')
+
+
+def test_adaptive(config):
+    q = queue.Queue()
+    accumulator = RecordAccumulator(RawBuffer, dict(
+        config, adaptive_target_latency=1))
+    client = mock.Mock()
+
+    sender = Sender(queue=q, accumulator=accumulator,
+                    client=client, partitioner=partitioner)
+
+    accumulator.try_append(b'-')
+    sender.flush()
+
+    callback = client.put_record.call_args[1]['callback']
+    time.sleep(0.1)
+    callback({'ShardId': 'shardId-0', 'SequenceNumber': '1'})
+    assert accumulator.adaptive.put_latency > 0.01
+
+
+def test_serializer(config):
+    q = queue.Queue()
+    accumulator = RecordAccumulator(RawBuffer, config)
+    client = mock.Mock()
+    budget = MemoryBudget()
+    serializer = JsonSerializer()
+
+    sender = Sender(queue=q, accumulator=accumulator,
+                    client=client, partitioner=partitioner, budget=budget,
+                    serializer=serializer)
+
+    futures = [RecordFuture() for _ in range(3)]
+    budget.acquire(3 * serializer.SIZE_ESTIMATE)
+    q.put(([{'a': 1}, object(), 'x' * (1024 * 1024)], None, futures, None))
+    sender.run_once(timeout=0)
+
+    assert budget.used == len(b'{"a":1}\n')
+    assert q.unfinished_tasks == 0
+    assert isinstance(futures[1].exception(), TypeError)
+    assert isinstance(futures[2].exception(), ValueError)
+
+    budget.acquire(serializer.SIZE_ESTIMATE)
+    q.put(([[1, 2]], None, [futures[0]], None))
+    sender.run_once(timeout=0)
+    sender.flush()
+
+    client.put_record.assert_called_once_with(
+        (b'{"a":1}\n[1,2]\n', 4), callback=mock.ANY, stream=None)
+
+
+def test_accumulate_error(config):
+    q = queue.Queue()
+    accumulator = RecordAccumulator(RawBuffer, config)
+    client = mock.Mock()
+    pending = PendingCounter()
+
+    sender = Sender(queue=q, accumulator=accumulator, client=client,
+                    partitioner=partitioner, pending=pending)
+
+    futures = [RecordFuture() for _ in range(3)]
+    pending.add(3)
+    q.put((u'-', None, futures[0], None))  # Not bytes
+    q.put(([b'-', u'-'], None, futures[1:], None))
+    sender.run_once(timeout=0)
+    sender.run_once(timeout=0)
+
+    assert q.unfinished_tasks == 0
+    assert [type(future.exception()) for future in futures] == \
+        [TypeError] * 3
+    assert pending.count == 0
+
+    future = RecordFuture()  # The sender goes on
+    pending.add()
+    q.put((b'+', None, future, None))
+    sender.run_once(timeout=0)
+    sender.flush()
+    client.put_record.call_args[1]['callback'](
+        {'ShardId': 'shardId-000000000000', 'SequenceNumber': '1'})
+    assert future.exception() is None
+    assert pending.count == 0
+
+
+def test_request_flush(config):
+    q = queue.Queue()
+    accumulator = RecordAccumulator(RawBuffer, dict(config,
+                                                    buffer_time_limit=60))
+    client = mock.Mock()
+
+    sender = Sender(queue=q, accumulator=accumulator,
+                    client=client, partitioner=partitioner)
+
+    q.put((b'-', None, None, None))
+    sender.run_once(timeout=0)
+    assert not client.put_record.called
+
+    sender.request_flush()
+    sender.run_once(timeout=0)
+    assert client.put_record.called
+    assert not accumulator.has_records()
+
+
+def test_join_timeout(config):
+    q = queue.Queue()
+    accumulator = RecordAccumulator(RawBuffer, config)
+    client = mock.Mock()
+
+    sender = Sender(queue=q, accumulator=accumulator,
+                    client=client, partitioner=partitioner)
+
+    assert not sender.join(timeout=0.01)  # Not started
+
+
+def test_lane_queue():
+    q = LaneQueue(min_priority=-1)
+    q.put((b'1', None, None, None))
+    q.put(FLUSH)
+    q.put((b'2', None, None, lane_key(None, 1)))
+    q.put((b'3', None, None, lane_key('other', -1)))
+    q.put((b'4', None, None, lane_key('other', 1)))
+
+    assert q.qsize() == 5
+    assert [q.get()[0] for _ in range(3)] == [b'2', b'4', b'1']
+    assert q.get() is FLUSH
+    assert q.get()[0] == b'3'
+
+
+def test_priority_lanes(config):
+    q = LaneQueue()
+    accumulator = RecordAccumulator(RawBuffer, config)
+    urgent_accumulator = RecordAccumulator(RawBuffer, config)
+    client = mock.Mock()
+
+    sender = Sender(queue=q, accumulator=accumulator,
+                    client=client, partitioner=partitioner)
+    sender.add_stream(None, urgent_accumulator, partitioner, priority=1)
+
+    q.put((b'1', None, None, None))
+    q.put((b'2', None, None, lane_key(None, 1)))
+    sender.run_once(timeout=0)
+    assert urgent_accumulator.has_records()
+    assert not accumulator.has_records()
+
+    sender.run_once(timeout=0)
+    sender.flush()
+    assert client.put_record.call_args_list == [
+        mock.call((b'2\n', 4), callback=None, stream=None, priority=1),
+        mock.call((b'1\n', 4), callback=None, stream=None),
+    ]
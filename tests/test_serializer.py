@@ -0,0 +1,51 @@
+import pytest
+
+from kinesis_producer.serializer import (SERIALIZERS, JsonSerializer,
+                                         get_serializer)
+
+
+@pytest.fixture(params=sorted(SERIALIZERS))
+def serializer(request):
+    return SERIALIZERS[request.param]()
+
+
+def test_get_serializer():
+    assert get_serializer({}) is None
+    assert isinstance(get_serializer({'serializer': 'json'}),
+                      JsonSerializer)
+
+    serializer = get_serializer({'serializer': lambda obj: b'-'})
+    assert serializer.dumps_many([1, 2]) == [b'-', b'-']
+
+    with pytest.raises(ValueError):
+        get_serializer({'serializer': 'unknown'})
+
+
+def test_dumps(serializer):
+    record = serializer.dumps({'a': [1, 'b']})
+    assert isinstance(record, bytes)
+    assert serializer.dumps_many([{'a': [1, 'b']}] * 2) == [record] * 2
+
+
+def test_dumps_error(serializer):
+    with pytest.raises(TypeError):
+        serializer.dumps(object())
+
+
+def test_serialize(serializer):
+    record = serializer.dumps(1)
+    records = serializer.serialize([1, object(), [0] * 100], 10)
+    assert records[0] == record
+    assert isinstance(records[1], TypeError)
+    assert isinstance(records[2], ValueError)
+
+
+def test_serialize_not_bytes():
+    serializer = get_serializer({'serializer': str})
+    records = serializer.serialize([1], 10)
+    assert isinstance(records[0], ValueError)
+
+
+def test_json():
+    assert JsonSerializer().dumps({'a': [1, u'\xe9']}) == \
+        b'{"a":[1,"\\u00e9"]}'
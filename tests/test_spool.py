@@ -0,0 +1,186 @@
+import os
+
+import mock
+import pytest
+
+from kinesis_producer.spool import (Spool, SpoolReplayer, encode_record,
+                                    read_segment, get_spool)
+
+
+def test_encode_record(tmpdir):
+    path = str(tmpdir.join('segment.log'))
+    records = [(b'data', 'key'), (b'', u'k\xe9y', '42')]
+    with open(path, 'wb') as f:
+        for record in records:
+            f.write(encode_record(record))
+
+    assert [record for _, record, _ in read_segment(path)] == records
+
+
+def test_encode_record_stream(tmpdir):
+    path = str(tmpdir.join('segment.log'))
+    with open(path, 'wb') as f:
+        f.write(encode_record((b'1', 'k', '42'), 'other'))
+
+    assert [(record, stream) for _, record, stream in read_segment(path)] == \
+        [((b'1', 'k', '42'), 'other')]
+
+
+def test_read_segment_offset(tmpdir):
+    path = str(tmpdir.join('segment.log'))
+    with open(path, 'wb') as f:
+        f.write(encode_record((b'1', 'k')))
+        f.write(encode_record((b'2', 'k')))
+
+    offset, _, _ = next(read_segment(path))
+    assert [record for _, record, _ in read_segment(path, offset)] == \
+        [(b'2', 'k')]
+
+
+def test_read_segment_truncated(tmpdir):
+    path = str(tmpdir.join('segment.log'))
+    with open(path, 'wb') as f:
+        f.write(encode_record((b'1', 'k')))
+        f.write(encode_record((b'2', 'k'))[:-1])
+
+    assert [record for _, record, _ in read_segment(path)] == [(b'1', 'k')]
+
+
+def test_append(tmpdir):
+    spool = Spool(str(tmpdir))
+    assert spool.append((b'1', 'k'))
+    assert spool.append((b'2', 'k'))
+    assert spool.oldest_segment() is None  # Still active
+
+    spool.rotate()
+    path = spool.oldest_segment()
+    assert [record for _, record, _ in read_segment(path)] == \
+        [(b'1', 'k'), (b'2', 'k')]
+    assert spool.size == os.path.getsize(path)
+
+    spool.remove(path)
+    assert spool.oldest_segment() is None
+    assert spool.size == 0
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_segment_size(tmpdir):
+    spool = Spool(str(tmpdir), segment_size=100)
+    for _ in range(3):
+        spool.append((b'-' * 60, 'k'))
+
+    assert len(os.listdir(str(tmpdir))) == 2
+    assert spool.oldest_segment() is not None
+
+
+def test_max_bytes(tmpdir):
+    spool = Spool(str(tmpdir), max_bytes=100)
+    assert spool.append((b'-' * 60, 'k'))
+    assert not spool.append((b'-' * 60, 'k'))
+
+
+def test_fsync_policy(tmpdir):
+    with mock.patch('os.fsync') as fsync:
+        spool = Spool(str(tmpdir), fsync='always')
+        spool.append((b'-', 'k'))
+        assert fsync.call_count == 1
+
+        spool = Spool(str(tmpdir.join('never')), fsync='never')
+        spool.append((b'-', 'k'))
+        spool.rotate()
+        assert fsync.call_count == 1
+
+    with pytest.raises(ValueError):
+        Spool(str(tmpdir), fsync='sometimes')
+
+
+def test_restart(tmpdir):
+    spool = Spool(str(tmpdir))
+    spool.append((b'1', 'k'))
+    spool.close()
+
+    spool = Spool(str(tmpdir))
+    spool.append((b'2', 'k'))
+    spool.close()
+
+    spool = Spool(str(tmpdir))
+    records = []
+    while spool.oldest_segment():
+        path = spool.oldest_segment()
+        records.extend(record for _, record, _ in read_segment(path))
+        spool.remove(path)
+    assert records == [(b'1', 'k'), (b'2', 'k')]
+
+
+def test_adopt_orphans(tmpdir):
+    directory = str(tmpdir)
+    for path, data in (('pid-1', b'1'), ('pid-2', b'2'),
+                       ('pid-1/pid-3', b'3')):
+        spool = Spool(os.path.join(directory, path))
+        spool.append((data, 'k'))
+        spool.close()
+
+    with mock.patch('kinesis_producer.spool.pid_alive',
+                    side_effect=lambda pid: pid == 2):
+        spool = Spool(directory)
+    records = []
+    while spool.oldest_segment():
+        path = spool.oldest_segment()
+        records.extend(record for _, record, _ in read_segment(path))
+        spool.remove(path)
+    assert records == [(b'3', 'k'), (b'1', 'k')]
+    assert sorted(os.listdir(directory)) == ['pid-2']
+
+    client = mock.Mock()
+    client.put_record.side_effect = \
+        lambda record, callback, stream: callback({'ShardId': 'shardId-0'})
+    with mock.patch('kinesis_producer.spool.pid_alive', return_value=False):
+        assert SpoolReplayer(spool, client).replay()  # pid 2 exited
+    assert client.put_record.call_args[0][0] == (b'2', 'k')
+    assert os.listdir(directory) == []
+
+
+def test_replay(tmpdir):
+    spool = Spool(str(tmpdir), segment_size=1)
+    spool.append((b'1', 'k'))
+    spool.append((b'2', 'k'), 'other')
+    client = mock.Mock()
+    client.put_record.side_effect = \
+        lambda record, callback, stream: callback({'ShardId': 'shardId-0'})
+
+    replayer = SpoolReplayer(spool, client)
+    assert replayer.replay()
+
+    sent = [(call[0][0], call[1]['stream'])
+            for call in client.put_record.call_args_list]
+    assert sent == [((b'1', 'k'), None), ((b'2', 'k'), 'other')]
+    assert spool.size == 0
+
+
+def test_replay_failure_resumes(tmpdir):
+    spool = Spool(str(tmpdir))
+    spool.append((b'1', 'k'))
+    spool.append((b'2', 'k'))
+    client = mock.Mock()
+    responses = [{}, Exception(), {}]
+    client.put_record.side_effect = \
+        lambda record, callback, stream: callback(responses.pop(0))
+
+    replayer = SpoolReplayer(spool, client)
+    assert not replayer.replay()
+    assert spool.size > 0
+
+    assert replayer.replay()
+    sent = [call[0][0] for call in client.put_record.call_args_list]
+    assert sent == [(b'1', 'k'), (b'2', 'k'), (b'2', 'k')]
+    assert spool.size == 0
+
+
+def test_get_spool(tmpdir):
+    assert get_spool({}) is None
+
+    directory = str(tmpdir.join('spool'))
+    spool = get_spool({'spool_directory': directory,
+                       'spool_fsync': 'never'})
+    assert spool.fsync == 'never'
+    assert os.path.isdir(directory)